@@ -0,0 +1,105 @@
+"""Compares the Tokenizer against the previous nltk based word extraction.
+
+Usage: python benchmarks/bench_tokenizer.py [--messages 1000000] [--nltk-messages 50000]
+
+The nltk path is a lot slower, so it runs on a sample (--nltk-messages) and the per-message time is compared. It is
+skipped if nltk or its punkt/stopwords data is not installed.
+"""
+
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+# run from anywhere, e.g. the repo root, without installing the package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from srg_analytics.tokenizer import default_tokenizer
+
+_WORDS = (
+    "the quick brown fox jumps over lazy dog hello world what are you doing tonight gaming with friends "
+    "python discord bot server channel message emoji analytics leaderboard naïve café über"
+).split()
+_EXTRAS = ("<@123456789012345678>", "<#123456789012345678>", "<:pog:123456789012345678>",
+           "https://example.com/some/path?x=1", "`inline code`", "lol!!", "don't", "it's", "42")
+
+
+def _generate_messages(amount: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    messages = []
+
+    for _ in range(amount):
+        if rng.random() < 0.02:
+            messages.append("```py\nprint('hello world')\n```")
+            continue
+
+        tokens = rng.choices(_WORDS, k=rng.randint(1, 20))
+        if rng.random() < 0.3:
+            tokens.insert(rng.randrange(len(tokens) + 1), rng.choice(_EXTRAS))
+
+        messages.append(" ".join(tokens))
+
+    return messages
+
+
+def _nltk_words(messages: list[str]) -> list[str]:
+    """The word extraction that the Tokenizer replaced."""
+    import nltk
+    import validators
+
+    stop_words = nltk.corpus.stopwords.words("english")
+    words = []
+
+    for sentence in messages:
+        if sentence.strip() == "":
+            continue
+        elif sentence[0:3] == "```" or sentence[-3:] == "```":
+            continue
+        elif validators.url(str(sentence)):
+            continue
+
+        for word in (w for w in nltk.tokenize.word_tokenize(sentence) if w not in stop_words):
+            if len(word) <= 1 or not word.isalpha():
+                continue
+
+            words.append(word.lower())
+
+    return words
+
+
+def _time(func, messages) -> tuple[float, int]:
+    start = time.perf_counter()
+    words = func(messages)
+
+    return time.perf_counter() - start, len(words)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--nltk-messages", type=int, default=50_000)
+    args = parser.parse_args()
+
+    messages = _generate_messages(args.messages)
+
+    elapsed, words = _time(default_tokenizer.words, messages)
+    per_message = elapsed / len(messages)
+    print(f"Tokenizer: {len(messages)} messages, {words} words in {elapsed:.2f}s ({per_message * 1e6:.2f} us/message)")
+
+    try:
+        nltk_elapsed, nltk_words = _time(_nltk_words, messages[:args.nltk_messages])
+    except (ImportError, LookupError) as e:
+        print(f"nltk: skipped ({type(e).__name__})")
+        return
+
+    nltk_per_message = nltk_elapsed / min(len(messages), args.nltk_messages)
+    print(
+        f"nltk:      {min(len(messages), args.nltk_messages)} messages, {nltk_words} words in {nltk_elapsed:.2f}s "
+        f"({nltk_per_message * 1e6:.2f} us/message)"
+    )
+    print(f"speedup:   {nltk_per_message / per_message:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Compares sending message batches to the worker processes pickled and in shared memory.
+
+Usage: python benchmarks/bench_transport.py [--messages 1000000] [--batch-size 10000] [--workers N] [--rounds 2]
+
+Every mode counts the same messages in the shared executor:
+- pickled words: pickled batches, the workers send back their raw word lists (the old process_messages)
+- pickled: pickled batches, the workers send back Counters
+- shared memory: batches packed into shared memory blocks, the workers send back Counters
+
+The words are counted with a Tokenizer without a cache, so no mode is sped up by the words an earlier one left in
+the workers' cache. The modes run in alternating order every round, and the fastest round of each is reported.
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+# run from anywhere, e.g. the repo root, without installing the package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bench_tokenizer import _generate_messages
+from srg_analytics.executor import run_batched, set_max_workers, shutdown_executor
+from srg_analytics.leaderboard import count_letters
+from srg_analytics.tokenizer import Tokenizer
+
+
+async def _time(func, messages: list, batch_size: int, shared_memory: bool) -> float:
+    start = time.perf_counter()
+    await run_batched(func, messages, batch_size, shared_memory=shared_memory)
+
+    return time.perf_counter() - start
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--batch-size", type=int, default=10_000)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--rounds", type=int, default=2)
+    args = parser.parse_args()
+
+    set_max_workers(args.workers)
+    messages = [message.encode("utf-8") for message in _generate_messages(args.messages)]
+    tokenizer = Tokenizer(cache_size=0)
+
+    modes = (
+        ("words", "pickled words", tokenizer.words, False),
+        ("words", "pickled", tokenizer.count, False),
+        ("words", "shared memory", tokenizer.count, True),
+        ("letters", "pickled", count_letters, False),
+        ("letters", "shared memory", count_letters, True),
+    )
+
+    # start the workers before timing anything
+    await run_batched(count_letters, messages[:1], 1)
+
+    # format - (task, mode): fastest time
+    best = {}
+    for round_ in range(args.rounds):
+        for task, mode, func, shared_memory in (modes if round_ % 2 == 0 else modes[::-1]):
+            elapsed = await _time(func, messages, args.batch_size, shared_memory)
+            best[task, mode] = min(elapsed, best.get((task, mode), elapsed))
+
+    for (task, mode), elapsed in best.items():
+        print(f"{task:<8} {mode:<14} {elapsed:6.2f}s ({len(messages) / elapsed:,.0f} messages/s)")
+
+    shutdown_executor()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,117 @@
+"""Checks the integer time bucketing of TimeBuckets (buckets.py) message by message against datetime.
+
+Usage: python benchmarks/check_buckets.py [--messages 200000] [--seed 0]
+
+Every epoch is bucketed the way the activity queries do it - buckets.sql() run in DuckDB, then buckets.index() - and
+compared with the hour, day, month or year the epoch falls into in the timezone according to datetime. The epochs are
+random over 2014-2031, plus the few hours around every local day, month and year boundary, for UTC offsets with and
+without whole hours (e.g. UTC+5:30, UTC+5:45, UTC-9:30). Exits with status 1 on the first mismatch. Requires the
+duckdb package.
+"""
+
+import argparse
+import datetime
+import random
+import sys
+from pathlib import Path
+
+import numpy as np
+
+# run from anywhere, e.g. the repo root, without installing the package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from srg_analytics.buckets import TimeBuckets
+from srg_analytics.dialect import DuckDBDialect
+
+_OFFSETS = ((0, 0), (3, 0), (-5, 0), (5, 30), (5, 45), (-9, -30), (14, 0), (-12, 0))
+_UNITS = ("hour", "day", "month", "year")
+
+_FIRST = datetime.datetime(2014, 1, 1, tzinfo=datetime.timezone.utc)
+_LAST = datetime.datetime(2031, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def _epochs(amount: int, timezone: datetime.timezone, rng: random.Random) -> list[int]:
+    """Random epochs, and the ones around the boundaries of the local days, months and years."""
+    epochs = [rng.randrange(int(_FIRST.timestamp()), int(_LAST.timestamp())) for _ in range(amount)]
+
+    day = _FIRST.astimezone(timezone).replace(hour=0, minute=0, second=0)
+    while day < _LAST:
+        # every day boundary of the first and last days of the months, and a sample of the others
+        if day.day in (1, 2, 28, 29, 30, 31) or rng.random() < 0.05:
+            boundary = int(day.timestamp())
+            epochs += [boundary - 3601, boundary - 1, boundary, boundary + 1, boundary + 3599, boundary + 3600]
+
+        day += datetime.timedelta(days=1)
+
+    return epochs
+
+
+def _expected(buckets: TimeBuckets, epoch: int, timezone: datetime.timezone) -> int:
+    """The index of the bucket an epoch falls into, according to datetime."""
+    local = datetime.datetime.fromtimestamp(epoch, timezone)
+    start = buckets.start
+
+    if buckets.unit == "hour":
+        return int((local.replace(minute=0, second=0) - start).total_seconds()) // 3600
+    if buckets.unit == "day":
+        return (local.date() - start.date()).days
+    if buckets.unit == "month":
+        return (local.year - start.year) * 12 + local.month - start.month
+
+    return local.year - start.year
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    import duckdb
+
+    rng = random.Random(args.seed)
+    dialect = DuckDBDialect()
+    con = duckdb.connect()
+
+    for hours, minutes in _OFFSETS:
+        timezone = datetime.timezone(datetime.timedelta(hours=hours, minutes=minutes))
+        epochs = _epochs(args.messages, timezone, rng)
+
+        con.execute("CREATE OR REPLACE TABLE epochs AS SELECT CAST(unnest(?) AS BIGINT) AS epoch", [epochs])
+
+        for unit in _UNITS:
+            buckets = TimeBuckets(unit, _FIRST.astimezone(timezone), 1)
+
+            rows = con.execute(f"SELECT epoch, {buckets.sql(dialect, 'epoch')} FROM epochs").fetchall()
+            indexes = buckets.index(np.array([bucket for _, bucket in rows], dtype=np.int64))
+
+            for (epoch, _), index in zip(rows, indexes.tolist()):
+                expected = _expected(buckets, epoch, timezone)
+                if index != expected:
+                    print(f"mismatch: {unit} of {epoch} in {timezone}: got bucket {index}, expected {expected}")
+                    sys.exit(1)
+
+            # and the counts scattered into the buckets of a whole year
+            year = TimeBuckets(unit, datetime.datetime(2024, 1, 1, tzinfo=timezone),
+                               {"hour": 8784, "day": 366, "month": 12, "year": 1}[unit])
+            rows = con.execute(
+                f"SELECT {year.sql(dialect, 'epoch')} AS bucket, COUNT(*) FROM epochs "
+                f"WHERE epoch BETWEEN {year.since} AND {year.until} GROUP BY bucket"
+            ).fetchall()
+
+            expected = np.zeros(year.count, dtype=np.int64)
+            for epoch in epochs:
+                if year.since <= epoch <= year.until:
+                    expected[_expected(year, epoch, timezone)] += 1
+
+            if not (year.counts(rows) == expected).all():
+                print(f"mismatch: counts of the {unit}s of 2024 in {timezone}")
+                sys.exit(1)
+
+        print(f"{timezone}: {len(epochs):,} epochs ok")
+
+    print("all ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,90 +1,353 @@
 """Functions for interacting with the database."""
 
+import contextlib
+import time
+
 import aiomysql
-from .schemas import DbCreds, Message
+from .schemas import DbCreds, Message, MessageEdit
+from .rollup import ROLLUP_TABLE, ROLLUP_KEY, SNAPSHOT_COLUMNS, MessageSnapshot, RollupDelta, rollup_upsert
+from .dialect import MySQLDialect
+from .filters import MessageFilter
+from .executor import map_batches, run_in_executor
+from .token_index import WORD_INDEX, TokenCounts, TokenDelta, TokenIndex
+from .emojis import EMOJI_INDEX, load_patterns
+from .postings import POSTINGS_TABLE, PostingsDelta, postings_batch, postings_create_table, postings_delete, postings_insert
+from .metrics import METRIC_COLUMNS, message_metrics, metrics_batch
+from .series_cache import SeriesCache
 import asyncio
 
+_ER_LOCK_DEADLOCK = 1213  # MySQL error of the transaction rolled back to break a deadlock
+_DEADLOCK_RETRIES = 3
+
+# named lock (GET_LOCK) held while migrating the legacy config table, and how long to wait for it in seconds
+_MIGRATE_CONFIG_LOCK = "srg_analytics.migrate_config"
+_MIGRATE_CONFIG_LOCK_TIMEOUT = 60
+
+
+# secondary indexes on every guild table, matching the filters used by the analysis functions
+# format - index name: columns
+_guild_indexes = {
+    "idx_epoch": ("epoch",),
+    "idx_author_epoch": ("author_id", "epoch"),
+    "idx_aliased_author_epoch": ("aliased_author_id", "epoch"),
+    "idx_channel_epoch": ("channel_id", "epoch"),
+}
+
+
+def _to_blob(content: str | bytes | None) -> bytes | None:
+    """Encodes message content for the BLOB column."""
+    return content.encode("utf-8") if isinstance(content, str) else content
+
 
 class DB:
     """Class for interaction with the database."""
 
-    def __init__(self, db_credentials: DbCreds):
+    dialect = MySQLDialect()
+    # token count tables kept up to date with the messages, next to the rollups
+    token_indexes: tuple[TokenIndex, ...] = (WORD_INDEX, EMOJI_INDEX)
+
+    def __init__(self, db_credentials: DbCreds, minsize: int = 1, maxsize: int = 10, pool_recycle: int = -1):
         self.con = None
         self.db_credentials: DbCreds = db_credentials
         self.is_connected = False
 
-        asyncio.create_task(self.connect())  # this doesn't work
+        # pool settings, see aiomysql.create_pool
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.pool_recycle = pool_recycle
+
+        self._connect_lock = asyncio.Lock()
+
+        # pool metrics, see pool_stats
+        self._acquires = 0
+        self._waiting = 0
+        self._acquire_wait_total = 0.0
+        self._acquire_wait_max = 0.0
+
+        # in-process copy of the config tables, loaded at connect and kept up to date by the config methods
+        self._channel_ignores: dict[int, set[int]] = {}  # guild_id: {channel_id, ...}
+        self._user_ignores: dict[int, set[int]] = {}  # guild_id: {user_id, ...}
+        self._aliases: dict[int, dict[int, list[int]]] = {}  # guild_id: {user_id: [alias_id, ...]}
+        self._timezones: dict[int, int] = {}  # guild_id: offset from UTC
+        self._config_loaded = False
+        self._config_refresh_task = None
+
+        # closed buckets of the activity series, see series_cache.py
+        self.series_cache = SeriesCache()
+
+    @classmethod
+    async def create(
+            cls, db_credentials: DbCreds, minsize: int = 1, maxsize: int = 10, pool_recycle: int = -1
+    ) -> "DB":
+        """Creates a DB and connects it.
+
+        minsize and maxsize bound the number of pooled connections, pool_recycle (seconds) replaces connections older
+        than that, -1 to never replace them.
+        """
+        db = cls(db_credentials, minsize=minsize, maxsize=maxsize, pool_recycle=pool_recycle)
+        await db.connect()
+        return db
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
 
     async def connect(self):
-        self.con = await aiomysql.create_pool(
+        """Creates the pool and the config tables. Does nothing if already connected."""
+        async with self._connect_lock:
+            if self.is_connected:
+                return
+
+            # building the emoji patterns takes a moment, so it happens in a thread while the tables are set up
+            patterns = asyncio.ensure_future(asyncio.to_thread(load_patterns))
+
+            self.con = await self._create_pool()
+            self.is_connected = True
+
+            await self._create_data_table()
+            await self.migrate_config()
+            # every write names the metric columns, so guild tables from before they existed get them first
+            await self.migrate_columns()
+            await self.load_config()
+            await patterns
+
+    async def _create_pool(self):
+        return await aiomysql.create_pool(
             host=self.db_credentials.host,
             port=self.db_credentials.port,
             user=self.db_credentials.user,
             password=self.db_credentials.password,
             db=self.db_credentials.name,
+            minsize=self.minsize,
+            maxsize=self.maxsize,
+            pool_recycle=self.pool_recycle,
             autocommit=True
         )
 
-        self.is_connected = True
+    def table(self, guild_id) -> str:
+        """The quoted name of a guild's table, for use in queries."""
+        return self.dialect.quote(guild_id)
+
+    async def close(self):
+        """Closes the pool, waiting for connections in use to be released."""
+        self.stop_config_refresh()
 
-        await self._create_data_table()
+        if self.con is not None:
+            self.con.close()
+            await self.con.wait_closed()
+
+        self.con = None
+        self.is_connected = False
+
+    @contextlib.asynccontextmanager
+    async def _acquire(self):
+        """Acquires a connection from the pool, connecting first if needed, and records how long that took."""
+        if self.con is None:
+            await self.connect()
+
+        self._waiting += 1
+        start = time.perf_counter()
+        try:
+            async with self.con.acquire() as conn:
+                wait = time.perf_counter() - start
+                self._waiting -= 1
+                start = None
+
+                self._acquires += 1
+                self._acquire_wait_total += wait
+                self._acquire_wait_max = max(self._acquire_wait_max, wait)
+
+                yield conn
+        finally:
+            if start is not None:
+                self._waiting -= 1
+
+    def pool_stats(self, reset: bool = False) -> dict:
+        """Returns the state of the connection pool and how long acquiring a connection has taken.
+
+        Pass reset=True to start measuring the wait times afresh after reading them.
+        """
+        stats = {
+            "minsize": self.minsize,
+            "maxsize": self.maxsize,
+            "size": self.con.size if self.con is not None else 0,
+            "free": self.con.freesize if self.con is not None else 0,
+            "in_use": self.con.size - self.con.freesize if self.con is not None else 0,
+            "waiting": self._waiting,
+            "acquires": self._acquires,
+            "total_wait": self._acquire_wait_total,
+            "avg_wait": self._acquire_wait_total / self._acquires if self._acquires else 0.0,
+            "max_wait": self._acquire_wait_max,
+        }
+
+        if reset:
+            self._acquires = 0
+            self._acquire_wait_total = 0.0
+            self._acquire_wait_max = 0.0
+
+        return stats
 
     async def _create_data_table(self):
-        # check if the "data" table exists, if not, create it
-        async with self.con.acquire() as conn:
+        # check if the config tables exist, if not, create them
+        statements = [
+            *self.dialect.create_table(
+                "channel_ignore",
+                """
+                    guild_id BIGINT NOT NULL,
+                    channel_id BIGINT NOT NULL
+                """,
+                ("guild_id", "channel_id"),
+            ),
+            *self.dialect.create_table(
+                "user_ignore",
+                """
+                    guild_id BIGINT NOT NULL,
+                    user_id BIGINT NOT NULL
+                """,
+                ("guild_id", "user_id"),
+            ),
+            *self.dialect.create_table(
+                "user_alias",
+                """
+                    guild_id BIGINT NOT NULL,
+                    user_id BIGINT NOT NULL,
+                    alias_id BIGINT NOT NULL
+                """,
+                ("guild_id", "user_id", "alias_id"),
+                {"idx_alias": ("guild_id", "alias_id")},
+            ),
+            *self.dialect.create_table(
+                "guild_settings",
+                """
+                    guild_id BIGINT NOT NULL,
+                    timezone SMALLINT NULL
+                """,
+                ("guild_id",),
+            ),
+            *self.dialect.create_table(
+                ROLLUP_TABLE,
+                """
+                    guild_id BIGINT NOT NULL,
+                    hour_bucket BIGINT NOT NULL,
+                    channel_id BIGINT NOT NULL,
+                    author_id BIGINT NOT NULL,
+                    aliased_author_id BIGINT NOT NULL,
+                    is_bot BOOLEAN NOT NULL,
+                    message_count INT NOT NULL DEFAULT 0,
+                    word_count BIGINT NOT NULL DEFAULT 0,
+                    char_count BIGINT NOT NULL DEFAULT 0,
+                    attachments INT NOT NULL DEFAULT 0
+                """,
+                ROLLUP_KEY,
+                {
+                    "idx_author": ("guild_id", "author_id", "hour_bucket"),
+                    "idx_aliased_author": ("guild_id", "aliased_author_id", "hour_bucket"),
+                    "idx_channel": ("guild_id", "channel_id", "hour_bucket"),
+                },
+            ),
+        ]
+
+        for index in self.token_indexes:
+            statements += index.create_table(self.dialect)
+        statements += postings_create_table(self.dialect)
+
+        async with self._acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(
-                    """
-                        CREATE TABLE IF NOT EXISTS config (
-                        _key TEXT NOT NULL,
-                        data1 TEXT NOT NULL,
-                        data2 TEXT NULL,
-                        data3 TEXT NULL
-                    );
-                    """
-                )
+                for statement in statements:
+                    await cur.execute(statement)
+
+        # Note: these replace the old generic `config` table, see migrate_config
+
+        # - channel_ignore: channels whose messages are not logged, per guild
+        # - user_ignore: users whose messages are not logged, per guild
+        # - user_alias: alt accounts (alias_id) counted as another user (user_id), per guild
+        # - guild_settings: one row of settings per guild
+        #  - timezone: offset from UTC, in hours
+        # - message_rollup: per guild, hour, channel and author totals of the guild tables, see rollup.py
+        #  - aliased_author_id is never NULL here, it falls back to author_id
+        # - word_index and emoji_index: per guild, author, channel and token counts of the guild tables, see
+        #   token_index.py
+        # - word_postings: the messages every word occurs in, see postings.py
+
+    async def migrate_config(self) -> dict[str, int]:
+        """Moves the rows of the legacy generic `config` table into the typed config tables.
+
+        The legacy table is renamed to `config_legacy` afterwards, so this only ever runs once. The rows are copied in
+        one transaction, but the RENAME is DDL, which MySQL commits on its own; if it fails, the copies stay and are
+        skipped (INSERT IGNORE) when this runs again. Processes connecting at the same time take turns on a named lock
+        (GET_LOCK), and the ones that come second find the table already migrated. Returns the number of rows copied
+        into each table.
+        """
+        async with self._acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT GET_LOCK(%s, %s);", (_MIGRATE_CONFIG_LOCK, _MIGRATE_CONFIG_LOCK_TIMEOUT))
+                if (await cur.fetchone())[0] != 1:
+                    raise RuntimeError("timed out waiting for another process to migrate the config table")
+
+                try:
+                    return await self._migrate_config(conn, cur)
+                finally:
+                    await cur.execute("SELECT RELEASE_LOCK(%s);", (_MIGRATE_CONFIG_LOCK,))
+
+    async def _migrate_config(self, conn, cur) -> dict[str, int]:
+        # checked under the lock, another process may have just migrated it
+        await cur.execute(
+            "SELECT COUNT(*) FROM information_schema.TABLES "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'config';"
+        )
+        if not (await cur.fetchone())[0]:
+            return {}
+
+        # Legacy format -
+        # - channel_ignore: data1 = guild_id, data2 = channel_id
+        # - user_ignore: data1 = guild_id, data2 = user_id
+        # - alias: data1 = guild_id, data2 = user_id, data3 = alias_id
+        # - timezone: data1 = guild_id, data2 = timezone
+        queries = {
+            "channel_ignore": """
+                INSERT IGNORE INTO channel_ignore (guild_id, channel_id)
+                SELECT CAST(data1 AS SIGNED), CAST(data2 AS SIGNED) FROM `config` WHERE _key = 'channel_ignore';
+            """,
+            "user_ignore": """
+                INSERT IGNORE INTO user_ignore (guild_id, user_id)
+                SELECT CAST(data1 AS SIGNED), CAST(data2 AS SIGNED) FROM `config` WHERE _key = 'user_ignore';
+            """,
+            "user_alias": """
+                INSERT IGNORE INTO user_alias (guild_id, user_id, alias_id)
+                SELECT CAST(data1 AS SIGNED), CAST(data2 AS SIGNED), CAST(data3 AS SIGNED)
+                FROM `config` WHERE _key = 'alias';
+            """,
+            "guild_settings": """
+                INSERT IGNORE INTO guild_settings (guild_id, timezone)
+                SELECT CAST(data1 AS SIGNED), CAST(data2 AS SIGNED) FROM `config` WHERE _key = 'timezone';
+            """,
+        }
+
+        migrated = {}
+
+        await conn.begin()
+        try:
+            for table, query in queries.items():
+                await cur.execute(query)
+                migrated[table] = cur.rowcount
+
+            await conn.commit()
+        except Exception:
+            await conn.rollback()
+            raise
 
-        # Note: This table will contain the following (so far):
-        # - channel_ignore
-        # - user_ignore
-        # - guild_pause
-        # - stopword
-        # - alias
-        # - timezone
-
-        # Format -
-        # - channel_ignore:
-        #  - _key: channel_ignore
-        #  - data1: guild_id
-        #  - data2: channel_id
-        #  - data3: None
-
-        # - user_ignore:
-        #  - _key: user_ignore
-        #  - data1: guild_id
-        #  - data2: user_id
-        #  - data3: None
-
-        # - alias:
-        #  - _key: alias
-        #  - data1: guild_id
-        #  - data2: user_id
-        #  - data3: alias_id
-
-        # - timezone:
-        #  - _key: timezone
-        #  - data1: guild_id
-        #  - data2: user_id
-        #  - data3: timezone
+        await cur.execute("RENAME TABLE `config` TO `config_legacy`;")
 
+        return migrated
 
     async def add_guild(self, guild_id):
         """Adds a guild (database), with boilerplate table."""
-        async with self.con.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(
-                    f"""
-                CREATE TABLE IF NOT EXISTS `{guild_id}` (
+        statements = self.dialect.create_table(
+            guild_id,
+            f"""
                 message_id BIGINT NOT NULL,
                 channel_id BIGINT NOT NULL,
                 author_id BIGINT NOT NULL,
@@ -93,28 +356,158 @@ class DB:
                 epoch BIGINT NOT NULL,
                 edit_epoch BIGINT,
                 is_bot BOOLEAN NOT NULL,
-                has_embed BOOLEAN NOT NULL,                       
+                has_embed BOOLEAN NOT NULL,
                 num_attachments SMALLINT NOT NULL DEFAULT 0,
                 ctx_id BIGINT,
                 user_mentions TEXT,
                 channel_mentions TEXT,
                 role_mentions TEXT,
                 reactions TEXT,
-                PRIMARY KEY (message_id)
-                );
-                """
+                {", ".join(f"{column} {type_}" for column, type_ in METRIC_COLUMNS.items())}
+            """,
+            ("message_id",),
+            _guild_indexes,
+        )
+
+        async with self._acquire() as conn:
+            async with conn.cursor() as cur:
+                for statement in statements:
+                    await cur.execute(statement)
+
+        # the table may already exist, from before the metric columns did
+        await self.migrate_columns([guild_id])
+
+    async def migrate_indexes(self, guild_ids: list[int] = None, delay: float = 0) -> dict[int, list[str]]:
+        """Adds the secondary indexes to guild tables created before they existed.
+
+        Every missing index is built with its own online ALTER (ALGORITHM=INPLACE, LOCK=NONE), one index of one
+        table at a time, so ingestion keeps writing to the table while it is being built. `delay` is slept between
+        each step to give the server some breathing room on large tables.
+        """
+        async with self._acquire() as conn:
+            async with conn.cursor() as cur:
+                if guild_ids is None:
+                    await cur.execute(
+                        "SELECT TABLE_NAME FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE();"
+                    )
+                    guild_ids = [int(name) for name, in await cur.fetchall() if name.isdigit()]
+
+                await cur.execute(
+                    "SELECT TABLE_NAME, INDEX_NAME FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE();"
                 )
+                existing = {(table, index) for table, index in await cur.fetchall()}
+
+        added = {}
+        for guild_id in guild_ids:
+            for name, columns in _guild_indexes.items():
+                if (str(guild_id), name) in existing:
+                    continue
+
+                # a fresh connection per step, so the pool is never held for the whole migration
+                async with self._acquire() as conn:
+                    async with conn.cursor() as cur:
+                        await cur.execute(
+                            f"ALTER TABLE {self.table(guild_id)} ADD INDEX {name} ({', '.join(columns)}), "
+                            f"ALGORITHM=INPLACE, LOCK=NONE;"
+                        )
+
+                added.setdefault(guild_id, []).append(name)
+
+                if delay:
+                    await asyncio.sleep(delay)
+
+        return added
+
+    async def migrate_columns(self, guild_ids: list[int] = None) -> dict[int, list[str]]:
+        """Adds the metric columns (see metrics.py) to guild tables created before they existed.
+
+        Runs on connect and add_guild, as writes fail without the columns. They are added empty (NULL), run
+        backfill_metrics on the guild afterwards to fill them in.
+        """
+        columns = {}
+        for table, column in await self.execute(self.dialect.columns_query, fetch="all"):
+            columns.setdefault(str(table), set()).add(column.lower())
+
+        if guild_ids is None:
+            guild_ids = [int(table) for table in columns if table.isdigit()]
+
+        added = {}
+        for guild_id in guild_ids:
+            missing = {
+                column: type_ for column, type_ in METRIC_COLUMNS.items() if column not in columns.get(str(guild_id), ())
+            }
+            if not missing:
+                continue
+
+            async with self._acquire() as conn:
+                async with conn.cursor() as cur:
+                    for statement in self.dialect.add_columns(guild_id, missing):
+                        await cur.execute(statement)
+
+            added[guild_id] = list(missing)
+
+        return added
+
+    async def backfill_metrics(self, guild_id: int, batch_size: int = 1000, delay: float = 0) -> int:
+        """Computes the metric columns of the messages that do not have them yet, e.g. after migrate_columns.
+
+        Walks the table in message_id order in batches, computing the metrics in the worker processes, and can be
+        stopped and resumed at any time. Returns the number of messages filled in.
+        """
+        filled = 0
+        last_message_id = -1
+
+        while True:
+            rows = await self.execute(
+                f"""
+                    SELECT message_id, channel_id, author_id, epoch, is_bot, has_embed, message_content
+                    FROM {self.table(guild_id)}
+                    WHERE message_id > %s AND word_count IS NULL
+                    ORDER BY message_id
+                    LIMIT {int(batch_size)};
+                """, (last_message_id,), fetch="all"
+            )
+
+            if not rows:
+                return filled
+
+            rows = await run_in_executor(metrics_batch, rows)
+
+            async with self._acquire() as conn:
+                async with conn.cursor() as cur:
+                    # the messages exist, so this never inserts; it just updates them in one statement
+                    await cur.executemany(
+                        f"""
+                            INSERT INTO {self.table(guild_id)} (message_id, channel_id, author_id, epoch, is_bot,
+                            has_embed, {", ".join(METRIC_COLUMNS)})
+                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                            {self.dialect.on_conflict(("message_id",), replace=tuple(METRIC_COLUMNS))};
+                        """, rows
+                    )
+
+            filled += len(rows)
+            last_message_id = rows[-1][0]
+
+            if delay:
+                await asyncio.sleep(delay)
 
     async def remove_guild(self, guild_id):
         """Removes the guild from the database."""
-        async with self.con.acquire() as conn:
+        async with self._acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(f"DROP TABLE IF EXISTS `{guild_id}`;")
+                await cur.execute(f"DROP TABLE IF EXISTS {self.table(guild_id)};")
 
-                await cur.execute(f"DELETE FROM config WHERE data1 = '{guild_id}';")
+                for table in ("channel_ignore", "user_ignore", "user_alias", "guild_settings", *self._derived_tables):
+                    await cur.execute(f"DELETE FROM {table} WHERE guild_id = %s;", (guild_id,))
+
+        self._channel_ignores.pop(guild_id, None)
+        self._user_ignores.pop(guild_id, None)
+        self._aliases.pop(guild_id, None)
+        self._timezones.pop(guild_id, None)
+        self.series_cache.clear(guild_id)
 
     async def execute(self, query, args=None, fetch=None):
-        async with self.con.acquire() as conn:
+        async with self._acquire() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(query.replace("?", "%s"), args)
                 if fetch is None:
@@ -126,19 +519,35 @@ class DB:
 
             await conn.commit()
 
+    async def iterate(self, query, args=None, batch_size: int = 10000):
+        """Yields the result of a query in lists of at most `batch_size` rows.
+
+        Uses an unbuffered server-side cursor, so only one batch is ever held in memory.
+        """
+        async with self._acquire() as conn:
+            async with conn.cursor(aiomysql.SSCursor) as cur:
+                await cur.execute(query.replace("?", "%s"), args)
+
+                while True:
+                    rows = await cur.fetchmany(batch_size)
+                    if not rows:
+                        break
+
+                    yield rows
+
     async def get(self, guild_id, selected: list = None):
         """Retrieves the guild from the database."""
 
         if selected is None:
             selected = ["*"]
-        async with self.con.acquire() as conn:
+        async with self._acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(f"SELECT {', '.join(selected)} FROM `{guild_id}`;")
+                await cur.execute(f"SELECT {', '.join(selected)} FROM {self.table(guild_id)};")
 
                 return await cur.fetchall()
 
     async def get_guilds(self):  # TODO TEST
-        async with self.con.acquire() as conn:
+        async with self._acquire() as conn:
             async with conn.cursor() as cur:
                 await cur.execute("SHOW TABLES;")
 
@@ -146,83 +555,485 @@ class DB:
 
     async def add_message(self, guild_id, data: Message):
         """Adds a message to the database."""
-        async with self.con.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(
-                    f"""
-                        INSERT IGNORE INTO `{guild_id}` (message_id, channel_id, author_id, aliased_author_id, message_content, epoch, 
-                        edit_epoch, is_bot, has_embed, num_attachments, ctx_id, user_mentions, channel_mentions, role_mentions, reactions)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
-                    """,
-                    (
-                        data.message_id,
-                        data.channel_id,
-                        data.author_id,
-                        data.aliased_author_id,
-                        data.message_content,
-                        data.epoch,
-                        data.edit_epoch,
-                        data.is_bot,
-                        data.has_embed,
-                        data.num_attachments,
-                        data.ctx_id,
-                        data.user_mentions,
-                        data.channel_mentions,
-                        data.role_mentions,
-                        data.reactions,
-                    ),
-                )
+        await self.add_messages_bulk(guild_id, [data])
 
-    async def add_messages_bulk(self, guild_id, data: Message):
-        async with self.con.acquire() as conn:
+    async def add_messages_bulk(self, guild_id, data: list[Message]):
+        # INSERT IGNORE keeps the first copy of a message, so only messages that are actually new are rolled up
+        messages = {}
+        for message in data:
+            messages.setdefault(message.message_id, message)
+
+        if not messages:
+            return
+
+        # two overlapping bulk inserts of the same new messages deadlock on their row locks, see _insert_messages; the
+        # one that is rolled back finds the messages there on its retry
+        for attempt in range(_DEADLOCK_RETRIES):
+            try:
+                added = await self._insert_messages(guild_id, dict(messages))
+                break
+            except aiomysql.OperationalError as e:
+                if e.args[0] != _ER_LOCK_DEADLOCK or attempt == _DEADLOCK_RETRIES - 1:
+                    raise
+
+        self._invalidate_series(guild_id, added)
+
+    async def _insert_messages(self, guild_id, messages: dict[int, Message]) -> list[MessageSnapshot]:
+        """Inserts the messages that are not in the guild table yet and adds them to the derived tables, in one
+        transaction. Returns the messages that were added."""
+        # tokenized once, before the row locks are taken, and shared by the metrics and the derived tables
+        snapshots = {message_id: MessageSnapshot.from_message(message) for message_id, message in messages.items()}
+        counts = self._count_tokens(snapshots.values())
+
+        async with self._acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.executemany(
-                    f"""
-                        INSERT IGNORE INTO `{guild_id}` (message_id, channel_id, author_id, aliased_author_id, message_content, epoch, 
-                        edit_epoch, is_bot, has_embed, num_attachments, ctx_id, user_mentions, channel_mentions, role_mentions, reactions)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
-                    """, [(
-                        message.message_id,
-                        message.channel_id,
-                        message.author_id,
-                        message.aliased_author_id,
-                        message.message_content,
-                        message.epoch,
-                        message.edit_epoch,
-                        message.is_bot,
-                        message.has_embed,
-                        message.num_attachments,
-                        message.ctx_id,
-                        message.user_mentions,
-                        message.channel_mentions,
-                        message.role_mentions,
-                        message.reactions,
-                    ) for message in data]
-                )
+                await conn.begin()
+                try:
+                    if len(messages) > 1:
+                        # locks the ids (or the gaps where they would go), so no other transaction inserts the same
+                        # messages in between and adds them to the derived tables too
+                        await cur.execute(
+                            f"SELECT message_id FROM {self.table(guild_id)} WHERE message_id IN ({', '.join(['%s'] * len(messages))}) {self.dialect.for_update};",
+                            tuple(messages),
+                        )
+                        for message_id, in await cur.fetchall():
+                            del messages[message_id]
+
+                    if not messages:
+                        await conn.commit()
+                        return []
+
+                    await cur.executemany(
+                        f"""
+                            {self.dialect.insert_ignore} INTO {self.table(guild_id)} (message_id, channel_id, author_id, aliased_author_id, message_content, epoch, 
+                            edit_epoch, is_bot, has_embed, num_attachments, ctx_id, user_mentions, channel_mentions, role_mentions, reactions,
+                            {", ".join(METRIC_COLUMNS)})
+                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
+                        """, [(
+                            message.message_id,
+                            message.channel_id,
+                            message.author_id,
+                            message.aliased_author_id,
+                            _to_blob(message.message_content),
+                            message.epoch,
+                            message.edit_epoch,
+                            message.is_bot,
+                            message.has_embed,
+                            message.num_attachments,
+                            message.ctx_id,
+                            message.user_mentions,
+                            message.channel_mentions,
+                            message.role_mentions,
+                            message.reactions,
+                            *self._message_metrics(snapshots[message.message_id], counts),
+                        ) for message in messages.values()]
+                    )
+
+                    # a single message is checked with the rowcount instead of a SELECT
+                    added = []
+                    if len(messages) > 1 or cur.rowcount == 1:
+                        added = [snapshots[message_id] for message_id in messages]
+                        await self._update_derived(cur, guild_id, added=added, counts=counts)
+
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
+
+        return added
 
     async def delete_message(self, guild_id: int, message_id: int):
-        async with self.con.acquire() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(f"DELETE FROM `{guild_id}` WHERE message_id = {message_id};")
+        await self.delete_messages_bulk(guild_id, [message_id])
+
+    async def delete_messages_bulk(self, guild_id: int, message_ids: list[int], chunk_size: int = 500) -> int:
+        """Deletes many messages (e.g. a purge), one transaction per chunk. Returns the number of deleted messages."""
+        deleted = 0
+
+        for i in range(0, len(message_ids), chunk_size):
+            chunk = tuple(message_ids[i:i + chunk_size])
+            placeholders = ", ".join(["%s"] * len(chunk))
+
+            async with self._acquire() as conn:
+                async with conn.cursor() as cur:
+                    await conn.begin()
+                    try:
+                        # locked, so the derived tables are updated from the rows that are actually deleted
+                        await cur.execute(
+                            f"SELECT {SNAPSHOT_COLUMNS} FROM {self.table(guild_id)} WHERE message_id IN ({placeholders}) "
+                            f"{self.dialect.for_update};", chunk
+                        )
+                        removed = [MessageSnapshot(*row) for row in await cur.fetchall()]
+
+                        await cur.execute(f"DELETE FROM {self.table(guild_id)} WHERE message_id IN ({placeholders});", chunk)
+                        deleted += cur.rowcount
+
+                        await self._update_derived(cur, guild_id, removed=removed)
+
+                        await conn.commit()
+                    except Exception:
+                        await conn.rollback()
+                        raise
+
+                self._invalidate_series(guild_id, removed)
+
+        return deleted
 
     async def edit_message(
             self, guild_id: int, message_id: int, content: str, edit_epoch: int, user_mentions: str,
             channel_mentions: str, role_mentions: str, num_attachments: int
     ):
-        async with self.con.acquire() as conn:
+        await self.edit_messages_bulk(
+            guild_id,
+            [MessageEdit(message_id, content, edit_epoch, user_mentions, channel_mentions, role_mentions, num_attachments)]
+        )
+
+    async def edit_messages_bulk(self, guild_id: int, edits: list[MessageEdit], chunk_size: int = 500) -> int:
+        """Applies many edits at once, one transaction per chunk. Returns the number of edited messages.
+
+        Edits of messages that are not in the database are skipped, as with edit_message.
+        """
+        # the last edit of a message wins
+        edits = list({edit.message_id: edit for edit in edits}.values())
+        edited = 0
+
+        for i in range(0, len(edits), chunk_size):
+            chunk = {edit.message_id: edit for edit in edits[i:i + chunk_size]}
+
+            async with self._acquire() as conn:
+                async with conn.cursor() as cur:
+                    await conn.begin()
+                    try:
+                        # locked until the commit, so a concurrent delete cannot land between this and the upsert
+                        # below, which would then insert the deleted message again
+                        await cur.execute(
+                            f"SELECT {SNAPSHOT_COLUMNS}, has_embed FROM {self.table(guild_id)} "
+                            f"WHERE message_id IN ({', '.join(['%s'] * len(chunk))}) {self.dialect.for_update};",
+                            tuple(chunk),
+                        )
+                        rows = await cur.fetchall()
+
+                        removed = [MessageSnapshot(*row[:-1]) for row in rows]
+                        added = [
+                            old._replace(
+                                message_content=chunk[old.message_id].message_content,
+                                num_attachments=chunk[old.message_id].num_attachments
+                            )
+                            for old in removed
+                        ]
+                        counts = self._count_tokens(added)
+
+                        # only existing messages are passed, so this never inserts; it just updates them in one statement
+                        await cur.executemany(
+                            f"""
+                                INSERT INTO {self.table(guild_id)} (message_id, channel_id, author_id, epoch, is_bot, has_embed,
+                                message_content, edit_epoch, user_mentions, channel_mentions, role_mentions, num_attachments,
+                                {", ".join(METRIC_COLUMNS)})
+                                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                                {self.dialect.on_conflict(
+                                    ("message_id",),
+                                    replace=("message_content", "edit_epoch", "user_mentions", "channel_mentions",
+                                             "role_mentions", "num_attachments", *METRIC_COLUMNS)
+                                )};
+                            """, [(
+                                old.message_id,
+                                old.channel_id,
+                                old.author_id,
+                                old.epoch,
+                                old.is_bot,
+                                has_embed,
+                                _to_blob(chunk[old.message_id].message_content),
+                                chunk[old.message_id].edit_epoch,
+                                chunk[old.message_id].user_mentions,
+                                chunk[old.message_id].channel_mentions,
+                                chunk[old.message_id].role_mentions,
+                                chunk[old.message_id].num_attachments,
+                                *self._message_metrics(new, counts),
+                            ) for old, new, (*_, has_embed) in zip(removed, added, rows)]
+                        )
+                        edited += len(removed)
+
+                        await self._update_derived(cur, guild_id, removed=removed, added=added, counts=counts)
+
+                        await conn.commit()
+                    except Exception:
+                        await conn.rollback()
+                        raise
+
+                self._invalidate_series(guild_id, removed)
+
+        return edited
+
+    @property
+    def _derived_tables(self) -> tuple[str, ...]:
+        """The tables aggregated from the guild tables, keyed by guild_id."""
+        return ROLLUP_TABLE, *(index.table for index in self.token_indexes), POSTINGS_TABLE
+
+    def _invalidate_series(self, guild_id: int, messages):
+        """Drops the cached activity buckets of the messages. Called both while the transaction writing them is open
+        and after it is committed, so counts read in between are not kept, see SeriesCache.put."""
+        self.series_cache.invalidate(guild_id, [message.epoch for message in messages])
+
+    def _count_tokens(self, messages) -> TokenCounts:
+        """Tokenizes the messages for the token indexes, the postings and the metrics, see _update_derived."""
+        counts = TokenCounts()
+        for message in messages:
+            for index in {*self.token_indexes, WORD_INDEX, EMOJI_INDEX}:
+                counts.get(index, message.text)
+
+        return counts
+
+    @staticmethod
+    def _message_metrics(message: MessageSnapshot, counts: TokenCounts) -> tuple:
+        """The values of METRIC_COLUMNS for a message, with its emojis counted from counts."""
+        return message_metrics(message.message_content, sum(counts.get(EMOJI_INDEX, message.text).values()))
+
+    async def _update_derived(
+            self, cur, guild_id: int, removed: list[MessageSnapshot] = (), added: list[MessageSnapshot] = (),
+            counts: TokenCounts = None
+    ):
+        """Applies the removed and added messages to the rollup table, the token indexes and the postings, on the
+        cursor of the calling transaction. An edit is passed as the old message removed and the new one added. Every
+        message is tokenized once, the counts the caller already has are reused.
+
+        The callers call _invalidate_series again once the transaction is committed."""
+        if counts is None:
+            counts = TokenCounts()
+
+        self._invalidate_series(guild_id, (*removed, *added))
+
+        delta = RollupDelta()
+
+        for message in removed:
+            delta.add(message, -1)
+        for message in added:
+            delta.add(message)
+
+        rows = delta.rows(guild_id)
+        if rows:
+            await cur.executemany(rollup_upsert(self.dialect), rows)
+
+        for index in self.token_indexes:
+            token_delta = TokenDelta(index)
+
+            for message in removed:
+                token_delta.add(message, -1, counts)
+            for message in added:
+                token_delta.add(message, counts=counts)
+
+            await self._apply_token_delta(cur, guild_id, token_delta)
+
+        postings_delta = PostingsDelta()
+
+        for message in removed:
+            postings_delta.add(message, -1)
+        for message in added:
+            postings_delta.add(message, counts=counts)
+
+        await self._apply_postings_delta(cur, guild_id, postings_delta)
+
+    async def _apply_postings_delta(self, cur, guild_id: int, delta: PostingsDelta):
+        removed = delta.removed(guild_id)
+        if removed:
+            await cur.executemany(postings_delete(), removed)
+
+        rows = delta.rows(guild_id)
+        if rows:
+            await cur.executemany(postings_insert(self.dialect), rows)
+
+    async def _apply_token_delta(self, cur, guild_id: int, delta: TokenDelta):
+        rows = delta.rows(guild_id)
+        if rows:
+            await cur.executemany(delta.index.upsert(self.dialect), rows)
+
+        pruned = delta.pruned(guild_id)
+        if pruned:
+            await cur.executemany(delta.index.prune(), pruned)
+
+    async def rebuild_rollups(self, guild_id: int, batch_size: int = 10000):
+        """Rebuilds the rollups of a guild from its messages, e.g. for messages logged before rollups existed.
+
+        Pause ingestion for the guild while this runs, messages added during the rebuild can be counted twice.
+        """
+        await self.execute(f"DELETE FROM {ROLLUP_TABLE} WHERE guild_id = %s;", (guild_id,))
+
+        delta = RollupDelta()
+
+        async for rows in self._iter_snapshots(guild_id, batch_size):
+            for row in rows:
+                delta.add(MessageSnapshot(*row))
+
+            # flush every so often, the upsert adds onto what is already there
+            if len(delta) >= batch_size:
+                await self._flush_rollup_delta(guild_id, delta)
+                delta = RollupDelta()
+
+        await self._flush_rollup_delta(guild_id, delta)
+
+        # anything cached while the rollups were being rebuilt was counted from some of them
+        self.series_cache.clear(guild_id)
+
+    async def _iter_snapshots(self, guild_id: int, batch_size: int):
+        """Yields the SNAPSHOT_COLUMNS of the messages of a guild in batches, in message_id order.
+
+        Every batch is its own query, so no connection is held between batches and the rebuilds can flush their
+        deltas in between, even with a pool of one connection (e.g. DuckDB).
+        """
+        last_message_id = -1
+
+        while True:
+            rows = await self.execute(
+                f"""
+                    SELECT {SNAPSHOT_COLUMNS}
+                    FROM {self.table(guild_id)}
+                    WHERE message_id > %s
+                    ORDER BY message_id
+                    LIMIT {int(batch_size)};
+                """, (last_message_id,), fetch="all"
+            )
+
+            if not rows:
+                return
+
+            yield rows
+            last_message_id = rows[-1][0]
+
+    async def _flush_rollup_delta(self, guild_id: int, delta: RollupDelta):
+        rows = delta.rows(guild_id)
+        if not rows:
+            return
+
+        async with self._acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(
-                    f"UPDATE `{guild_id}` SET message_content = %s, edit_epoch = %s, user_mentions = %s, channel_mentions = %s, role_mentions = %s, num_attachments = %s WHERE message_id = %s;",
-                    (
-                        content,
-                        edit_epoch,
-                        user_mentions,
-                        channel_mentions,
-                        role_mentions,
-                        num_attachments,
-                        message_id,
-                    ),
-                )
+                await cur.executemany(rollup_upsert(self.dialect), rows)
+
+    async def rebuild_token_index(self, guild_id: int, index: TokenIndex = WORD_INDEX, batch_size: int = 10000):
+        """Rebuilds a token index (by default the word index) of a guild from its messages, e.g. for messages logged
+        before the index existed. The messages are tokenized in the worker processes, see executor.py.
+
+        Pause ingestion for the guild while this runs, messages added during the rebuild can be counted twice.
+        """
+        await self.execute(f"DELETE FROM {index.table} WHERE guild_id = %s;", (guild_id,))
+
+        delta = TokenDelta(index)
+        batches = self._iter_snapshots(guild_id, batch_size)
+
+        async for batch_delta in map_batches(index.delta, batches):
+            delta.update(batch_delta)
+
+            # flush every so often, the upsert adds onto what is already there
+            if len(delta) >= batch_size:
+                await self._flush_token_delta(guild_id, delta)
+                delta = TokenDelta(index)
+
+        await self._flush_token_delta(guild_id, delta)
+
+    async def _flush_token_delta(self, guild_id: int, delta: TokenDelta):
+        async with self._acquire() as conn:
+            async with conn.cursor() as cur:
+                await self._apply_token_delta(cur, guild_id, delta)
+
+    async def rebuild_postings(self, guild_id: int, batch_size: int = 10000):
+        """Rebuilds the word postings of a guild from its messages, e.g. for messages logged before the postings
+        existed. The messages are tokenized in the worker processes, see executor.py.
+
+        Messages are never posted twice, so new messages can keep coming in while this runs; pause edits and deletes
+        for the guild though, they can be undone by the rebuild.
+        """
+        await self.execute(f"DELETE FROM {POSTINGS_TABLE} WHERE guild_id = %s;", (guild_id,))
+
+        delta = PostingsDelta()
+        batches = self._iter_snapshots(guild_id, batch_size)
+
+        async for batch_delta in map_batches(postings_batch, batches):
+            delta.update(batch_delta)
+
+            if len(delta) >= batch_size:
+                await self._flush_postings_delta(guild_id, delta)
+                delta = PostingsDelta()
+
+        await self._flush_postings_delta(guild_id, delta)
+
+    async def _flush_postings_delta(self, guild_id: int, delta: PostingsDelta):
+        async with self._acquire() as conn:
+            async with conn.cursor() as cur:
+                await self._apply_postings_delta(cur, guild_id, delta)
+
+    async def load_config(self):
+        """(Re)loads all the config tables into the in-process cache."""
+        channel_ignores = {}
+        user_ignores = {}
+        aliases = {}
+        timezones = {}
+
+        async with self._acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT guild_id, channel_id FROM channel_ignore;")
+                for guild_id, channel_id in await cur.fetchall():
+                    channel_ignores.setdefault(guild_id, set()).add(channel_id)
+
+                await cur.execute("SELECT guild_id, user_id FROM user_ignore;")
+                for guild_id, user_id in await cur.fetchall():
+                    user_ignores.setdefault(guild_id, set()).add(user_id)
+
+                await cur.execute("SELECT guild_id, user_id, alias_id FROM user_alias;")
+                for guild_id, user_id, alias_id in await cur.fetchall():
+                    aliases.setdefault(guild_id, {}).setdefault(user_id, []).append(alias_id)
+
+                await cur.execute("SELECT guild_id, timezone FROM guild_settings WHERE timezone IS NOT NULL;")
+                for guild_id, timezone in await cur.fetchall():
+                    timezones[guild_id] = timezone
+
+        # swap everything in at once, so readers never see a half loaded cache
+        self._channel_ignores = channel_ignores
+        self._user_ignores = user_ignores
+        self._aliases = aliases
+        self._timezones = timezones
+        self._config_loaded = True
+
+    async def _ensure_config(self):
+        """Connects if needed, which loads the config cache, before it is read."""
+        if not self._config_loaded:
+            await self.connect()
+
+    def start_config_refresh(self, interval: float = 60):
+        """Periodically reloads the config cache, for when other processes write to the same database."""
+        self.stop_config_refresh()
+        self._config_refresh_task = asyncio.create_task(self._refresh_config(interval))
+
+    def stop_config_refresh(self):
+        if self._config_refresh_task is not None:
+            self._config_refresh_task.cancel()
+            self._config_refresh_task = None
+
+    async def _refresh_config(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+
+            try:
+                await self.load_config()
+            except Exception as e:
+                print(e)
+
+    def is_ignored(self, guild_id: int = None, channel_id: int = None, user_id: int = None) -> bool:
+        """Returns whether a channel or user is ignored, from the config cache.
+
+        The cache is loaded by connect(), call it (or await helpers.is_ignored, which does) first.
+        """
+        if channel_id is None and user_id is None:
+            raise ValueError("channel_id and user_id cannot both be None")
+        if not self._config_loaded:
+            raise RuntimeError("the config cache is not loaded yet, connect the DB first")
+
+        if guild_id is not None:
+            return (
+                channel_id in self._channel_ignores.get(guild_id, ())
+                or user_id in self._user_ignores.get(guild_id, ())
+            )
+
+        return (
+            any(channel_id in channels for channels in self._channel_ignores.values())
+            or any(user_id in users for users in self._user_ignores.values())
+        )
 
     async def add_ignore(
             self, guild_id: int, channel_id: int = None, user_id: int = None, update_existing: bool = False
@@ -233,32 +1044,48 @@ class DB:
         # Ignore based on channel_id
         if channel_id is not None:
             # Add to database
-            async with self.con.acquire() as conn:
+            async with self._acquire() as conn:
                 async with conn.cursor() as cur:
                     await cur.execute(
-                        "INSERT IGNORE INTO `config` (_key, data1, data2) VALUES ('channel_ignore', %s, %s);",
+                        f"{self.dialect.insert_ignore} INTO channel_ignore (guild_id, channel_id) VALUES (%s, %s);",
                         (guild_id, channel_id,),
                     )
 
                     if update_existing:
                         await cur.execute(
-                            f"DELETE FROM `{guild_id}` WHERE channel_id = {channel_id};"
+                            f"DELETE FROM {self.table(guild_id)} WHERE channel_id = {channel_id};"
                         )
+                        for table in self._derived_tables:
+                            await cur.execute(
+                                f"DELETE FROM {table} WHERE guild_id = %s AND channel_id = %s;",
+                                (guild_id, channel_id),
+                            )
+                        self.series_cache.clear(guild_id)
+
+            self._channel_ignores.setdefault(guild_id, set()).add(channel_id)
 
         # Ignore based on user_id
         elif user_id is not None:
             # Add to database
-            async with self.con.acquire() as conn:
+            async with self._acquire() as conn:
                 async with conn.cursor() as cur:
                     await cur.execute(
-                        "INSERT IGNORE INTO `config` (_key, data1, data2) VALUES ('user_ignore', %s, %s);",
+                        f"{self.dialect.insert_ignore} INTO user_ignore (guild_id, user_id) VALUES (%s, %s);",
                         (guild_id, user_id),
                     )
 
                     if update_existing:
                         await cur.execute(
-                            f"DELETE FROM `{guild_id}` WHERE author_id = {user_id};"
+                            f"DELETE FROM {self.table(guild_id)} WHERE author_id = {user_id};"
                         )
+                        for table in self._derived_tables:
+                            await cur.execute(
+                                f"DELETE FROM {table} WHERE guild_id = %s AND author_id = %s;",
+                                (guild_id, user_id),
+                            )
+                        self.series_cache.clear(guild_id)
+
+            self._user_ignores.setdefault(guild_id, set()).add(user_id)
 
 
     async def remove_ignore(
@@ -270,111 +1097,104 @@ class DB:
         # Ignore based on channel_id
         if channel_id is not None:
             # Add to database
-            async with self.con.acquire() as conn:
+            async with self._acquire() as conn:
                 async with conn.cursor() as cur:
                     await cur.execute(
-                        "DELETE FROM `config` WHERE _key = 'channel_ignore' AND data1 = %s AND data2 = %s;",
+                        "DELETE FROM channel_ignore WHERE guild_id = %s AND channel_id = %s;",
                         (guild_id, channel_id),
                     )
 
+            self._channel_ignores.get(guild_id, set()).discard(channel_id)
+
         # Ignore based on user_id
         elif user_id is not None:
             # Add to database
-            async with self.con.acquire() as conn:
+            async with self._acquire() as conn:
                 async with conn.cursor() as cur:
                     await cur.execute(
-                        "DELETE FROM `config` WHERE _key = 'user_ignore' AND data1 = %s AND data2 = %s;",
+                        "DELETE FROM user_ignore WHERE guild_id = %s AND user_id = %s;",
                         (guild_id, user_id),
                     )
 
+            self._user_ignores.get(guild_id, set()).discard(user_id)
+
 
     async def get_ignore_list(self, type_: str, guild_id: int = None) -> dict or list:
+        await self._ensure_config()
+
         if type_ not in ["channel", "user"]:
             raise ValueError("type_ must be either 'channel' or 'user'")
 
-        if guild_id is not None:
-            async with self.con.acquire() as conn:
-                async with conn.cursor() as cur:
-                    await cur.execute(
-                        "SELECT data1, data2 FROM `config` WHERE _key = %s AND data1 = %s;",
-                        (f"{type_}_ignore", guild_id),
-                    )
-
-                    # format of res: [(guild_id, channel_id), (guild_id, channel_id), ...]
-                    res = await cur.fetchall()
-
-            # convert to this format -
-            # [channel_id, channel_id, ...]
-            res = [int(channel_id) for _, channel_id in res if _ == guild_id]  # todo check if == guild_id is needed
-            return res
-
-        else:
-            # get list of the one that is not None
-            async with self.con.acquire() as conn:
-                async with conn.cursor() as cur:
-                    await cur.execute(
-                        "SELECT data1, data2 FROM `config` WHERE _key = %s;",
-                        (f"{type_}_ignore",),
-                    )
+        ignores = self._channel_ignores if type_ == "channel" else self._user_ignores
 
-                    # format of res: [(guild_id, channel_id), (guild_id, channel_id), ...]
-                    res = await cur.fetchall()
+        if guild_id is not None:
+            # format - [channel_id, channel_id, ...]
+            return list(ignores.get(guild_id, ()))
 
-            # convert to this format -
-            # {
-            #   guild_id: [channel_id, channel_id, ...],
-            #   guild_id: [channel_id, channel_id, ...], ...
-            # }
-            res = {
-                int(guild_id): [
-                    int(channel_id) for _, channel_id in res if _ == guild_id
-                ]
-                for guild_id, _ in res
-            }
-            return res
+        # format -
+        # {
+        #   guild_id: [channel_id, channel_id, ...],
+        #   guild_id: [channel_id, channel_id, ...], ...
+        # }
+        return {guild_id_: list(ids) for guild_id_, ids in ignores.items() if ids}
 
 
     async def add_user_alias(self, guild_id: int, user_id: int, alias_id: int, update_existing: bool = True):
-        async with self.con.acquire() as conn:
+        async with self._acquire() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(
-                    "INSERT IGNORE INTO `config` (_key, data1, data2, data3) VALUES ('alias', %s, %s, %s);",
+                    f"{self.dialect.insert_ignore} INTO user_alias (guild_id, user_id, alias_id) VALUES (%s, %s, %s);",
                     (guild_id, user_id, alias_id),
                 )
                 if update_existing:
                     # replace all existing aliases with the new one
                     await cur.execute(
-                        f"UPDATE `{guild_id}` SET aliased_author_id = {user_id} WHERE author_id = {alias_id};"
+                        f"UPDATE {self.table(guild_id)} SET aliased_author_id = {user_id} WHERE author_id = {alias_id};"
                     )
+                    for table in self._derived_tables:
+                        await cur.execute(
+                            f"UPDATE {table} SET aliased_author_id = %s WHERE guild_id = %s AND author_id = %s;",
+                            (user_id, guild_id, alias_id),
+                        )
+                    self.series_cache.clear(guild_id)
+
+        alias_ids = self._aliases.setdefault(guild_id, {}).setdefault(user_id, [])
+        if alias_id not in alias_ids:
+            alias_ids.append(alias_id)
 
 
     async def remove_user_alias(self, guild_id: int, user_id: int, alias_id: int, update_existing: bool = True):
-        async with self.con.acquire() as conn:
+        async with self._acquire() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(
-                    "DELETE FROM `config` WHERE _key = 'alias' AND data1 = %s AND data2 = %s AND data3 = %s;",
+                    "DELETE FROM user_alias WHERE guild_id = %s AND user_id = %s AND alias_id = %s;",
                     (guild_id, user_id, alias_id),
                 )
                 if update_existing:
                     # replace all existing aliases with the new one
                     await cur.execute(
-                        f"UPDATE `{guild_id}` SET aliased_author_id = NULL WHERE author_id = {alias_id};"
+                        f"UPDATE {self.table(guild_id)} SET aliased_author_id = NULL WHERE author_id = {alias_id};"
                     )
+                    for table in self._derived_tables:
+                        await cur.execute(
+                            f"UPDATE {table} SET aliased_author_id = author_id WHERE guild_id = %s AND author_id = %s;",
+                            (guild_id, alias_id),
+                        )
+                    self.series_cache.clear(guild_id)
 
+        alias_ids = self._aliases.get(guild_id, {}).get(user_id, [])
+        if alias_id in alias_ids:
+            alias_ids.remove(alias_id)
 
-    async def get_user_aliases(self, guild_id: int = None):
-        if guild_id is None:
-            async with self.con.acquire() as conn:
-                async with conn.cursor() as cur:
-                    await cur.execute(
-                        "SELECT data1, data2, data3 FROM `config` WHERE _key = 'alias';"
-                    )
+        if not alias_ids:
+            self._aliases.get(guild_id, {}).pop(user_id, None)
 
-                    # data1 is guild_id, data2 is user_id, data3 is alias_id
 
-                    res = await cur.fetchall()
+    async def get_user_aliases(self, guild_id: int = None):
+        await self._ensure_config()
 
-            # convert into this format -
+        if guild_id is None:
+            # format -
             # {
             #   guild_id: {
             #       user_id: [alias_id, alias_id, ...],
@@ -384,124 +1204,51 @@ class DB:
             #       user_id: [alias_id, alias_id, ...],
             #       user_id: [alias_id, alias_id, ...], ...
             #   }, ...
-
-            result = {}
-
-            for row in res:
-                guild_id, user_id, alias_id = row
-
-                if guild_id not in result:
-                    result[guild_id] = {}
-
-                if user_id not in result[guild_id]:
-                    result[guild_id][user_id] = []
-
-                result[guild_id][user_id].append(alias_id)
-
-            # make sure all the ids are ints
-            result = {
-                int(guild_id): {
-                    int(user_id): [int(alias_id) for alias_id in alias_ids]
-                    for user_id, alias_ids in user_ids.items()
-                }
-                for guild_id, user_ids in result.items()
+            return {
+                guild_id_: {user_id: list(alias_ids) for user_id, alias_ids in users.items()}
+                for guild_id_, users in self._aliases.items() if users
             }
 
-            return result
-
-        else:
-            async with self.con.acquire() as conn:
-                async with conn.cursor() as cur:
-                    await cur.execute(
-                        "SELECT data2, data3 FROM `config` WHERE _key = 'alias' AND data1 = %s;",
-                        (guild_id,),
-                    )
-
-                    # data2 is user_id, data3 is alias_id
-
-                    res = await cur.fetchall()
-
-            # convert into this format -
-            # {
-            #   user_id: [alias_id, alias_id, ...],
-            #   user_id: [alias_id, alias_id, ...], ...
-            # }
-
-            res = {
-                int(user_id): [int(alias_id) for _, alias_id in res if _ == user_id]
-                for user_id, _ in res
-            }
-
-            return res
+        # format -
+        # {
+        #   user_id: [alias_id, alias_id, ...],
+        #   user_id: [alias_id, alias_id, ...], ...
+        # }
+        return {user_id: list(alias_ids) for user_id, alias_ids in self._aliases.get(guild_id, {}).items()}
 
     async def set_timezone(self, guild_id: int, timezone: int):
         # timezone here is an offset from UTC
-
-        if await self.execute(
-                f"SELECT data2 FROM `config` WHERE _key = 'timezone' AND data1 = '%s';",
-                (guild_id,), fetch="one"
-        ) is None:
-            await self.execute(
-                "INSERT INTO `config` (_key, data1, data2) VALUES ('timezone', %s, %s);",
-                (guild_id, timezone),
-            )
-            return
-
         await self.execute(
-            "UPDATE `config` SET data2 = %s WHERE _key = 'timezone' AND data1 = %s;",
-            (timezone, guild_id),
+            "INSERT INTO guild_settings (guild_id, timezone) VALUES (%s, %s) "
+            f"{self.dialect.on_conflict(('guild_id',), replace=('timezone',))};",
+            (guild_id, timezone),
         )
 
-    async def get_timezone(self, guild_id: int):
-        res = await self.execute(f"SELECT data2 FROM `config` WHERE _key = 'timezone' AND data1 = '%s';",
-            (guild_id,), fetch="one")
-
-        if res is None:
-            return None
+        self._timezones[guild_id] = int(timezone)
 
-        return res[0]
+    async def get_timezone(self, guild_id: int):
+        await self._ensure_config()
+        return self._timezones.get(guild_id)
 
 
     # analysis functions
     async def get_message_count(
-            self, guild_id: int, channel_id: int = None, user_id: int = None
+            self, guild_id: int, channel_id: int = None, user_id: int = None, message_filter: MessageFilter = None
     ):
-        if guild_id is None:
-            raise ValueError("guild_id cannot be None")
-
-        async with self.con.acquire() as conn:
-            async with conn.cursor() as cur:
-                if channel_id is None and user_id is None:
-                    await cur.execute(
-                        f"SELECT COUNT(*) FROM `{guild_id}`",
-                    )
-                elif channel_id is not None and user_id is None:
-                    await cur.execute(
-                        f"SELECT COUNT(*) FROM `{guild_id}` WHERE channel_id = %s;",
-                        (channel_id,),
-                    )
-                elif channel_id is None and user_id is not None:
-                    await cur.execute(
-                        f"SELECT COUNT(*) FROM `{guild_id}` WHERE author_id = %s;",
-                        (user_id,),
-                    )
-                else:
-                    await cur.execute(
-                        f"SELECT COUNT(*) FROM `{guild_id}` WHERE channel_id = %s AND author_id = %s;",
-                        (channel_id, user_id),
-                    )
-                
-                return (await cur.fetchone())[0]
+        """Returns the number of messages in a guild, optionally only those matching `message_filter`."""
+        message_filter = message_filter or MessageFilter(guild_id, channel_ids=channel_id, user_ids=user_id)
+        where, args = message_filter.compile()
 
+        res = await self.execute(f"SELECT COUNT(*) FROM {self.table(guild_id)} {where};", args, fetch="one")
+        return res[0]
 
-    
     async def get_mentions(self, guild_id: int, user_id: int) -> list[int]:
         """Returns all the instances where mentions are not empty, where user_id;"""
         if user_id is not None:
-            async with self.con.acquire() as conn:
+            async with self._acquire() as conn:
                 async with conn.cursor() as cur:
                     await cur.execute(
-                        f"SELECT mentions FROM `{guild_id}` WHERE author_id = %s AND mentions IS NOT NULL;",
+                        f"SELECT mentions FROM {self.table(guild_id)} WHERE author_id = %s AND mentions IS NOT NULL;",
                         (user_id,),
                     )
 
@@ -516,10 +1263,10 @@ class DB:
 
     async def get_all_mentions(self, guild_id: int) -> list[int, list[int]]:
         """Returns all the instances where mentions are not empty along with whom the messages belong to"""
-        async with self.con.acquire() as conn:
+        async with self._acquire() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(
-                    f"SELECT author_id, mentions FROM `{guild_id}` WHERE mentions IS NOT NULL;",
+                    f"SELECT author_id, mentions FROM {self.table(guild_id)} WHERE mentions IS NOT NULL;",
                 )
 
                 res = await cur.fetchall()
@@ -533,32 +1280,25 @@ class DB:
 
         return data
 
-    async def get_message_content(self, guild_id: int, channel_id: int = None, user_id: int = None) -> list[str]:
-        async with self.con.acquire() as conn:
-            async with conn.cursor() as cur:
+    async def iter_message_content(
+            self, guild_id: int, channel_id: int = None, user_id: int = None, batch_size: int = 10000,
+            message_filter: MessageFilter = None
+    ):
+        """Yields the (decoded) message content in lists of at most `batch_size` messages."""
+        message_filter = message_filter or MessageFilter(guild_id, channel_ids=channel_id, user_ids=user_id)
+        where, args = message_filter.replace(non_empty=True).compile()
 
-                if channel_id is None and user_id is None:
-                    await cur.execute(
-                        f"SELECT message_content FROM `{guild_id}` WHERE message_content IS NOT NULL;",
-                    )
-                elif channel_id is not None and user_id is None:
-                    await cur.execute(
-                        f"SELECT message_content FROM `{guild_id}` WHERE channel_id = %s AND message_content IS NOT "
-                        f"NULL;",
-                        (channel_id,),
-                    )
-                elif channel_id is None and user_id is not None:
-                    await cur.execute(
-                        f"SELECT message_content FROM `{guild_id}` WHERE author_id = %s AND message_content IS NOT NULL;",
-                        (user_id,),
-                    )
-                else:
-                    await cur.execute(
-                        f"SELECT message_content FROM `{guild_id}` WHERE channel_id = %s AND author_id = %s AND "
-                        f"message_content IS NOT NULL;",
-                        (channel_id, user_id),
-                    )
+        query = f"SELECT message_content FROM {self.table(guild_id)} {where}"
 
-                res = await cur.fetchall()
+        async for rows in self.iterate(query, args, batch_size=batch_size):
+            yield [message_content.decode("utf-8") for message_content, in rows]
+
+    async def get_message_content(
+            self, guild_id: int, channel_id: int = None, user_id: int = None, message_filter: MessageFilter = None
+    ) -> list[str]:
+        message_filter = message_filter or MessageFilter(guild_id, channel_ids=channel_id, user_ids=user_id)
+        where, args = message_filter.replace(non_empty=True).compile()
+
+        res = await self.execute(f"SELECT message_content FROM {self.table(guild_id)} {where};", args, fetch="all")
 
         return [(message_content[0]).decode("utf-8") for message_content in res]
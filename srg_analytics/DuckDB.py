@@ -0,0 +1,160 @@
+"""Embedded DuckDB storage backend, for running the analytics without a MySQL server."""
+
+import asyncio
+import contextlib
+
+from .DB import DB
+from .dialect import DuckDBDialect
+
+
+class _DuckDBCursor:
+    """The subset of the aiomysql cursor interface used by DB, on top of a DuckDB connection."""
+
+    def __init__(self, connection: "_DuckDBConnection"):
+        self._connection = connection
+        self._result = None
+        self.rowcount = -1
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    @staticmethod
+    def _translate(query: str, args):
+        # same as pymysql, the query is only formatted when there are args
+        if args is None:
+            return query, None
+        return query.replace("%s", "?").replace("%%", "%"), tuple(args)
+
+    def _execute(self, query: str, args):
+        self._result = self._connection.con.execute(query, args)
+
+        # DuckDB returns the number of affected rows as the result of a DML statement
+        if query.lstrip().split(None, 1)[0].upper() in ("INSERT", "UPDATE", "DELETE"):
+            self.rowcount = self._result.fetchone()[0]
+            self._result = None
+        else:
+            self.rowcount = -1
+
+    async def execute(self, query: str, args=None):
+        query, args = self._translate(query, args)
+        await asyncio.to_thread(self._execute, query, args)
+
+    async def executemany(self, query: str, args):
+        if not args:
+            return
+
+        def run():
+            rowcount = 0
+            for args_ in args:
+                self._execute(*self._translate(query, args_))
+                rowcount += max(self.rowcount, 0)
+            self.rowcount = rowcount
+
+        await asyncio.to_thread(run)
+
+    async def fetchone(self):
+        return await asyncio.to_thread(self._result.fetchone)
+
+    async def fetchall(self):
+        return await asyncio.to_thread(self._result.fetchall)
+
+    async def fetchmany(self, size: int):
+        return await asyncio.to_thread(self._result.fetchmany, size)
+
+    async def close(self):
+        self._result = None
+
+
+class _DuckDBConnection:
+    def __init__(self, con):
+        self.con = con
+        self._in_transaction = False
+
+    def cursor(self, cursor_class=None) -> _DuckDBCursor:
+        # DuckDB results are always streamed, so there is no separate unbuffered cursor
+        return _DuckDBCursor(self)
+
+    async def begin(self):
+        await asyncio.to_thread(self.con.execute, "BEGIN TRANSACTION")
+        self._in_transaction = True
+
+    async def commit(self):
+        if self._in_transaction:
+            self._in_transaction = False
+            await asyncio.to_thread(self.con.execute, "COMMIT")
+
+    async def rollback(self):
+        if self._in_transaction:
+            self._in_transaction = False
+            await asyncio.to_thread(self.con.execute, "ROLLBACK")
+
+
+class _DuckDBPool:
+    """Hands out up to `maxsize` connections to one DuckDB database, in the shape of an aiomysql pool."""
+
+    def __init__(self, database, maxsize: int):
+        self._database = database
+        self._semaphore = asyncio.Semaphore(maxsize)
+
+        self.minsize = 0
+        self.maxsize = maxsize
+        self.size = maxsize
+        self.freesize = maxsize
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        async with self._semaphore:
+            con = self._database.cursor()
+            self.freesize -= 1
+
+            try:
+                yield _DuckDBConnection(con)
+            finally:
+                self.freesize += 1
+                con.close()
+
+    def close(self):
+        self._database.close()
+
+    async def wait_closed(self):
+        pass
+
+
+class DuckDB(DB):
+    """DB stored in an embedded DuckDB database file, for offline reporting on a snapshot, or CI.
+
+    It has the same methods as DB, and the analysis functions accept it in place of one. Requires the duckdb package.
+    `maxsize` connections can be used at once; DuckDB aborts transactions that write the same rows concurrently, so
+    keep it at 1 unless the database is only being read.
+    """
+
+    dialect = DuckDBDialect()
+
+    def __init__(self, path: str = ":memory:", maxsize: int = 1, minsize: int = 0, pool_recycle: int = -1):
+        # minsize and pool_recycle are accepted like DB's, but have no meaning for an embedded database
+        super().__init__(None, minsize=0, maxsize=maxsize)
+        self.path = path
+
+    @classmethod
+    async def create(cls, path: str = ":memory:", maxsize: int = 1, minsize: int = 0,
+                     pool_recycle: int = -1) -> "DuckDB":
+        """Creates a DuckDB and connects it, see DB.create."""
+        db = cls(path, maxsize=maxsize)
+        await db.connect()
+        return db
+
+    async def _create_pool(self):
+        import duckdb
+
+        return _DuckDBPool(duckdb.connect(self.path), self.maxsize)
+
+    async def migrate_indexes(self, guild_ids: list[int] = None, delay: float = 0) -> dict[int, list[str]]:
+        # no secondary indexes are used on DuckDB, see DuckDBDialect.create_table
+        return {}
+
+    async def migrate_config(self) -> dict[str, int]:
+        # DuckDB databases never had the legacy config table
+        return {}
@@ -1,10 +1,22 @@
 from .activity import *
+from .buckets import *
+from .series_cache import *
 from .DB import *
+from .DuckDB import *
+from .executor import *
+from .transport import *
+from .filters import *
 from .helpers import *
 from .schemas import *
+from .tokenizer import *
+from .token_index import *
+from .postings import *
+from .emojis import *
+from .sketch import *
 from .wordcloud import *
 from .top import *
 from .profile import *
 from .export import *
+from .ingest import *
 from .profile import build_profile
 from .leaderboard import *
\ No newline at end of file
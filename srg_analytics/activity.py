@@ -1,264 +1,131 @@
-import random
-from typing import Any
 import calendar
-from .DB import DB
-import mplcyberpunk
 import datetime
-from dateutil.relativedelta import relativedelta
-import matplotlib.pyplot as plt
-
-
-
-_days = {
-    # format - timeperiod: (days, number of data points)
-    '1d': (1, 24),
-    '3d': (3, 3),
-    '5d': (5, 5),
-    '1w': (7, 7),
-    '2w': (14, 14),
-    '1m': (30, 30),
-    '3m': (90, 3),
-    '6m': (180, 6),
-    '9m': (270, 9),
-    '1y': (365, 12),
-    '2y': (730, 24),
-    '3y': (1095, 36),
-    '5y': (1825, 5),
-    'all': (lambda:  [(datetime.date(2015, 4, 1) - datetime.date.today()).days, datetime.date.today().year - 2015])()
-}
-
-
-async def _generate_timeperiod(time_period, timezone: datetime.timezone = None):
-    # If there is no time zone, set it to UTC+3
-    if timezone is None:
-        timezone = datetime.timezone(datetime.timedelta(hours=3))
-
-    now = datetime.datetime.now(timezone)
-
-    # Define the time periods and intervals
-    periods = {
-        # todo this will take days=30 for some reason when if it's set to anything else in 3m and above when format is %d-%m
-        '1d': (now.replace(hour=0, minute=0, second=0, microsecond=0), '%H'),
-        '5d': (now - datetime.timedelta(days=_days['5d'][0]), '%d-%m-%Y'),
-        '1w': (now - datetime.timedelta(days=_days['1w'][0]), '%d-%m-%Y'),
-        '2w': (now - datetime.timedelta(days=_days['2w'][0]), '%d-%m-%Y'),
-        '1m': (now - datetime.timedelta(days=_days['1m'][0]), '%d-%m-%Y'),
-        '3m': (now - datetime.timedelta(days=_days['3m'][0]), '%m-%Y'),
-        '6m': (now - datetime.timedelta(days=_days['6m'][0]), '%m-%Y'),
-        '9m': (now - datetime.timedelta(days=_days['9m'][0]), '%m-%Y'),
-        '1y': (now - datetime.timedelta(days=_days['1y'][0]), '%m-%Y'),
-        '2y': (now - datetime.timedelta(days=_days['2y'][0]), '%m-%Y'),
-        '3y': (now - datetime.timedelta(days=_days['3y'][0]), '%m-%Y'),
-        '5y': (now - datetime.timedelta(days=_days['5y'][0]), '%Y'),
-        'all': (datetime.datetime(2015, 4, 1, tzinfo=timezone), '%Y')
-    }
-
-    try:
-        start_time, label_format = periods.get(time_period)
-    except TypeError:
-        raise ValueError(f"Invalid time period: {time_period}")
-
-    return now, start_time, label_format
-
-
-async def _structure_data(data, start_time, time_period, label_format, timezone: datetime.timezone = None):
-    # Group the data by the specified interval (hourly, daily, etc.)
-    grouped_data = {}
-    for row in data:
-        group_key = row[0]
-        grouped_data.setdefault(group_key, 0)
-        grouped_data[group_key] += row[1]
-
-    # Fill in missing data points with 0
-    for i in range(_days[time_period][1]):
-        if time_period == '1d':
-            key = (start_time + datetime.timedelta(hours=i)).strftime(label_format)
-        else:
-            key = (start_time + datetime.timedelta(days=i)).strftime(label_format)
-
-        grouped_data.setdefault(key, 0)
-
-    # Sort the data by date
-    sorted_data = sorted(grouped_data.items(), key=lambda x: datetime.datetime.strptime(x[0], label_format))
-
-    # Split the data into x and y values
-    x = [row[0] for row in sorted_data]
-    y = [row[1] for row in sorted_data]
-
-    # if there are extra values, pop the start values to make length == time_period
-    if time_period != "all":
-        if len(y) > _days[time_period][1]:
-            y = y[len(y) - (_days[time_period][1]):]
-            x = x[len(x) - (_days[time_period][1]):]
-
-    return x, y
-
-
-async def _get_number_of_dates_in_range(start_date, end_date):
-    dates = 0
-    delta = datetime.timedelta(days=1)
-
-    while start_date <= end_date:
-        dates += 1
-        start_date += delta
-
-    return dates  # inclusive of starting and ending date
-
-
-async def _get_number_of_months_in_range(start_date, end_date):
-    months = 0
-    delta = relativedelta(months=1)
-
-    while start_date <= end_date:
-        months += 1
-        start_date += delta
-
-    return months  # inclusive of starting and ending month
-
-
-async def _structure_daterange(data, start_date, end_date, date_format, timezone):
-    # data = {'date': value, ...}
+import functools
+import random
+import time
 
-    if date_format == '%d-%m-%Y':
-        # Fill in all missing dates between start_date and end_date
-        dates = await _get_number_of_dates_in_range(start_date, end_date)
-        grouped_data = {}
+import mplcyberpunk
+import matplotlib.pyplot as plt
+import numpy as np
 
-        for row in data:
-            group_key = row[0]
-            grouped_data.setdefault(group_key, 0)
-            grouped_data[group_key] += row[1]
+from .buckets import DEFAULT_TIMEZONE, HOUR, TimeBuckets
+from .DB import DB
+from .filters import MessageFilter
+from .rollup import ROLLUP_TABLE
 
-        # Fill in missing data points with 0
-        for i in range(dates):
-            key = (start_date + datetime.timedelta(days=i))
-            if key.date() > end_date.date():
-                break
 
-            key = key.strftime(date_format)
-            grouped_data.setdefault(key, 0)
+def _time_buckets(timeperiod_or_daterange: str | tuple | list, timezone: datetime.timezone = None) -> TimeBuckets:
+    if type(timeperiod_or_daterange) in [tuple, list]:
+        # A daterange has been passed
+        # Format - ("dd-mm-yyyy", "dd-mm-yyyy") or ("mm-yyyy", "mm-yyyy")
+        #             start         end
+        return TimeBuckets.for_range(timeperiod_or_daterange, timezone)
 
-        # Sort the data by date
-        sorted_data = sorted(grouped_data.items(), key=lambda x: datetime.datetime.strptime(x[0], date_format))
+    return TimeBuckets.for_period(timeperiod_or_daterange, timezone)
 
-        _last_sorted_date = datetime.datetime.strptime(sorted_data[-1][0], date_format)
-        if _last_sorted_date.date() != end_date.date():
-            sorted_data.pop()
 
-        # Split the data into x and y values
-        x = [row[0] for row in sorted_data]
-        y = [row[1] for row in sorted_data]
+def _count_source(db: DB, message_filter: MessageFilter, offset: int) -> tuple[str, tuple, str, str, str, str]:
+    """The where clause, args, table, epoch column, message count and author of counting the messages matching a
+    filter in a timezone of UTC offset `offset`. The rollups are used, unless their UTC hours do not line up with the
+    timezone (e.g. UTC+5:30) or the filter is non_empty, which they cannot tell apart."""
+    if offset % HOUR == 0 and not message_filter.non_empty:
+        where, args = message_filter.compile_rollup()
+        author = "aliased_author_id" if message_filter.aliased else "author_id"
+        return where, args, ROLLUP_TABLE, "hour_bucket", "SUM(message_count)", author
 
-        return x, y
+    where, args = message_filter.compile()
+    author = "COALESCE(aliased_author_id, author_id)" if message_filter.aliased else "author_id"
+    return where, args, db.table(message_filter.guild_id), "epoch", "COUNT(*)", author
 
-    elif date_format == '%m-%Y':
-        _last_day = (calendar.monthrange(end_date.year, end_date.month))[1]
-        end_date = datetime.date(end_date.year, end_date.month, _last_day)
-        end_date = datetime.datetime.combine(end_date, datetime.time.max)
 
-        # Get all months between start_date and end_date
-        months = await _get_number_of_months_in_range(start_date, end_date)
-        print(months)
-        grouped_data = {}
+async def _activity_counts(db: DB, message_filter: MessageFilter, buckets: TimeBuckets,
+                           by_user: bool = False) -> list[tuple]:
+    """Returns the message counts matching a filter per bucket (see TimeBuckets.sql), or per user (aliased if the
+    filter is) and bucket with by_user. Served from the rollups when they line up with the buckets, see
+    _count_source."""
+    where, args, table, column, count, author = _count_source(db, message_filter, buckets.offset)
 
-        for row in data:
-            group_key = row[0]
-            grouped_data.setdefault(group_key, 0)
-            grouped_data[group_key] += row[1]
+    group_by = "author, bucket" if by_user else "bucket"
 
-        # Fill in missing data points with 0
-        for i in range(months):
-            key = start_date + relativedelta(months=1)
-            if key.date() > end_date.date():
-                break
+    query = f"""
+        SELECT 
+            {f"{author} AS author," if by_user else ""}
+            {buckets.sql(db.dialect, column)} AS bucket, 
+            CAST({count} AS {db.dialect.int_type}) AS count 
+        FROM 
+            {table} 
+        {where} 
+        GROUP BY 
+            {group_by}
+    """
 
-            key = key.strftime(date_format)
-            grouped_data.setdefault(key, 0)
+    return await db.execute(query, args, fetch="all")
 
-        # Sort the data by date
-        sorted_data = sorted(grouped_data.items(), key=lambda x: datetime.datetime.strptime(x[0], date_format))
 
-        _last_sorted_date = datetime.datetime.strptime(sorted_data[-1][0], date_format)
-        # if _last_sorted_date.date() != end_date.date():
-        #     sorted_data.pop()
+async def _cached_activity_counts(db: DB, message_filter: MessageFilter, buckets: TimeBuckets,
+                                  by_user: bool = False) -> list[tuple]:
+    """_activity_counts over the time window of the buckets, with the closed buckets served from db.series_cache.
 
-        # Split the data into x and y values
-        x = [row[0] for row in sorted_data]
-        y = [row[1] for row in sorted_data]
+    Only the buckets from the first one that is not cached onwards are queried, usually just the current one.
+    """
+    cache = db.series_cache
+    key = cache.key(message_filter, buckets, by_user)
+    bucket_column = 1 if by_user else 0
 
-        return x, y
+    # the SQL buckets of the window, and the first one that is still open
+    first = (buckets.since + buckets.offset) // buckets.seconds
+    last = (buckets.until + buckets.offset) // buckets.seconds
+    current = (int(time.time()) + buckets.offset) // buckets.seconds
 
+    cached, missing = cache.get(key, range(first, min(last, current - 1) + 1))
+    start = missing[0] if missing else max(first, current)
 
-async def activity_guild(db, guild_id, timeperiod_or_daterange: str | tuple | list, timezone: datetime.timezone = None):
-    if type(timeperiod_or_daterange) in [tuple, list]:
-        date_range = timeperiod_or_daterange
-        # A daterange has been passed 
-        # Format - ("dd-mm-yyyy", "dd-mm-yyyy")
-        #             start         end
+    served = [bucket_rows for bucket, bucket_rows in cached.items() if bucket < start]
+    rows = [row for bucket_rows in served for row in bucket_rows]
+    cache.count(hits=len(served))
 
-        if len(date_range[0].split("-")) == 3:
-            date_format = '%d-%m-%Y'
-            end_time = datetime.datetime.strptime(date_range[1], date_format)
-        else:
-            date_format = '%m-%Y'
-            end_time = datetime.datetime.strptime(date_range[1], date_format) + relativedelta(months=1) - relativedelta(days=1) # todo check if works as intended
+    if start > last:
+        return rows
 
-        start_time = datetime.datetime.strptime(date_range[0], date_format)
-        end_time = datetime.datetime.combine(end_time, datetime.time.max)
+    generation = cache.generation(message_filter.guild_id)
+    queried = await _activity_counts(
+        db, message_filter.replace(since=start * buckets.seconds - buckets.offset), buckets, by_user
+    )
+    rows += queried
 
-        print(end_time)
-        # end_time = datetime.datetime.combine(end_time, datetime.time.max)
-        # print(end_time)
-        print(end_time.timestamp())
+    closed = range(start, min(last, current - 1) + 1)
+    cache.count(misses=len(closed), open_=last - start + 1 - len(closed))
 
-        query_template = f"""
-        SELECT 
-            DATE_FORMAT(FROM_UNIXTIME(epoch), %s) AS datetime, 
-            COUNT(*) AS count 
-        FROM 
-            `{guild_id}` 
-        WHERE 
-            epoch >= %s AND epoch <= %s 
-        GROUP BY 
-            datetime
-        """
+    if closed:
+        rows_by_bucket = {bucket: [] for bucket in closed}
+        for row in queried:
+            if row[bucket_column] in rows_by_bucket:
+                rows_by_bucket[row[bucket_column]].append(tuple(row))
 
-        # Define the query parameters
-        query_params = (date_format.replace("%M", "%i"), start_time.timestamp(), end_time.timestamp())
+        cache.put(key, generation, rows_by_bucket)
 
-        # Execute the SQL query
-        data = await db.execute(query_template, query_params, fetch="all")
+    return rows
 
-        # Structure the data
-        x_labels, y_values = await _structure_daterange(data, start_time, end_time, date_format, timezone)
 
-    elif type(timeperiod_or_daterange) is str:
-        time_period = timeperiod_or_daterange
-        now, start_time, date_format = await _generate_timeperiod(time_period, timezone)
+async def _activity_series(count, message_filter: MessageFilter, timeperiod_or_daterange: str | tuple | list,
+                           timezone: datetime.timezone = None) -> tuple[list[str], np.ndarray]:
+    """Buckets the counts of the messages matching a filter over a time period or date range, returning the labels
+    and values of the graph. count(message_filter, buckets) returns the (SQL bucket, count) rows."""
+    buckets = _time_buckets(timeperiod_or_daterange, timezone)
+    rows = await count(message_filter.replace(since=buckets.since, until=buckets.until), buckets)
 
-        # Define the SQL query template
-        query_template = f"""
-            SELECT 
-                DATE_FORMAT(FROM_UNIXTIME(epoch), %s) AS datetime, 
-                COUNT(*) AS count 
-            FROM 
-                `{guild_id}` 
-            WHERE 
-                epoch >= %s AND epoch <= UNIX_TIMESTAMP() 
-            GROUP BY 
-                datetime
-        """
+    return buckets.labels(), buckets.counts(rows)
 
-        # Define the query parameters
-        query_params = (date_format.replace("%M", "%i"), start_time.timestamp(),)
 
-        # Execute the SQL query
-        data = await db.execute(query_template, query_params, fetch="all")
+async def activity_guild(db, guild_id, timeperiod_or_daterange: str | tuple | list, timezone: datetime.timezone = None,
+                         message_filter: MessageFilter = None) -> tuple[list[str], np.ndarray]:
+    """Returns the labels of the hours, days, months or years of a time period (see buckets.PERIODS) or date range,
+    and the number of messages sent in each of them, in the timezone (UTC+3 by default)."""
+    message_filter = message_filter or MessageFilter(guild_id)
 
-        # Structure the data
-        x_labels, y_values = await _structure_data(data, start_time, time_period, date_format, timezone)
-
-    return x_labels, y_values
+    return await _activity_series(
+        functools.partial(_cached_activity_counts, db), message_filter, timeperiod_or_daterange, timezone
+    )
 
 
 async def activity_guild_visual(db: DB, guild_id: int, timeperiod_or_daterange: list | tuple | str,
@@ -298,102 +165,36 @@ async def activity_guild_visual(db: DB, guild_id: int, timeperiod_or_daterange:
 
 
 async def activity_user(
-        db: DB, guild_id: int, user_list: list[int], timeperiod_or_daterange: str | tuple | list, timezone: datetime.timezone = None
-) -> tuple[tuple[Any, ...] | None, dict[int, list[Any]]]:
+        db: DB, guild_id: int, user_list: list[int], timeperiod_or_daterange: str | tuple | list, timezone: datetime.timezone = None,
+        message_filter: MessageFilter = None, aliased: bool = False
+) -> tuple[tuple[str, ...], dict[int, np.ndarray]]:
+    """Returns the labels of the buckets of a time period or date range (see activity_guild), and the number of messages
+    every user sent in each of them, as user_id: counts. The counts are the rows of one users x buckets matrix.
+
+    All the users are counted in one query. With aliased, the messages of a user's alts are counted as theirs, like in
+    the leaderboards.
+    """
     # user_list is a list of user ids
+    user_ids = list(dict.fromkeys(user_list))
+    message_filter = (message_filter or MessageFilter(guild_id)).replace(user_ids=user_ids, aliased=aliased)
 
-    x_labels = None
-    y_values = {}
-
-    if type(timeperiod_or_daterange) in [tuple, list]:
-        date_range = timeperiod_or_daterange
-        # A daterange has been passed
-        # Format - ("dd-mm-yyyy", "dd-mm-yyyy")
-        #             start         end
+    buckets = _time_buckets(timeperiod_or_daterange, timezone)
+    rows = await _cached_activity_counts(
+        db, message_filter.replace(since=buckets.since, until=buckets.until), buckets, by_user=True
+    )
+    matrix = buckets.matrix(rows, user_ids)
 
-        if len(date_range[0].split("-")) == 3:
-            date_format = '%d-%m-%Y'
-        else:
-            date_format = '%m-%Y'
-
-        start_time = datetime.datetime.strptime(date_range[0], date_format)
-        end_time = datetime.datetime.strptime(date_range[1], date_format)
-        end_time = datetime.datetime.combine(end_time, datetime.time.max)
-
-        for user_id in user_list:
-            query_template = f"""
-                    SELECT 
-                        DATE_FORMAT(FROM_UNIXTIME(epoch), %s) AS datetime, 
-                        COUNT(*) AS count 
-                    FROM 
-                        `{guild_id}` 
-                    WHERE 
-                        epoch >= %s AND epoch <= %s 
-                    AND author_id = %s
-                    GROUP BY 
-                        datetime
-                    """
-
-            # Define the query parameters
-            query_params = (date_format.replace("%M", "%i"), start_time.timestamp(), end_time.timestamp(), user_id)
-
-            # Execute the SQL query
-            data = await db.execute(query_template, query_params, fetch="all")
-
-            # Structure the data
-            x, y = await _structure_daterange(data, start_time, end_time, date_format, timezone)
-
-            # Add the data to the graph
-            if x_labels is None:
-                x_labels = tuple(x)
-            y_values[user_id] = y
-
-    elif type(timeperiod_or_daterange) is str:
-        # A timeperiod has been passed
-        time_period = timeperiod_or_daterange
-
-        now, start_time, label_format = await _generate_timeperiod(time_period, timezone)
-
-        for user_id in user_list:
-
-            # Define the SQL query template
-            query_template = f"""
-                SELECT 
-                    DATE_FORMAT(FROM_UNIXTIME(epoch), %s) AS datetime, 
-                    COUNT(*) AS count
-                FROM 
-                    `{guild_id}`
-                WHERE
-                    epoch >= %s AND epoch <= UNIX_TIMESTAMP() 
-                    AND author_id = %s
-                GROUP BY
-                    datetime
-            """
-
-            # Define the query parameters
-            query_params = (label_format.replace("%M", "%i"), start_time.timestamp(), user_id,)
-
-            # Execute the SQL query
-            data = await db.execute(query_template, query_params, fetch="all")
-
-            # Structure the data
-            x, y = await _structure_data(data, start_time, time_period, label_format, timezone)
-
-            # Add the data to the graph
-            if x_labels is None:
-                x_labels = tuple(x)
-            y_values[user_id] = y
-
-    return x_labels, y_values
+    return tuple(buckets.labels()), dict(zip(user_ids, matrix))
 
 
 async def activity_user_visual(
-        db: DB, guild_id: int, user_list: list, timeperiod_or_daterange: list | tuple | str, timezone: datetime.timezone = None
+        db: DB, guild_id: int, user_list: list, timeperiod_or_daterange: list | tuple | str, timezone: datetime.timezone = None,
+        aliased: bool = False
 ):
     usernames = [user[0] for user in user_list]
     user_ids = [user[1] for user in user_list]
 
-    x, y = await activity_user(db, guild_id, user_ids, timeperiod_or_daterange, timezone)
+    x, y = await activity_user(db, guild_id, user_ids, timeperiod_or_daterange, timezone, aliased=aliased)
     plt.style.use("cyberpunk")
 
     try:
@@ -425,3 +226,87 @@ async def activity_user_visual(
         print(e)
         plt.close()
         return None
+
+
+# 1970-01-01 was a Thursday, the 4th day of a week starting on Monday
+_EPOCH_WEEK_HOUR = 3 * 24
+
+
+async def activity_heatmap(db: DB, guild_id: int, user_id: int = None, channel_id: int = None,
+                           timezone: datetime.timezone = None, message_filter: MessageFilter = None) -> np.ndarray:
+    """Returns the number of messages sent in every hour of the week, as a 7 x 24 array of days (Monday first) by
+    hours of the day, in the timezone (UTC+3 by default).
+
+    Counted in one query grouped by the hour of the week, from the rollups when the timezone lines up with them.
+    """
+    message_filter = message_filter or MessageFilter(guild_id)
+    if user_id is not None:
+        message_filter = message_filter.replace(user_ids=user_id)
+    if channel_id is not None:
+        message_filter = message_filter.replace(channel_ids=channel_id)
+
+    timezone = timezone or DEFAULT_TIMEZONE
+    offset = int(datetime.datetime.now(timezone).utcoffset().total_seconds())
+
+    where, args, table, column, count, _ = _count_source(db, message_filter, offset)
+    week_hour = f"MOD({db.dialect.intdiv(f'{column} + {offset}', HOUR)} + {_EPOCH_WEEK_HOUR}, {7 * 24})"
+
+    query = f"""
+        SELECT 
+            {week_hour} AS week_hour, 
+            CAST({count} AS {db.dialect.int_type}) AS count 
+        FROM 
+            {table} 
+        {where} 
+        GROUP BY 
+            week_hour
+    """
+
+    heatmap = np.zeros(7 * 24, dtype=np.int64)
+    rows = await db.execute(query, args, fetch="all")
+    if rows:
+        week_hours, values = np.array(rows, dtype=np.int64).T
+        heatmap[week_hours] = values
+
+    return heatmap.reshape(7, 24)
+
+
+def most_active_hour_and_day(heatmap: np.ndarray) -> tuple[int | None, str | None]:
+    """The hour of the day (0-23) and the day of the week (e.g. "Monday") with the most messages of a heatmap, or None
+    if it is empty."""
+    if not heatmap.any():
+        return None, None
+
+    return int(heatmap.sum(axis=0).argmax()), calendar.day_name[int(heatmap.sum(axis=1).argmax())]
+
+
+async def activity_heatmap_visual(db: DB, guild_id: int, user_id: int = None, channel_id: int = None,
+                                  timezone: datetime.timezone = None):
+    heatmap = await activity_heatmap(db, guild_id, user_id, channel_id, timezone)
+    plt.style.use("cyberpunk")
+
+    try:
+        fig, ax = plt.subplots(figsize=(12, 4))
+        image = ax.imshow(heatmap, aspect="auto", cmap="magma")
+
+        # Add labels and title
+        ax.set_xticks(range(24), [f"{hour:02}" for hour in range(24)])
+        ax.set_yticks(range(7), calendar.day_abbr)
+        ax.set_xlabel("Hour")
+        ax.set_title("Activity Heatmap")
+
+        fig.colorbar(image, ax=ax, label="Message Count")
+        ax.grid(False)
+        plt.tight_layout()
+
+        name = random.randint(1, 100000000)
+        plt.savefig(f"{name}.png", format='png', dpi=400, bbox_inches="tight")
+        plt.close()
+
+        return f"{name}.png"
+
+    except Exception as e:
+        print(e)
+        plt.close()
+
+        return None
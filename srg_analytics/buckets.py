@@ -0,0 +1,185 @@
+"""Time bucketing of epochs with integer arithmetic - in SQL, as (epoch + offset) DIV size, and in Python with NumPy."""
+
+import datetime
+
+import numpy as np
+from dateutil.relativedelta import relativedelta
+
+HOUR = 3600
+DAY = 86400
+
+# timezone of the time periods and date ranges when none is passed
+DEFAULT_TIMEZONE = datetime.timezone(datetime.timedelta(hours=3))
+
+# format - unit: (size of the SQL bucket in seconds, label format, length of a bucket)
+# months and years have no fixed length, so they are bucketed by day in SQL and grouped into months/years in NumPy
+_UNITS = {
+    "hour": (HOUR, "%H", relativedelta(hours=1)),
+    "day": (DAY, "%d-%m-%Y", relativedelta(days=1)),
+    "month": (DAY, "%m-%Y", relativedelta(months=1)),
+    "year": (DAY, "%Y", relativedelta(years=1)),
+}
+
+# format - time period: (unit, number of buckets, ending with the current one)
+PERIODS = {
+    "1d": ("hour", 24),
+    "3d": ("day", 3),
+    "5d": ("day", 5),
+    "1w": ("day", 7),
+    "2w": ("day", 14),
+    "1m": ("day", 30),
+    "3m": ("month", 3),
+    "6m": ("month", 6),
+    "9m": ("month", 9),
+    "1y": ("month", 12),
+    "2y": ("month", 24),
+    "3y": ("month", 36),
+    "5y": ("year", 5),
+    "all": ("year", None),  # every year since FIRST_YEAR
+}
+FIRST_YEAR = 2015
+
+
+def _truncate(moment: datetime.datetime, unit: str) -> datetime.datetime:
+    """The start of the unit a moment falls into."""
+    moment = moment.replace(minute=0, second=0, microsecond=0)
+    if unit == "hour":
+        return moment
+
+    moment = moment.replace(hour=0)
+    if unit == "day":
+        return moment
+
+    moment = moment.replace(day=1)
+    if unit == "month":
+        return moment
+
+    return moment.replace(month=1)
+
+
+class TimeBuckets:
+    """`count` consecutive hours, days, months or years, the first one starting at `start`.
+
+    Epochs are bucketed in the timezone of `start`, with its UTC offset at `start` - exact for the fixed offsets of
+    datetime.timezone. sql() buckets a column in the query, and counts() scatters the (bucket, count) rows it is
+    grouped by into a dense array.
+    """
+
+    def __init__(self, unit: str, start: datetime.datetime, count: int):
+        if unit not in _UNITS:
+            raise ValueError(f"unit must be one of {', '.join(_UNITS)}")
+        if start.tzinfo is None:
+            raise ValueError("start must be timezone aware")
+
+        self.unit = unit
+        self.start = _truncate(start, unit)
+        self.count = count
+        self.offset = int(self.start.utcoffset().total_seconds())
+        self.seconds, self.label_format, self.step = _UNITS[unit]
+
+    def __repr__(self):
+        return f"TimeBuckets(unit={self.unit!r}, start={self.start.isoformat()}, count={self.count})"
+
+    @classmethod
+    def for_period(cls, time_period: str, timezone: datetime.tzinfo = None,
+                   now: datetime.datetime = None) -> "TimeBuckets":
+        """The buckets of a time period (see PERIODS), ending with the current one."""
+        try:
+            unit, count = PERIODS[time_period]
+        except KeyError:
+            raise ValueError(f"Invalid time period: {time_period}") from None
+
+        timezone = timezone or DEFAULT_TIMEZONE
+        now = now.astimezone(timezone) if now is not None else datetime.datetime.now(timezone)
+
+        if count is None:
+            count = now.year - FIRST_YEAR + 1
+
+        return cls(unit, _truncate(now, unit) - _UNITS[unit][2] * (count - 1), count)
+
+    @classmethod
+    def for_range(cls, date_range: tuple | list, timezone: datetime.tzinfo = None) -> "TimeBuckets":
+        """The days of a ("dd-mm-yyyy", "dd-mm-yyyy") or the months of a ("mm-yyyy", "mm-yyyy") date range, both ends
+        included."""
+        timezone = timezone or DEFAULT_TIMEZONE
+
+        if len(date_range[0].split("-")) == 3:
+            unit, date_format = "day", "%d-%m-%Y"
+        else:
+            unit, date_format = "month", "%m-%Y"
+
+        first, last = (datetime.datetime.strptime(date, date_format).replace(tzinfo=timezone) for date in date_range)
+
+        if unit == "day":
+            count = (last.date() - first.date()).days + 1
+        else:
+            count = (last.year - first.year) * 12 + last.month - first.month + 1
+
+        if count < 1:
+            raise ValueError("the end of the date range is before its start")
+
+        return cls(unit, first, count)
+
+    @property
+    def end(self) -> datetime.datetime:
+        """The end of the last bucket (exclusive)."""
+        return self.start + self.step * self.count
+
+    @property
+    def since(self) -> int:
+        """The first epoch of the buckets."""
+        return int(self.start.timestamp())
+
+    @property
+    def until(self) -> int:
+        """The last epoch of the buckets."""
+        return int(self.end.timestamp()) - 1
+
+    def sql(self, dialect, column: str) -> str:
+        """The SQL bucket of an epoch column (SQL expression), to group by and pass to counts()."""
+        return dialect.intdiv(f"{column} + {self.offset}", self.seconds)
+
+    def index(self, buckets: np.ndarray) -> np.ndarray:
+        """The index of the bucket of every SQL bucket."""
+        if self.unit in ("hour", "day"):
+            return buckets - (self.since + self.offset) // self.seconds
+
+        # SQL buckets are days (since 1970-01-01 in the timezone), which NumPy turns into months/years since 1970
+        code = "M" if self.unit == "month" else "Y"
+        units = buckets.astype("datetime64[D]").astype(f"datetime64[{code}]").astype(np.int64)
+
+        return units - np.datetime64(self.start.date(), code).astype(np.int64)
+
+    def counts(self, rows) -> np.ndarray:
+        """Scatters (SQL bucket, count) rows into an array of the count of every bucket."""
+        if not rows:
+            return np.zeros(self.count, dtype=np.int64)
+
+        buckets, values = np.array(rows, dtype=np.int64).T
+        indexes = self.index(buckets)
+        inside = (indexes >= 0) & (indexes < self.count)
+
+        return np.bincount(indexes[inside], weights=values[inside], minlength=self.count).astype(np.int64)
+
+    def matrix(self, rows, keys: list[int]) -> np.ndarray:
+        """Scatters (key, SQL bucket, count) rows into a len(keys) x count array, the counts of keys[i] being row i.
+        Rows of other keys are left out."""
+        result = np.zeros((len(keys), self.count), dtype=np.int64)
+        if not rows or not keys:
+            return result
+
+        row_keys, buckets, values = np.array(rows, dtype=np.int64).T
+
+        # the row of every key, by binary search in the sorted keys
+        order = np.argsort(np.array(keys, dtype=np.int64))
+        sorted_keys = np.array(keys, dtype=np.int64)[order]
+        positions = np.searchsorted(sorted_keys, row_keys).clip(max=len(keys) - 1)
+
+        indexes = self.index(buckets)
+        inside = (sorted_keys[positions] == row_keys) & (indexes >= 0) & (indexes < self.count)
+        np.add.at(result, (order[positions][inside], indexes[inside]), values[inside])
+
+        return result
+
+    def labels(self) -> list[str]:
+        return [(self.start + self.step * i).strftime(self.label_format) for i in range(self.count)]
@@ -0,0 +1,113 @@
+"""The parts of the SQL that differ between the database backends."""
+
+
+class Dialect:
+    """Base class of the SQL dialects, see MySQLDialect and DuckDBDialect."""
+
+    int_type: str = None  # integer type to CAST to
+    insert_ignore: str = None  # INSERT that skips rows whose key already exists
+    now: str = None  # the current epoch
+    token_type: str = None  # case and accent sensitive text, for keys made of words, emojis etc.
+    columns_query: str = None  # (table name, column name) of every table in the database
+    for_update: str = None  # appended to a SELECT to lock the rows it reads until the transaction ends
+
+    def quote(self, name) -> str:
+        """Quotes a table name, e.g. a guild table."""
+        raise NotImplementedError
+
+    def intdiv(self, dividend: str, divisor) -> str:
+        """Integer division of two (non-negative) SQL expressions, e.g. to bucket epochs."""
+        raise NotImplementedError
+
+    def start_of_day(self, epoch: str) -> str:
+        """The epoch of the start of the day an epoch (SQL expression) falls into."""
+        raise NotImplementedError
+
+    def on_conflict(self, keys: tuple, replace: tuple = (), add: tuple = ()) -> str:
+        """The clause to append to an INSERT to turn it into an upsert.
+
+        On a conflict on `keys`, the columns in `replace` are set to the inserted values, and the inserted values of
+        the columns in `add` are added onto the existing ones.
+        """
+        raise NotImplementedError
+
+    def create_table(self, name: str, columns: str, primary_key: tuple, indexes: dict = None) -> list[str]:
+        """The statements that create a table (if it does not exist) with its indexes.
+
+        `indexes` is of the format - index name: columns
+        """
+        raise NotImplementedError
+
+    def add_columns(self, name: str, columns: dict) -> list[str]:
+        """The statements that add nullable columns to an existing table.
+
+        `columns` is of the format - column name: type
+        """
+        raise NotImplementedError
+
+
+class MySQLDialect(Dialect):
+    int_type = "SIGNED"
+    insert_ignore = "INSERT IGNORE"
+    now = "UNIX_TIMESTAMP()"
+    token_type = "VARCHAR(191) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin"
+    columns_query = "SELECT TABLE_NAME, COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE();"
+    for_update = "FOR UPDATE"
+
+    def quote(self, name) -> str:
+        return f"`{name}`"
+
+    def intdiv(self, dividend: str, divisor) -> str:
+        return f"({dividend}) DIV {divisor}"
+
+    def start_of_day(self, epoch: str) -> str:
+        return f"UNIX_TIMESTAMP(DATE(FROM_UNIXTIME({epoch})))"
+
+    def on_conflict(self, keys: tuple, replace: tuple = (), add: tuple = ()) -> str:
+        assignments = [f"{column} = VALUES({column})" for column in replace]
+        assignments += [f"{column} = {column} + VALUES({column})" for column in add]
+
+        return f"ON DUPLICATE KEY UPDATE {', '.join(assignments)}"
+
+    def create_table(self, name: str, columns: str, primary_key: tuple, indexes: dict = None) -> list[str]:
+        definitions = [columns, f"PRIMARY KEY ({', '.join(primary_key)})"]
+        definitions += [f"INDEX {index} ({', '.join(columns_)})" for index, columns_ in (indexes or {}).items()]
+
+        return [f"CREATE TABLE IF NOT EXISTS {self.quote(name)} ({', '.join(definitions)});"]
+
+    def add_columns(self, name: str, columns: dict) -> list[str]:
+        # one ALTER for all the columns, so the table is rebuilt at most once
+        definitions = ", ".join(f"ADD COLUMN {column} {type_} NULL" for column, type_ in columns.items())
+        return [f"ALTER TABLE {self.quote(name)} {definitions};"]
+
+
+class DuckDBDialect(Dialect):
+    int_type = "BIGINT"
+    insert_ignore = "INSERT OR IGNORE"
+    now = "CAST(epoch(current_timestamp) AS BIGINT)"
+    token_type = "VARCHAR"
+    columns_query = "SELECT table_name, column_name FROM information_schema.columns WHERE table_schema = current_schema();"
+    # no locking reads; of two transactions writing the same rows, DuckDB aborts the second one instead
+    for_update = ""
+
+    def quote(self, name) -> str:
+        return f'"{name}"'
+
+    def intdiv(self, dividend: str, divisor) -> str:
+        return f"({dividend}) // {divisor}"
+
+    def start_of_day(self, epoch: str) -> str:
+        return f"CAST(epoch(date_trunc('day', make_timestamp(CAST({epoch} AS BIGINT) * 1000000))) AS BIGINT)"
+
+    def on_conflict(self, keys: tuple, replace: tuple = (), add: tuple = ()) -> str:
+        assignments = [f"{column} = EXCLUDED.{column}" for column in replace]
+        assignments += [f"{column} = {column} + EXCLUDED.{column}" for column in add]
+
+        return f"ON CONFLICT ({', '.join(keys)}) DO UPDATE SET {', '.join(assignments)}"
+
+    def create_table(self, name: str, columns: str, primary_key: tuple, indexes: dict = None) -> list[str]:
+        # secondary indexes are left out, the column store's min/max zonemaps already skip most of a scan
+        return [f"CREATE TABLE IF NOT EXISTS {self.quote(name)} ({columns}, PRIMARY KEY ({', '.join(primary_key)}));"]
+
+    def add_columns(self, name: str, columns: dict) -> list[str]:
+        return [f"ALTER TABLE {self.quote(name)} ADD COLUMN {column} {type_};" for column, type_ in columns.items()]
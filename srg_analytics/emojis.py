@@ -0,0 +1,122 @@
+"""Emoji extraction - Unicode emojis (including ZWJ sequences, flags and skin tones) and custom Discord emojis."""
+
+import collections
+import functools
+import re
+
+import emoji
+
+from .token_index import TokenIndex
+
+# <:name:id>, or <a:name:id> for animated ones
+_CUSTOM_EMOJI = r"<a?:\w+:\d+>"
+
+
+def _trie_pattern(sequences) -> str:
+    """Builds a regex matching any of the sequences, preferring the longest one, with the alternatives grouped by their
+    common prefixes so that a match only has to look at the branches of the characters seen so far."""
+    trie = {}
+    for sequence in sequences:
+        node = trie
+        for character in sequence:
+            node = node.setdefault(character, {})
+        node[""] = {}
+
+    def build(node, top_level=False):
+        branches = []
+        single = []  # characters that end a sequence and have nothing after them
+
+        for character, child in sorted(node.items()):
+            if character == "":
+                continue
+
+            rest = build(child)
+            if rest is None:
+                single.append(re.escape(character))
+            else:
+                branches.append(re.escape(character) + rest)
+
+        if single:
+            branches.append(single[0] if len(single) == 1 else f"[{''.join(single)}]")
+
+        if not branches:
+            return None
+
+        pattern = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+        return f"(?:{pattern})?" if "" in node and not top_level else pattern
+
+    return build(trie, top_level=True)
+
+
+def _ranges(characters) -> str:
+    """A character class body for the characters, with runs of consecutive code points as ranges."""
+    runs = []
+    for code_point in sorted(set(map(ord, characters))):
+        if runs and code_point == runs[-1][1] + 1:
+            runs[-1][1] = code_point
+        else:
+            runs.append([code_point, code_point])
+
+    return "".join(
+        re.escape(chr(start)) if start == end else f"{re.escape(chr(start))}-{re.escape(chr(end))}"
+        for start, end in runs
+    )
+
+
+@functools.cache
+def _patterns() -> tuple[re.Pattern, re.Pattern]:
+    """Returns the pattern finding the positions an emoji can start at, and the pattern matching one there. Built on
+    first use, as it takes a moment."""
+    candidates = re.compile(f"<a?:|[{_ranges(sequence[0] for sequence in emoji.EMOJI_DATA)}]")
+    emojis = re.compile(f"{_CUSTOM_EMOJI}|{_trie_pattern(emoji.EMOJI_DATA)}")
+
+    return candidates, emojis
+
+
+def load_patterns():
+    """Builds the emoji patterns ahead of their first use, see DB.connect, so that no write has to wait for them."""
+    _patterns()
+
+
+_custom_emojis = re.compile(_CUSTOM_EMOJI)
+
+
+def extract_emojis(message: str | bytes | None) -> list[str]:
+    """Returns the emojis of a message in order, one entry per occurrence."""
+    if not message:
+        return []
+    if isinstance(message, bytes):
+        message = message.decode("utf-8", errors="replace")
+
+    # every Unicode emoji has a non-ASCII character, so ASCII messages can only have custom emojis
+    if message.isascii():
+        return _custom_emojis.findall(message) if "<" in message else []
+
+    candidates, emojis = _patterns()
+    found = []
+    position = 0
+
+    # jumping between candidate positions is a lot faster than searching with the emoji pattern itself
+    while (candidate := candidates.search(message, position)) is not None:
+        match = emojis.match(message, candidate.start())
+
+        if match is None:
+            position = candidate.start() + 1
+        else:
+            found.append(match.group())
+            position = match.end()
+
+    return found
+
+
+def count_emojis(messages) -> collections.Counter:
+    """Returns how often every emoji occurs in the messages."""
+    counts = collections.Counter()
+    for message in messages:
+        counts.update(extract_emojis(message))
+
+    return counts
+
+
+EMOJI_INDEX = TokenIndex("emoji_index", extract_emojis)
+
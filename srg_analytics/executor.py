@@ -0,0 +1,104 @@
+"""Process pool shared by the CPU bound analysis functions, so they do not block the event loop."""
+
+import asyncio
+import collections
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker
+
+from .transport import SharedBatch, read_shared
+
+_executor: ProcessPoolExecutor | None = None
+_max_workers: int | None = None
+
+
+def set_max_workers(max_workers: int = None):
+    """Sets the number of worker processes, defaults to the number of CPUs. Takes effect the next time the executor is
+    started, call shutdown_executor() first to resize a running one."""
+    global _max_workers
+
+    if max_workers is not None and max_workers < 1:
+        raise ValueError("max_workers must be at least 1")
+
+    _max_workers = max_workers
+
+
+def get_executor() -> ProcessPoolExecutor:
+    """Returns the shared executor, starting it on first use."""
+    global _executor
+
+    if _executor is None:
+        # the workers have to share the resource tracker of this process, or each of them would start its own, which
+        # would try to clean up the shared memory blocks they read (see transport.py) once they exit
+        resource_tracker.ensure_running()
+        _executor = ProcessPoolExecutor(max_workers=_max_workers or os.cpu_count())
+
+    return _executor
+
+
+def shutdown_executor(wait: bool = True):
+    """Stops the worker processes. The executor is started again if it is used afterwards."""
+    global _executor
+
+    if _executor is not None:
+        _executor.shutdown(wait=wait, cancel_futures=not wait)
+        _executor = None
+
+
+async def run_in_executor(func, *args):
+    """Runs func(*args) in a worker process. func and its arguments have to be picklable."""
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), func, *args)
+
+
+async def _run_shared(func, batch):
+    shared = SharedBatch.pack(batch)
+    try:
+        return await run_in_executor(read_shared, func, shared.handle)
+    finally:
+        shared.close()
+
+
+def _submit(loop, executor, func, batch, shared_memory: bool) -> asyncio.Future:
+    if shared_memory:
+        return asyncio.ensure_future(_run_shared(func, batch))
+    return loop.run_in_executor(executor, func, batch)
+
+
+async def run_batched(func, items: list, batch_size: int = 1000, shared_memory: bool = False) -> list:
+    """Applies func to the items in batches of `batch_size`, in parallel. Returns the results of the batches in order.
+
+    See map_batches for shared_memory.
+    """
+    loop = asyncio.get_running_loop()
+    executor = get_executor()
+
+    return await asyncio.gather(
+        *(_submit(loop, executor, func, items[i:i + batch_size], shared_memory) for i in range(0, len(items), batch_size))
+    )
+
+
+async def map_batches(func, batches, max_pending: int = 16, shared_memory: bool = False):
+    """Applies func to every batch of an async iterable of batches, yielding the results in order.
+
+    At most `max_pending` batches are queued at once, so memory stays bounded by the batch size.
+
+    With shared_memory, every batch of messages (or of (integer key, message) rows) is sent packed in a shared memory
+    block instead of pickled, and func gets it as PackedMessages, see transport.py. func should return a compact
+    aggregate (e.g. a Counter) rather than anything in proportion to the messages, which would be pickled back.
+    """
+    loop = asyncio.get_running_loop()
+    executor = get_executor()
+    pending = collections.deque()
+
+    try:
+        async for batch in batches:
+            pending.append(_submit(loop, executor, func, batch, shared_memory))
+
+            if len(pending) >= max_pending:
+                yield await pending.popleft()
+
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for future in pending:
+            future.cancel()
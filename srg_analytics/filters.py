@@ -0,0 +1,121 @@
+"""Composable filter on the messages of a guild, compiled into parameterized SQL."""
+
+from .rollup import hour_bucket
+
+
+def _as_tuple(ids) -> tuple:
+    if ids is None:
+        return ()
+    if isinstance(ids, int):
+        return (ids,)
+    return tuple(ids)
+
+
+class MessageFilter:
+    """Which messages of a guild an analysis runs on.
+
+    channel_ids and user_ids take a single id or a list of ids, user_ids match aliased_author_id instead of author_id
+    when aliased is True. since and until are inclusive epochs. exclude_bots leaves out messages sent by bots, and
+    non_empty leaves out messages without content.
+    """
+
+    def __init__(
+            self, guild_id: int, channel_ids: int | list[int] = None, user_ids: int | list[int] = None,
+            aliased: bool = False, since: int | float = None, until: int | float = None, exclude_bots: bool = False,
+            non_empty: bool = False
+    ):
+        if guild_id is None:
+            raise ValueError("guild_id cannot be None")
+
+        self.guild_id = guild_id
+        self.channel_ids: tuple[int, ...] = _as_tuple(channel_ids)
+        self.user_ids: tuple[int, ...] = _as_tuple(user_ids)
+        self.aliased = aliased
+        self.since = since
+        self.until = until
+        self.exclude_bots = exclude_bots
+        self.non_empty = non_empty
+
+    def __repr__(self):
+        return (
+            f"MessageFilter(guild_id={self.guild_id}, channel_ids={self.channel_ids}, user_ids={self.user_ids}, "
+            f"aliased={self.aliased}, since={self.since}, until={self.until}, exclude_bots={self.exclude_bots}, "
+            f"non_empty={self.non_empty})"
+        )
+
+    def replace(self, **changes) -> "MessageFilter":
+        """Returns a copy of the filter with some of its fields changed."""
+        fields = {
+            "guild_id": self.guild_id,
+            "channel_ids": self.channel_ids,
+            "user_ids": self.user_ids,
+            "aliased": self.aliased,
+            "since": self.since,
+            "until": self.until,
+            "exclude_bots": self.exclude_bots,
+            "non_empty": self.non_empty,
+        }
+        fields.update(changes)
+
+        return MessageFilter(**fields)
+
+    def compile(self) -> tuple[str, list]:
+        """Compiles the filter for the guild's message table. Returns the WHERE clause (empty if there is nothing to
+        filter on) and its arguments."""
+        # aliased_author_id is NULL in the message tables for users without an alias
+        return self._compile([], [], "epoch", self.since, self.until, aliased_nullable=True)
+
+    def compile_rollup(self) -> tuple[str, list]:
+        """Compiles the filter for the rollup table, where since and until are applied to the whole hour they fall
+        into. Returns the WHERE clause and its arguments."""
+        if self.non_empty:
+            raise ValueError("non_empty cannot be answered from the rollups, they do not track message content")
+
+        since = hour_bucket(self.since) if self.since is not None else None
+        return self._compile(["guild_id = %s"], [self.guild_id], "hour_bucket", since, self.until)
+
+    def compile_postings(self) -> tuple[str, list]:
+        """Compiles the filter for the word postings, which only has messages with words, so non_empty is implied.
+        Returns the WHERE clause and its arguments."""
+        return self.replace(non_empty=False)._compile(["guild_id = %s"], [self.guild_id], "epoch", self.since, self.until)
+
+    def _compile(self, clauses: list, args: list, epoch_column: str, since, until,
+                 aliased_nullable: bool = False) -> tuple[str, list]:
+        if self.channel_ids:
+            clauses.append(f"channel_id IN ({', '.join(['%s'] * len(self.channel_ids))})")
+            args.extend(self.channel_ids)
+
+        if self.user_ids:
+            placeholders = ", ".join(["%s"] * len(self.user_ids))
+
+            if not self.aliased:
+                clauses.append(f"author_id IN ({placeholders})")
+            elif not aliased_nullable:
+                clauses.append(f"aliased_author_id IN ({placeholders})")
+            else:
+                # rather than COALESCE(aliased_author_id, author_id) IN (...), so the author indexes can be used
+                clauses.append(
+                    f"(aliased_author_id IN ({placeholders}) OR (aliased_author_id IS NULL AND author_id IN ({placeholders})))"
+                )
+                args.extend(self.user_ids)
+
+            args.extend(self.user_ids)
+
+        if since is not None:
+            clauses.append(f"{epoch_column} >= %s")
+            args.append(since)
+
+        if until is not None:
+            clauses.append(f"{epoch_column} <= %s")
+            args.append(until)
+
+        if self.exclude_bots:
+            clauses.append("is_bot = 0")
+
+        if self.non_empty:
+            clauses.append("message_content IS NOT NULL AND message_content != ''")
+
+        if not clauses:
+            return "", args
+
+        return f"WHERE {' AND '.join(clauses)}", args
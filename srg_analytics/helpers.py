@@ -1,49 +1,25 @@
 import collections
+import functools
 import time
 
-import nltk
-
+from .activity import _activity_series
+from .buckets import TimeBuckets
 from .DB import DB
+from .emojis import EMOJI_INDEX, count_emojis
+from .executor import map_batches, run_batched
+from .filters import MessageFilter
+from .postings import POSTINGS_TABLE
+from .sketch import SpaceSaving
+from .token_index import TOKEN_LENGTH, WORD_INDEX, TokenIndex
+from .tokenizer import Tokenizer, default_tokenizer
 from collections import Counter
-import validators
-from multiprocessing import Pool
-
-
-async def is_ignored(db: DB, channel_id: int = None, user_id: int = None):
-    if channel_id is None and user_id is None:
-        raise ValueError("channel_id and user_id cannot both be None")
-
-    channel_ignored = False
-    user_ignored = False
-
-    # Ignore based on channel_id
-    if channel_id is not None:
-        res = await db.execute(
-            f"""
-                        SELECT * FROM `config` WHERE data1 = {channel_id} AND _key = 'channel_ignore'
-                    """, fetch="one"
-        )
-        try:
-            channel_ignored = res[0] == channel_id
-        except TypeError:
-            channel_ignored = False
-
-    # Ignore based on user_id
-    if user_id is not None:
-        res = await db.execute(
-            f"""
-                        SELECT data1 FROM `config` WHERE data1 = {user_id} AND _key = 'user_ignore';
-                    """, fetch="one"
-        )
 
-        # get the data1 and check if it is equal to user_id
-        try:
-            user_ignored = res[0] == user_id
-        except TypeError:
-            user_ignored = False
 
-    if True in [channel_ignored, user_ignored]:
-        return True
+async def is_ignored(db: DB, channel_id: int = None, user_id: int = None, guild_id: int = None):
+    """Returns whether a channel or user is ignored. Served from the config cache of the DB, pass guild_id for a
+    constant time lookup."""
+    await db.connect()  # loads the config cache, does nothing if already connected
+    return db.is_ignored(guild_id=guild_id, channel_id=channel_id, user_id=user_id)
 
 
 def get_words_from_user(db_or_msgs: DB | list, guild_id: int = None, user_id: int = None):
@@ -56,177 +32,222 @@ def get_words_from_user(db_or_msgs: DB | list, guild_id: int = None, user_id: in
     if not message_content:
         return None
 
-    all_messages = " ".join(message_content)
-    words = nltk.word_tokenize(all_messages)
+    return default_tokenizer.words(message_content)
+
+
+async def get_top_users_by_words(db: DB, guild_id: int, channel_id: int = None, amount: int = 10, start_epoch: int = None, count_others = True,
+                                 message_filter: MessageFilter = None):
+    message_filter = message_filter or MessageFilter(guild_id, channel_ids=channel_id, since=start_epoch)
+
+    # Get the top users and their word counts
+    # noinspection PyTypeChecker
+    top_users: list[tuple[int, int]] = await _sum_metric(db, message_filter, "author_id", "word_count")
+
+    if count_others:
+        return [*top_users[:amount], ('others', sum([i[1] for i in top_users[amount:]]))]
+    else:
+        return top_users[:amount]
+
 
-    # remove stopwords
-    stopwords = nltk.corpus.stopwords.words("english")
-    words = [word for word in words if word not in stopwords]
+async def get_top_channels_by_words(db: DB, guild_id: int, amount: int = 10, message_filter: MessageFilter = None):
+    message_filter = message_filter or MessageFilter(guild_id)
 
-    return words
+    return await _sum_metric(db, message_filter, "channel_id", "word_count", amount)
 
 
-async def get_top_users_by_words(db: DB, guild_id: int, channel_id: int = None, amount: int = 10, start_epoch: int = None, count_others = True):
+async def _sum_metric(db: DB, message_filter: MessageFilter, group_by: str, column: str, amount: int = None):
+    """Sums a metric column (see metrics.py) of the non-bot messages matching a filter per user or channel, in
+    descending order."""
+    where, args = message_filter.replace(exclude_bots=True).compile()
 
     query = f"""
-            SELECT author_id, message_content
-            FROM `{guild_id}` WHERE is_bot = 0 AND message_content != ''
+            SELECT {group_by}, CAST(SUM({column}) AS {db.dialect.int_type}) AS count
+            FROM {db.table(message_filter.guild_id)} {where}
+            GROUP BY {group_by}
+            HAVING SUM({column}) > 0
+            ORDER BY count DESC
             """
 
-    if channel_id is not None:
-        query += f"AND channel_id = {channel_id}"
+    if amount is not None:
+        query += f"LIMIT {int(amount)}"
 
-    if start_epoch is not None:
-        query += f"AND epoch >= {start_epoch}"
+    return [tuple(row) for row in await db.execute(query, args, fetch="all")]
 
-    res = await db.execute(query, fetch="all")
+async def count_words(messages, batch_size=1000) -> Counter:
+    """Returns how often every valid word occurs in a list of messages from the database."""
+    counts = Counter()
+    for batch_counts, stats in await run_batched(default_tokenizer.count_batch, messages, batch_size, shared_memory=True):
+        counts.update(batch_counts)
+        default_tokenizer.merge_stats(stats)
 
-    # Count words for each user
-    word_counts = Counter()
-    for author_id, message in res:
-        words = message.split()
-        word_counts[author_id] += len(words)
+    return counts
 
-    # Get the top users and their word counts
-    # noinspection PyTypeChecker
-    top_users: list[tuple[int, int]] = word_counts.most_common()
 
-    if count_others:
-        return [*top_users[:amount], ('others', sum([i[1] for i in top_users[amount:]]))]
-    else:
-        return top_users[:amount]
+async def process_messages(messages, batch_size=1000):
+    """Returns a list of all valid words when given a list of messages from the database, grouped by word rather than
+    in the order of the messages. Prefer count_words, this expands its counts."""
+    return list((await count_words(messages, batch_size)).elements())
+
+
+async def _content_batches(db: DB, query: str, args: list, batch_size: int):
+    """Streams the first column of a query, in batches."""
+    async for rows in db.iterate(query, args, batch_size=batch_size):
+        yield [row[0] for row in rows]
+
+
+async def get_top_tokens(db: DB, index: TokenIndex, message_filter: MessageFilter, amount: int = 10):
+    """Returns the most common tokens of a token index (e.g. WORD_INDEX) among the messages matching a filter. The
+    index has no time column, so the filter cannot have since or until set."""
+    if message_filter.since is not None or message_filter.until is not None:
+        raise ValueError("token indexes cannot be filtered by time")
 
+    # messages without content have no tokens, so non_empty is implied
+    where, args = message_filter.replace(non_empty=False).compile_rollup()
 
-async def get_top_channels_by_words(db: DB, guild_id: int, amount: int = 10):
-    res = await db.execute(
+    return await db.execute(
         f"""
-            SELECT channel_id, message_content
-            FROM `{guild_id}` WHERE is_bot = 0 AND message_content != ''
-        """, fetch="all"
+            SELECT token, CAST(SUM(occurrences) AS {db.dialect.int_type}) AS count
+            FROM {index.table} {where}
+            GROUP BY token
+            HAVING SUM(occurrences) > 0
+            ORDER BY count DESC
+            LIMIT {int(amount)};
+        """, args, fetch="all"
     )
 
-    # Count words for each user
-    word_counts = Counter()
-    for _channel_id, message in res:
-        words = message.split()
-        word_counts[_channel_id] += len(words)
 
-    # Get the top users and their word counts
-    top_channels = word_counts.most_common()
-
-    return top_channels[:amount]
-
-import nltk
-from multiprocessing import Pool
-
-def _process_batch(messages):
-    """Process a batch of messages and return a list of valid words."""
-    words = []
-
-    try:
-        stop_words = nltk.corpus.stopwords.words("english")
-    except LookupError:
-        nltk.download("stopwords")
-        stop_words = nltk.corpus.stopwords.words("english")
-
-    for sentence in messages:
-        sentence = sentence.decode("utf-8")
-
-        if sentence.strip() == "":
-            continue
-        elif sentence[0:3] == "```" or sentence[-3:] == "```":
-            continue
-        elif validators.url(str(sentence)):
-            continue
-
-        try:
-            tokens = nltk.tokenize.word_tokenize(sentence)
-        except LookupError:
-            nltk.download("punkt")
-            tokens = nltk.tokenize.word_tokenize(sentence)
-
-        sentence = [w for w in tokens if w not in stop_words]
-
-        for word in sentence:
-            if sentence[0:2] == "<@":
-                continue
-            if len(word) <= 1:
-                continue
-            elif not word.isalpha():
-                continue    # Todo check if this is a good idea
-            # elif word[0:2] == "<@":
-            #     continue
-            # elif word[0:2] == "<!":
-            #     continue
-            # elif word[0:2] == "<#":
-            #     continue
-
-            words.append(word.lower())
-
-    return words
-
-def process_messages(messages, batch_size=1000, num_processes=8):
-    """Returns a list of all valid words when given a list of messages from the database."""
-    pool = Pool(processes=num_processes)
-    results = []
-
-    # Split messages into batches
-    message_batches = [messages[i:i+batch_size] for i in range(0, len(messages), batch_size)]
-
-    # Process batches concurrently
-    for batch in message_batches:
-        result = pool.apply_async(_process_batch, (batch,))
-        results.append(result)
-
-    # Collect results from all batches
-    words = []
-    for result in results:
-        words.extend(result.get())
-
-    return words
-
-
-
-async def get_top_words(db: DB, guild_id: int, user_id: int = None, channel_id: int = None, amount: int = 10):
-    if user_id is not None:
-        res = await db.execute(
-            f"""
-                        SELECT message_content
-                        FROM `{guild_id}` WHERE author_id = {user_id}
-                        AND is_bot = 0 AND message_content != ''
-                    """, fetch="all"
-        )
-    elif channel_id is not None:
-        res = await db.execute(
-            f"""
-                        SELECT message_content
-                        FROM `{guild_id}` WHERE channel_id = {channel_id}
-                        AND is_bot = 0 AND message_content != ''
-                    """, fetch="all"
-        )
-    elif user_id is not None and channel_id is not None:
-        res = await db.execute(
-            f"""
-                        SELECT message_content
-                        FROM `{guild_id}` WHERE author_id = {user_id} AND channel_id = {channel_id}
-                        AND is_bot = 0 AND message_content != ''
-                    """, fetch="all"
-        )
-    else:
-        res = await db.execute(
-            f"""
-                        SELECT message_content
-                        FROM `{guild_id}` WHERE is_bot = 0 AND message_content != ''
-                    """, fetch="all"
+async def _batch_counts(count, batches):
+    """Counts every batch with count(messages) -> Counter in the worker processes, yielding the counts in order. The
+    words of a Tokenizer are counted with its cache, whose stats are merged into it."""
+    if not isinstance(count, Tokenizer):
+        async for batch_counts in map_batches(count, batches, shared_memory=True):
+            yield batch_counts
+        return
+
+    async for batch_counts, stats in map_batches(count.count_batch, batches, shared_memory=True):
+        count.merge_stats(stats)
+        yield batch_counts
+
+
+async def _count_top(db: DB, message_filter: MessageFilter, count, amount: int, batch_size: int,
+                     approximate: float = None) -> list[tuple]:
+    """Counts the messages matching a filter with count(messages) -> Counter (or a Tokenizer) in the worker processes,
+    returning the most common items.
+
+    With `approximate` set, the counts of the batches are folded into a SpaceSaving sketch with that relative error
+    as they come back, so memory stays bounded by the batch size and the sketch however many distinct items there
+    are, and (item, count, max error) tuples are returned.
+    """
+    where, args = message_filter.replace(non_empty=True).compile()
+    query = f"SELECT message_content FROM {db.table(message_filter.guild_id)} {where}"
+    batches = _content_batches(db, query, args, batch_size)
+
+    if approximate is None:
+        counts = collections.Counter()
+        async for batch_counts in _batch_counts(count, batches):
+            counts.update(batch_counts)
+
+        return counts.most_common(amount)
+
+    summary = SpaceSaving.for_error(approximate)
+    async for batch_counts in _batch_counts(count, batches):
+        summary.update(batch_counts)
+
+    return summary.top(amount)
+
+
+async def get_top_words(db: DB, guild_id: int, user_id: int = None, channel_id: int = None, amount: int = 10,
+                        batch_size: int = 1000, message_filter: MessageFilter = None, approximate: float = None):
+    """Returns the most used words of a guild, or of a user and/or channel, as (word, count) tuples.
+
+    Time windows are counted from the messages, pass approximate (the relative error, e.g. 0.001) to do that in
+    bounded memory; (word, count, max error) tuples are returned then.
+    """
+    message_filter = message_filter or MessageFilter(guild_id, channel_ids=channel_id, user_ids=user_id)
+    message_filter = message_filter.replace(exclude_bots=True)
+
+    if message_filter.since is None and message_filter.until is None:
+        top_words = await get_top_tokens(db, WORD_INDEX, message_filter, amount)
+        return [(word, count) if approximate is None else (word, count, 0) for word, count in top_words]
+
+    # the word index has no time column, so time windows are counted from the messages themselves
+    return await _count_top(db, message_filter, default_tokenizer, amount, batch_size, approximate)
+
+
+async def get_top_emojis(db: DB, guild_id: int, user_id: int = None, channel_id: int = None, amount: int = 10,
+                         batch_size: int = 1000, message_filter: MessageFilter = None,
+                         approximate: float = None) -> list[tuple]:
+    """Returns the most used emojis of a guild, or of a user and/or channel, see get_top_words."""
+    message_filter = message_filter or MessageFilter(guild_id, channel_ids=channel_id, user_ids=user_id)
+
+    if message_filter.since is None and message_filter.until is None:
+        top_emojis = await get_top_tokens(db, EMOJI_INDEX, message_filter, amount)
+        return [(emoji, count) if approximate is None else (emoji, count, 0) for emoji, count in top_emojis]
+
+    # the emoji index has no time column, so time windows are counted from the messages themselves
+    return await _count_top(db, message_filter, count_emojis, amount, batch_size, approximate)
+
+
+async def _word_usage_counts(db: DB, word: str, message_filter: MessageFilter, buckets: TimeBuckets) -> list[tuple]:
+    """Returns the occurrences of a word among the messages matching a filter per bucket (see TimeBuckets.sql)."""
+    where, args = message_filter.compile_postings()
+
+    query = f"""
+        SELECT
+            {buckets.sql(db.dialect, "epoch")} AS bucket,
+            CAST(SUM(occurrences) AS {db.dialect.int_type}) AS count
+        FROM
+            {POSTINGS_TABLE}
+        {where} AND token = %s
+        GROUP BY
+            bucket
+    """
+
+    return await db.execute(query, [*args, word], fetch="all")
+
+
+async def word_usage(db: DB, guild_id: int, word: str, by: str = "user", amount: int = None,
+                     timeperiod_or_daterange: str | tuple | list = None, timezone=None,
+                     message_filter: MessageFilter = None):
+    """Returns how often a word was used, from the word postings.
+
+    by="user" and by="channel" return (user or channel id, count) tuples, most uses first; pass user_ids in the filter
+    for how often someone said it. by="time" returns the labels and values of a graph of its uses over a time period or
+    date range, bucketed like the activity graphs.
+    """
+    if by not in ("user", "channel", "time"):
+        raise ValueError("by must be either 'user', 'channel' or 'time'")
+
+    message_filter = message_filter or MessageFilter(guild_id)
+
+    # the postings are keyed by the tokenizer's words, so the word is looked up the way it was indexed
+    tokens = default_tokenizer.tokenize(word)
+    if len(tokens) != 1:
+        raise ValueError(f"{word!r} is not a single indexed word, stopwords and single letters are not indexed")
+    word = tokens[0][:TOKEN_LENGTH]
+
+    if by == "time":
+        if timeperiod_or_daterange is None:
+            raise ValueError("timeperiod_or_daterange is required when by is 'time'")
+
+        return await _activity_series(
+            functools.partial(_word_usage_counts, db, word), message_filter, timeperiod_or_daterange, timezone
         )
 
-    res = [x[0] for x in res]
+    if by == "user":
+        group_by = "aliased_author_id" if message_filter.aliased else "author_id"
+    else:
+        group_by = "channel_id"
 
-    words = process_messages(res)
+    where, args = message_filter.compile_postings()
+    query = f"""
+        SELECT {group_by}, CAST(SUM(occurrences) AS {db.dialect.int_type}) AS count
+        FROM {POSTINGS_TABLE} {where} AND token = %s
+        GROUP BY {group_by}
+        ORDER BY count DESC
+    """
 
-    # words is a list of all words ever sent, make a list of the top words and their counts
-    counts = collections.Counter(words)
-    top_words = counts.most_common(amount)
+    if amount is not None:
+        query += f"LIMIT {int(amount)}"
 
-    # return the top words with their counts
-    return top_words  # [(word, count), (word, count), ...]
+    return [tuple(row) for row in await db.execute(query, [*args, word], fetch="all")]
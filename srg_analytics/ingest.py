@@ -0,0 +1,213 @@
+"""Write-behind buffer that coalesces single message inserts into bulk inserts."""
+
+import asyncio
+import time
+
+from .DB import DB
+from .schemas import Message, MessageEdit
+
+
+class IngestBuffer:
+    """Buffers messages per guild in front of `DB.add_messages_bulk`.
+
+    A guild's pending messages are flushed as one multi-row insert once `max_batch` of them are pending, or once the
+    oldest of them has waited `max_delay` seconds. When `max_pending` messages are buffered in total, `add_message`
+    waits for the whole buffer to be flushed before returning (backpressure).
+
+    Edits and deletes of messages that are still buffered are applied in memory, everything else is passed on to the
+    DB. Call `close()` (or `flush()`) on shutdown, so nothing is lost.
+    """
+
+    def __init__(self, db: DB, max_batch: int = 500, max_delay: float = 1.0, max_pending: int = 10000):
+        self.db = db
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+
+        # format - guild_id: {message_id: Message}
+        self._pending: dict[int, dict[int, Message]] = {}
+        self._oldest: dict[int, float] = {}  # guild_id: time the oldest pending message was added
+        self._in_flight: dict[int, set[int]] = {}  # guild_id: message ids currently being inserted
+        self._size = 0
+
+        self._lock = asyncio.Lock()  # only one flush at a time
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._closed = False
+
+    def __len__(self):
+        return self._size
+
+    async def add_message(self, guild_id: int, data: Message):
+        """Buffers a message, to be inserted with the next flush of its guild."""
+        if self._closed:
+            raise RuntimeError("IngestBuffer is closed")
+
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+        guild = self._pending.setdefault(guild_id, {})
+
+        # same as INSERT IGNORE, the first copy of a message wins
+        if data.message_id in guild:
+            return
+
+        guild[data.message_id] = data
+        self._oldest.setdefault(guild_id, time.monotonic())
+        self._size += 1
+        self._wakeup.set()
+
+        if self._size >= self.max_pending:
+            await self.flush()
+        elif len(guild) >= self.max_batch:
+            await self.flush(guild_id)
+
+    async def add_messages_bulk(self, guild_id: int, data: list[Message]):
+        for message in data:
+            await self.add_message(guild_id, message)
+
+    async def edit_message(
+            self, guild_id: int, message_id: int, content: str, edit_epoch: int, user_mentions: str,
+            channel_mentions: str, role_mentions: str, num_attachments: int
+    ):
+        await self.edit_messages_bulk(
+            guild_id,
+            [MessageEdit(message_id, content, edit_epoch, user_mentions, channel_mentions, role_mentions, num_attachments)]
+        )
+
+    async def delete_message(self, guild_id: int, message_id: int):
+        await self.delete_messages_bulk(guild_id, [message_id])
+
+    async def delete_messages_bulk(self, guild_id: int, message_ids: list[int]) -> int:
+        """Drops buffered messages in memory and bulk deletes the rest. Returns the number of deleted messages."""
+        for message_id in message_ids:
+            await self._wait_if_in_flight(guild_id, message_id)
+
+        guild = self._pending.get(guild_id, {})
+        remaining = []
+        deleted = 0
+
+        for message_id in message_ids:
+            if message_id in guild:
+                del guild[message_id]
+                self._size -= 1
+                deleted += 1
+            else:
+                remaining.append(message_id)
+
+        if not guild:
+            self._pending.pop(guild_id, None)
+            self._oldest.pop(guild_id, None)
+
+        if remaining:
+            deleted += await self.db.delete_messages_bulk(guild_id, remaining)
+
+        return deleted
+
+    async def edit_messages_bulk(self, guild_id: int, edits: list[MessageEdit]) -> int:
+        """Applies edits of buffered messages in memory and bulk edits the rest. Returns the number of edited messages."""
+        for edit in edits:
+            await self._wait_if_in_flight(guild_id, edit.message_id)
+
+        guild = self._pending.get(guild_id, {})
+        remaining = []
+        edited = 0
+
+        for edit in edits:
+            message = guild.get(edit.message_id)
+
+            if message is None:
+                remaining.append(edit)
+                continue
+
+            message.message_content = edit.message_content
+            message.edit_epoch = edit.edit_epoch
+            message.user_mentions = edit.user_mentions
+            message.channel_mentions = edit.channel_mentions
+            message.role_mentions = edit.role_mentions
+            message.num_attachments = edit.num_attachments
+            edited += 1
+
+        if remaining:
+            edited += await self.db.edit_messages_bulk(guild_id, remaining)
+
+        return edited
+
+    async def flush(self, guild_id: int = None):
+        """Inserts the pending messages of a guild, or of all guilds if no guild_id is passed."""
+        async with self._lock:
+            guild_ids = list(self._pending) if guild_id is None else [guild_id]
+
+            for guild_id_ in guild_ids:
+                await self._flush_guild(guild_id_)
+
+    async def close(self):
+        """Stops the background flusher and flushes everything that is still pending."""
+        self._closed = True
+
+        if self._task is not None:
+            # with the lock held, a flush the flusher is in the middle of completes before it is cancelled
+            async with self._lock:
+                self._task.cancel()
+                try:
+                    await self._task
+                except asyncio.CancelledError:
+                    pass
+                self._task = None
+
+        await self.flush()
+
+    async def _flush_guild(self, guild_id: int):
+        messages = self._pending.pop(guild_id, None)
+        self._oldest.pop(guild_id, None)
+
+        if not messages:
+            return
+
+        self._size -= len(messages)
+        self._in_flight[guild_id] = set(messages)
+
+        try:
+            await self.db.add_messages_bulk(guild_id, list(messages.values()))
+        except BaseException:
+            # put the messages back, so they are retried with the next flush (also when the flush is cancelled;
+            # messages that were inserted after all are skipped by add_messages_bulk)
+            guild = self._pending.setdefault(guild_id, {})
+            for message_id, message in messages.items():
+                if message_id not in guild:
+                    guild[message_id] = message
+                    self._size += 1
+
+            self._oldest.setdefault(guild_id, time.monotonic())
+            raise
+        finally:
+            del self._in_flight[guild_id]
+
+    async def _wait_if_in_flight(self, guild_id: int, message_id: int):
+        # the message is being inserted right now, let the insert land before touching it
+        if message_id in self._in_flight.get(guild_id, ()):
+            async with self._lock:
+                pass
+
+    async def _run(self):
+        """Flushes every guild whose oldest pending message has waited `max_delay` seconds."""
+        while True:
+            if not self._oldest:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            wait = min(self._oldest.values()) + self.max_delay - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            now = time.monotonic()
+            due = [guild_id for guild_id, oldest in self._oldest.items() if now - oldest >= self.max_delay]
+
+            try:
+                async with self._lock:
+                    for guild_id in due:
+                        await self._flush_guild(guild_id)
+            except Exception as e:
+                print(e)
+                await asyncio.sleep(self.max_delay)
@@ -1,45 +1,116 @@
-import time
+import functools
+from collections import Counter
+
+import numpy as np
 
 from .DB import DB
-import multiprocessing
-from collections import Counter
+from .executor import map_batches
+from .filters import MessageFilter
+from .helpers import _content_batches
+from .schemas import LetterLeaderboard
+from .transport import PackedMessages
 
-# Top-level function, not nested inside letter_leaderboard
-def count_letters(message_list):
+_LOWERCASE = np.arange(ord("a"), ord("z") + 1)
+_UPPERCASE = np.arange(ord("A"), ord("Z") + 1)
+
+# byte: whether it is an ASCII letter
+_IS_ASCII_LETTER = np.zeros(256, dtype=bool)
+_IS_ASCII_LETTER[_LOWERCASE] = True
+_IS_ASCII_LETTER[_UPPERCASE] = True
+
+
+def _unicode_letters(message: str):
+    """The non-ASCII letters of a message, lowercased."""
+    return [letter for letter in message.lower() if letter.isalpha() and not letter.isascii()]
+
+
+def _letter_counter(byte_counts: np.ndarray) -> Counter:
+    """The ASCII letters of a bincount of bytes, case-insensitively."""
     letters = Counter()
-    for message in message_list:
-        for letter in message.lower():
-            if letter.isalpha():
-                letters[letter] += 1
+    for letter, count in zip(_LOWERCASE, byte_counts[_LOWERCASE] + byte_counts[_UPPERCASE]):
+        if count:
+            letters[chr(letter)] = int(count)
 
     return letters
 
-async def letter_leaderboard(db: DB, guild_id: int, user_id: int = None):
-    messages = await db.get_message_content(guild_id)
-    batch_size = 10000
 
-    # Create counter for letters
-    letters = Counter()
+# Top-level function, not nested inside letter_leaderboard
+def count_letters(message_list: list | PackedMessages) -> Counter:
+    """Counts the letters of the messages (str, UTF-8 bytes, or packed), case-insensitively.
 
-    # Split messages into batches
-    message_batches = [messages[i:i + batch_size] for i in range(0, len(messages), batch_size)] # todo make faster
+    ASCII letters are counted with one bincount over all the bytes, only messages with other characters are decoded.
+    """
+    packed = message_list if isinstance(message_list, PackedMessages) else PackedMessages.pack(message_list)
 
-    # Process batches concurrently using multiprocessing pool
-    with multiprocessing.Pool(processes=8) as pool:
-        results = pool.map(count_letters, message_batches)
-        pool.close()
-        pool.join()
+    letters = _letter_counter(np.bincount(packed.bytes(), minlength=256))
+    for i in packed.non_ascii().tolist():
+        letters.update(_unicode_letters(packed.message(i)))
 
-    # Sum the results from all batches
-    for result in results:
-        letters.update(result)
+    return letters
 
-    print(letters)
 
+def _count_letters_by_author(user_ids: tuple, packed: PackedMessages) -> tuple[Counter, Counter]:
+    """Counts the letters of the users' messages in messages packed with their author as the key, along with the
+    number of letters of every author."""
+    data = packed.bytes()
+    lengths = packed.lengths
 
+    # letters per message - the running number of letters at the end of each message minus the one at its start
+    running = np.concatenate(([0], np.cumsum(_IS_ASCII_LETTER[data])))
+    per_message = running[packed.ends] - running[packed.starts]
 
+    selected = np.isin(packed.keys, np.array(user_ids, dtype=np.int64))
+    letters = _letter_counter(np.bincount(data[np.repeat(selected, lengths)], minlength=256))
 
+    for i in packed.non_ascii().tolist():
+        unicode_letters = _unicode_letters(packed.message(i))
+        per_message[i] += len(unicode_letters)
+        if selected[i]:
+            letters.update(unicode_letters)
 
+    authors, inverse = np.unique(packed.keys, return_inverse=True)
+    totals = Counter(dict(zip(authors.tolist(), np.bincount(inverse, weights=per_message).astype(np.int64).tolist())))
 
-    return letters
+    return letters, totals
+
+
+async def letter_leaderboard(db: DB, guild_id: int, user_id: int = None, batch_size: int = 10000,
+                             message_filter: MessageFilter = None, channel_id: int = None,
+                             rank_user: bool = True) -> LetterLeaderboard:
+    """Counts the letters of a guild, or of a user and/or channel.
+
+    For a single user, rank_user also ranks them among the users of the guild by their number of letters, which takes
+    a pass over the messages of all the users instead of just theirs.
+    """
+    message_filter = message_filter or MessageFilter(guild_id, channel_ids=channel_id, user_ids=user_id)
+    message_filter = message_filter.replace(non_empty=True)
+
+    if not (rank_user and len(message_filter.user_ids) == 1):
+        where, args = message_filter.compile()
+        query = f"SELECT message_content FROM {db.table(guild_id)} {where}"
+
+        # Stream the messages in batches, and count them concurrently in the worker processes
+        letters = Counter()
+        async for result in map_batches(count_letters, _content_batches(db, query, args, batch_size), shared_memory=True):
+            letters.update(result)
+
+        return LetterLeaderboard(letters)
+
+    author = "COALESCE(aliased_author_id, author_id)" if message_filter.aliased else "author_id"
+    where, args = message_filter.replace(user_ids=None).compile()
+    query = f"SELECT {author}, message_content FROM {db.table(guild_id)} {where}"
+
+    letters = Counter()
+    totals = Counter()
+    count_batch = functools.partial(_count_letters_by_author, message_filter.user_ids)
+
+    batches = db.iterate(query, args, batch_size=batch_size)
+
+    async for batch_letters, batch_totals in map_batches(count_batch, batches, shared_memory=True):
+        letters.update(batch_letters)
+        totals.update(batch_totals)
+
+    user_total = totals.get(message_filter.user_ids[0], 0)
+    user_rank = 1 + sum(1 for total in totals.values() if total > user_total) if user_total else None
 
+    return LetterLeaderboard(letters, user_rank=user_rank, ranked_users=len(totals))
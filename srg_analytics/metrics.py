@@ -0,0 +1,40 @@
+"""Metrics of a message's content, computed once when it is written and stored next to it in the guild table."""
+
+import re
+
+from .emojis import extract_emojis
+
+# format - column: type; NULL until computed, see DB.backfill_metrics
+METRIC_COLUMNS = {
+    "word_count": "INT",
+    "char_count": "INT",
+    "emoji_count": "INT",
+    "is_url_only": "BOOLEAN",
+    "is_code_block": "BOOLEAN",
+}
+
+_url_only = re.compile(r"\s*(?:(?:https?://|www\.)\S+\s*)+")
+
+
+def message_metrics(content: str | bytes | None, emoji_count: int = None) -> tuple[int, int, int, bool, bool]:
+    """Returns the values of METRIC_COLUMNS for a message's content. The emojis are only extracted if their count is
+    not given, e.g. from the TokenCounts of EMOJI_INDEX."""
+    if isinstance(content, bytes):
+        content = content.decode("utf-8", errors="replace")
+    if not content:
+        return 0, 0, 0, False, False
+
+    stripped = content.strip()
+
+    return (
+        len(content.split()),
+        len(content),
+        len(extract_emojis(content)) if emoji_count is None else emoji_count,
+        _url_only.fullmatch(content) is not None,
+        len(stripped) >= 6 and stripped.startswith("```") and stripped.endswith("```"),
+    )
+
+
+def metrics_batch(rows) -> list[tuple]:
+    """Returns the rows with the metrics of their last column (the message content) in its place."""
+    return [(*row[:-1], *message_metrics(row[-1])) for row in rows]
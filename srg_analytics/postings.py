@@ -0,0 +1,99 @@
+"""Inverted word index - the messages every word occurs in, maintained at ingestion time."""
+
+from .rollup import MessageSnapshot
+from .token_index import WORD_INDEX, TokenCounts
+
+POSTINGS_TABLE = "word_postings"
+POSTINGS_KEY = ("guild_id", "token", "message_id")
+
+
+def postings_create_table(dialect) -> list[str]:
+    return dialect.create_table(
+        POSTINGS_TABLE,
+        f"""
+            guild_id BIGINT NOT NULL,
+            token {dialect.token_type} NOT NULL,
+            message_id BIGINT NOT NULL,
+            author_id BIGINT NOT NULL,
+            aliased_author_id BIGINT NOT NULL,
+            channel_id BIGINT NOT NULL,
+            epoch BIGINT NOT NULL,
+            is_bot BOOLEAN NOT NULL,
+            occurrences INT NOT NULL
+        """,
+        POSTINGS_KEY,
+        {
+            "idx_token_epoch": ("guild_id", "token", "epoch"),
+            "idx_message": ("guild_id", "message_id"),
+            # for the alias updates and ignore deletes, see DB.add_user_alias and DB.add_ignore
+            "idx_author": ("guild_id", "author_id"),
+            "idx_channel": ("guild_id", "channel_id"),
+        },
+    )
+
+
+def postings_insert(dialect) -> str:
+    """The statement that adds the rows of a PostingsDelta."""
+    return f"""
+        {dialect.insert_ignore} INTO {POSTINGS_TABLE} (guild_id, token, message_id, author_id, aliased_author_id,
+        channel_id, epoch, is_bot, occurrences)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);
+    """
+
+
+def postings_delete() -> str:
+    """The statement that removes the postings of a message."""
+    return f"DELETE FROM {POSTINGS_TABLE} WHERE guild_id = %s AND message_id = %s;"
+
+
+class PostingsDelta:
+    """Accumulates the changes to the postings table caused by added and removed messages.
+
+    Removed messages are deleted before the added ones are inserted, so an edit is passed as the old message removed
+    and the new one added.
+    """
+
+    def __init__(self):
+        self._removed = set()  # message ids
+        # format - (token, message_id, author_id, aliased_author_id, channel_id, epoch, is_bot, occurrences)
+        self._added = []
+
+    def __len__(self):
+        return len(self._added)
+
+    def add(self, message: MessageSnapshot, sign: int = 1, counts: TokenCounts = None):
+        """Adds a message to the delta, or removes it if sign is -1. The words are taken from counts if given."""
+        if sign < 0:
+            self._removed.add(message.message_id)
+            return
+
+        tokens = counts.get(WORD_INDEX, message.text) if counts is not None else WORD_INDEX.count(message.text)
+        aliased_author_id = message.aliased_author_id if message.aliased_author_id is not None else message.author_id
+
+        self._added.extend(
+            (token, message.message_id, message.author_id, aliased_author_id, message.channel_id, message.epoch,
+             bool(message.is_bot), occurrences)
+            for token, occurrences in tokens.items()
+        )
+
+    def update(self, other: "PostingsDelta"):
+        """Adds the changes of another delta."""
+        self._removed |= other._removed
+        self._added.extend(other._added)
+
+    def removed(self, guild_id: int) -> list[tuple]:
+        """Returns the parameters for postings_delete."""
+        return [(guild_id, message_id) for message_id in self._removed]
+
+    def rows(self, guild_id: int) -> list[tuple]:
+        """Returns the parameters for postings_insert."""
+        return [(guild_id, *row) for row in self._added]
+
+
+def postings_batch(rows) -> PostingsDelta:
+    """Returns the delta that adds the messages of rows of SNAPSHOT_COLUMNS, e.g. for a backfill."""
+    delta = PostingsDelta()
+    for row in rows:
+        delta.add(MessageSnapshot(*row))
+
+    return delta
@@ -1,12 +1,18 @@
+import asyncio
+import datetime
 import time
 from collections import Counter
 from typing import Tuple, Any
 
-import nltk
-
+from .activity import activity_heatmap, most_active_hour_and_day
 from .DB import DB
-import emoji
 from .schemas import Profile
+from .filters import MessageFilter
+from .emojis import count_emojis
+from .executor import map_batches
+from .helpers import get_top_emojis, get_top_tokens
+from .token_index import WORD_INDEX
+from .tokenizer import default_tokenizer
 
 
 async def total_message_count(db: DB, guild_id: int, user_id: int) -> int:
@@ -14,48 +20,42 @@ async def total_message_count(db: DB, guild_id: int, user_id: int) -> int:
     return await db.get_message_count(guild_id=guild_id, user_id=user_id)
 
 
+async def _iter_messages(db_or_msgs: DB | list[str], guild_id: int, user_id: int = None):
+    """Yields the message content in batches, streaming it from the DB if a DB is passed."""
+    if isinstance(db_or_msgs, DB):
+        async for batch in db_or_msgs.iter_message_content(guild_id, user_id=user_id or None):
+            yield batch
+    elif db_or_msgs:
+        yield db_or_msgs
+
+
 async def top_words(db_or_msgs: DB | list[str], guild_id: int, user_id: int = None, amount: int = 5) -> dict[str:int]:
     """Returns the n most used words in a guild."""
-
     if isinstance(db_or_msgs, DB):
-        message_content: list[str] = await db_or_msgs.get_message_content(guild_id, user_id=user_id or None)
-    else:
-        message_content = db_or_msgs
+        top = await get_top_tokens(db_or_msgs, WORD_INDEX, MessageFilter(guild_id, user_ids=user_id or None), amount)
+        return dict(top) or None
 
-    if not message_content:
-        return None
+    word_counts = Counter()
 
-    stopwords = set(nltk.corpus.stopwords.words("english"))
+    async for message_content in _iter_messages(db_or_msgs, guild_id, user_id):
+        word_counts.update(default_tokenizer.count(message_content))
 
-    all_messages = " ".join(message_content)
-    all_messages = all_messages.lower()
-
-    words = nltk.word_tokenize(all_messages)
-    words = (word for word in words if word.isalpha() and word not in stopwords)
-    word_counts = Counter(words)
+    if not word_counts:
+        return None
 
     return dict(word_counts.most_common(amount))
 
 
 async def top_emoji(db_or_msgs: DB | list[str], guild_id: int, user_id: int = None, amount: int = 5) -> dict[str:int]:
     """Returns the n most used emojis in a guild."""
-    if isinstance(db_or_msgs, DB):  # If a DB is passed, get the message content from the DB
-        message_content: list[str] = await db_or_msgs.get_message_content(guild_id=guild_id, user_id=user_id or None)
-    else:  # If a list of messages is passed, use that
-        message_content = db_or_msgs
-
-    if not message_content:
-        return None
+    if isinstance(db_or_msgs, DB):
+        return dict(await get_top_emojis(db_or_msgs, guild_id, user_id=user_id or None, amount=amount)) or None
 
-    all_messages = "".join(message_content)
-    emoji_counts = list(Counter(all_messages.split()))
+    emojis = count_emojis(db_or_msgs or [])
 
-    emojis = []
-    for block in emoji_counts:    # TODO fix this, doesnt work as intended
-        if emoji.is_emoji(block[0]):
-            emojis.append(block)
+    if not emojis:
+        return None
 
-    emojis = Counter(emojis)
     return dict(emojis.most_common(amount))
 
 
@@ -89,28 +89,39 @@ async def most_mentioned_by(db: DB, guild_id: int, user_id: int) -> tuple[Any, i
     return Counter(mentions_count).most_common(1)[0]
 
 
+async def _sum_column(db: DB, guild_id: int, user_id: int, column: str) -> int:
+    """Sums a metric column (see metrics.py) of the messages of a guild, or of a user."""
+    where, args = MessageFilter(guild_id, user_ids=user_id or None).compile()
+
+    res = await db.execute(f"SELECT SUM({column}) FROM {db.table(guild_id)} {where}", args, fetch="one")
+    return int(res[0] or 0)
+
+
 async def get_word_count(db_or_msgs: DB | list[str], guild_id: int, user_id: int) -> int:
     """Returns the number of words in a guild."""
     if isinstance(db_or_msgs, DB):
-        message_content: list[str] = await db_or_msgs.get_message_content(guild_id, user_id or None)
-    else:
-        message_content = db_or_msgs
-    all_messages = " ".join(message_content)
+        return await _sum_column(db_or_msgs, guild_id, user_id, "word_count")
+
+    words = 0
+    async for message_content in _iter_messages(db_or_msgs, guild_id, user_id):
+        all_messages = " ".join(message_content)
+        words += len(all_messages.split())
 
-    return len(all_messages.split())
+    return words
 
 
 async def get_character_count(db_or_msgs: DB | list[str], guild_id: int, user_id: int) -> int:
     """Returns the number of characters in a guild."""
     if isinstance(db_or_msgs, DB):
-        message_content: list[str] = await db_or_msgs.get_message_content(guild_id, user_id or None)
-    else:
-        message_content = db_or_msgs
+        return await _sum_column(db_or_msgs, guild_id, user_id, "char_count")
 
-    # get the number of characters in each message
-    all_messages = "".join(message_content)
+    characters = 0
+    async for message_content in _iter_messages(db_or_msgs, guild_id, user_id):
+        # get the number of characters in each message
+        all_messages = "".join(message_content)
+        characters += len(all_messages)
 
-    return len(all_messages)
+    return characters
 
 
 async def get_total_attachments(db: DB, guild_id: int, user_id: int) -> int:
@@ -118,7 +129,7 @@ async def get_total_attachments(db: DB, guild_id: int, user_id: int) -> int:
     return (
         await db.execute(
             # select sum of all values in sum_attachments column
-            f"SELECT SUM(num_attachments) FROM `{guild_id}` WHERE author_id = ?",
+            f"SELECT SUM(num_attachments) FROM {db.table(guild_id)} WHERE author_id = ?",
             (str(user_id),), fetch="one"
         )
     )[0]
@@ -127,7 +138,7 @@ async def get_total_attachments(db: DB, guild_id: int, user_id: int) -> int:
 async def get_total_embeds(db: DB, guild_id: int, user_id: int) -> int:
     return (
         await db.execute(
-            f"SELECT COUNT(has_embed) FROM `{guild_id}` WHERE author_id = ?",
+            f"SELECT COUNT(has_embed) FROM {db.table(guild_id)} WHERE author_id = ?",
             (str(user_id),), fetch="one"
         )
     )[0]
@@ -137,7 +148,7 @@ async def is_bot(db: DB, guild_id: int, user_id: int) -> bool:
     """Returns whether a user is a bot or not."""
     return (
         await db.execute(
-            f"SELECT is_bot FROM `{guild_id}` WHERE author_id = ? LIMIT 1", 
+            f"SELECT is_bot FROM {db.table(guild_id)} WHERE author_id = ? LIMIT 1", 
             (str(user_id),), fetch="one"
         )
     )[0]
@@ -145,35 +156,112 @@ async def is_bot(db: DB, guild_id: int, user_id: int) -> bool:
 async def get_notnull_message_count(db: DB, guild_id: int, user_id: int):
     return (
         await db.execute(
-            f"SELECT count(*) FROM `{guild_id}` WHERE author_id = ? AND message_content IS NOT NULL AND message_content != ''",
+            f"SELECT count(*) FROM {db.table(guild_id)} WHERE author_id = ? AND message_content IS NOT NULL AND message_content != ''",
             (str(user_id),), fetch="one"
         )
     )[0]
     
 
-async def build_profile(db: DB, guild_id: int, user_id: int) -> Profile:
-    """Builds the profile for a certain user, in a certain guild."""
+async def _profile_stats(db: DB, guild_id: int, user_id: int) -> tuple:
+    """Returns whether a user is a bot, and their number of messages, messages with content, embeds and attachments,
+    in one aggregate query."""
+    where, args = MessageFilter(guild_id, user_ids=user_id).compile()
+    int_type = db.dialect.int_type
+
+    return await db.execute(
+        f"""
+            SELECT 
+                MAX(CASE WHEN is_bot THEN 1 ELSE 0 END), 
+                COUNT(*), 
+                CAST(SUM(CASE WHEN message_content IS NOT NULL AND message_content != '' THEN 1 ELSE 0 END) AS {int_type}), 
+                CAST(SUM(CASE WHEN has_embed THEN 1 ELSE 0 END) AS {int_type}), 
+                CAST(SUM(num_attachments) AS {int_type}) 
+            FROM 
+                {db.table(guild_id)} 
+            {where}
+        """, args, fetch="one"
+    )
+
+
+def _content_stats(messages) -> tuple[int, int, Counter, Counter, tuple]:
+    """Returns the number of words and characters of a batch of messages, how often every word and emoji occurs in
+    them, and the stats of the tokenizer cache, see Tokenizer.count_batch."""
+    messages = list(messages)
+    word_counts, cache_stats = default_tokenizer.count_batch(messages)
+
+    return (
+        sum(len(message.split()) for message in messages),
+        sum(map(len, messages)),
+        word_counts,
+        count_emojis(messages),
+        cache_stats,
+    )
+
+
+async def _profile_content(db: DB, guild_id: int, user_id: int, batch_size: int) -> tuple[int, int, Counter, Counter]:
+    """Streams the content of a user's messages through the worker processes once, returning their number of words
+    and characters, and how often every word and emoji occurs in them."""
+    words, characters = 0, 0
+    word_counts, emoji_counts = Counter(), Counter()
+
+    batches = db.iter_message_content(guild_id, user_id=user_id, batch_size=batch_size)
+    async for batch_words, batch_characters, batch_word_counts, batch_emoji_counts, cache_stats in map_batches(
+            _content_stats, batches, shared_memory=True
+    ):
+        words += batch_words
+        characters += batch_characters
+        word_counts.update(batch_word_counts)
+        emoji_counts.update(batch_emoji_counts)
+        default_tokenizer.merge_stats(cache_stats)
+
+    return words, characters, word_counts, emoji_counts
+
+
+async def _timed(timings: dict, stage: str, coro):
+    """Awaits coro, recording how long it took in timings[stage]."""
+    start = time.perf_counter()
+    try:
+        return await coro
+    finally:
+        timings[stage] = time.perf_counter() - start
+
+
+async def build_profile(db: DB, guild_id: int, user_id: int, batch_size: int = 10000) -> Profile:
+    """Builds the profile for a certain user, in a certain guild.
+
+    The scalar stats, the content of the messages and the activity heatmap are each read in one pass, concurrently.
+    How long every stage took is recorded in profile.timings.
+    """
     start_time = time.time()
 
     profile = Profile()
 
     profile.user_id = user_id
     profile.guild_id = guild_id
-    profile.is_bot = await is_bot(db, guild_id, user_id)
-
-    msg_list = await db.get_message_content(guild_id, user_id=user_id)
-
-    profile.messages = await total_message_count(db, guild_id, user_id)
-    profile.words = await get_word_count(msg_list, guild_id, user_id)
-    profile.characters = await get_character_count(msg_list, guild_id, user_id)
-    profile.average_msg_length = profile.characters / await get_notnull_message_count(db, guild_id, user_id)
-
-    profile.total_embeds = await get_total_embeds(db, guild_id, user_id)
-
-    profile.total_attachments = int(await get_total_attachments(db, guild_id, user_id))
-    profile.top_words = await top_words(msg_list, guild_id, user_id)
 
-    profile.top_emojis = await top_emoji(msg_list, guild_id, user_id)
+    # the most active hour and day are in the guild's timezone
+    timezone = await db.get_timezone(guild_id)
+    if timezone is not None:
+        timezone = datetime.timezone(datetime.timedelta(hours=int(timezone)))
+
+    stats, content, heatmap = await asyncio.gather(
+        _timed(profile.timings, "stats", _profile_stats(db, guild_id, user_id)),
+        _timed(profile.timings, "content", _profile_content(db, guild_id, user_id, batch_size)),
+        _timed(profile.timings, "heatmap", activity_heatmap(db, guild_id, user_id, timezone=timezone)),
+    )
+
+    is_bot_, messages, non_empty_messages, embeds, attachments = stats
+    profile.is_bot = bool(is_bot_)
+    profile.messages = messages
+    profile.total_embeds = int(embeds or 0)
+    profile.total_attachments = int(attachments or 0)
+
+    profile.words, profile.characters, word_counts, emoji_counts = content
+    profile.average_msg_length = profile.characters / non_empty_messages if non_empty_messages else 0
+    profile.top_words = dict(word_counts.most_common(5)) or None
+    profile.top_emojis = dict(emoji_counts.most_common(5)) or None
+
+    profile.most_active_hour, profile.most_active_day = most_active_hour_and_day(heatmap)
 
     # most_mentioned_ = await most_mentioned(db, guild_id, user_id)
     # profile.total_mentions = len(most_mentioned_)
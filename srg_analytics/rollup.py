@@ -0,0 +1,92 @@
+"""Hourly pre-aggregates of the guild tables, maintained at ingestion time."""
+
+from typing import NamedTuple
+
+from .schemas import Message
+
+ROLLUP_TABLE = "message_rollup"
+ROLLUP_KEY = ("guild_id", "hour_bucket", "channel_id", "author_id")
+HOUR = 3600
+
+# the columns of a guild table needed to maintain everything derived from a message
+SNAPSHOT_COLUMNS = "message_id, channel_id, author_id, aliased_author_id, message_content, epoch, is_bot, num_attachments"
+
+
+class MessageSnapshot(NamedTuple):
+    message_id: int
+    channel_id: int
+    author_id: int
+    aliased_author_id: int | None
+    message_content: str | bytes | None
+    epoch: int
+    is_bot: bool
+    num_attachments: int
+
+    @classmethod
+    def from_message(cls, message: Message) -> "MessageSnapshot":
+        return cls(
+            message.message_id,
+            message.channel_id,
+            message.author_id,
+            message.aliased_author_id,
+            message.message_content,
+            message.epoch,
+            message.is_bot,
+            message.num_attachments,
+        )
+
+    @property
+    def text(self) -> str:
+        """The message content as a string, empty if there is none."""
+        if self.message_content is None:
+            return ""
+        if isinstance(self.message_content, bytes):
+            return self.message_content.decode("utf-8", errors="replace")
+        return self.message_content
+
+
+def hour_bucket(epoch: int | float) -> int:
+    """Returns the epoch of the start of the (UTC) hour an epoch falls into."""
+    return int(epoch) // HOUR * HOUR
+
+
+class RollupDelta:
+    """Accumulates the changes to the rollup table caused by added and removed messages."""
+
+    def __init__(self):
+        # format - (hour_bucket, channel_id, author_id): [aliased_author_id, is_bot, messages, words, chars, attachments]
+        self._deltas = {}
+
+    def __len__(self):
+        return len(self._deltas)
+
+    def add(self, message: MessageSnapshot, sign: int = 1):
+        """Adds a message to the delta, or removes it if sign is -1."""
+        key = (hour_bucket(message.epoch), message.channel_id, message.author_id)
+        aliased_author_id = message.aliased_author_id if message.aliased_author_id is not None else message.author_id
+
+        delta = self._deltas.setdefault(key, [aliased_author_id, bool(message.is_bot), 0, 0, 0, 0])
+        text = message.text
+
+        delta[2] += sign
+        delta[3] += sign * len(text.split())
+        delta[4] += sign * len(text)
+        delta[5] += sign * (message.num_attachments or 0)
+
+    def rows(self, guild_id: int) -> list[tuple]:
+        """Returns the parameters for rollup_upsert, skipping keys whose changes cancel out."""
+        return [
+            (guild_id, *key, *delta)
+            for key, delta in self._deltas.items()
+            if any(delta[2:])
+        ]
+
+
+def rollup_upsert(dialect) -> str:
+    """The statement that adds the rows of a RollupDelta onto the rollup table."""
+    return f"""
+        INSERT INTO {ROLLUP_TABLE} (guild_id, hour_bucket, channel_id, author_id, aliased_author_id, is_bot,
+        message_count, word_count, char_count, attachments)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        {dialect.on_conflict(ROLLUP_KEY, add=("message_count", "word_count", "char_count", "attachments"))};
+    """
@@ -45,6 +45,26 @@ class Message:
         self.reactions = reactions
 
 
+class MessageEdit:
+    def __init__(
+        self,
+        message_id,
+        message_content,
+        edit_epoch,
+        user_mentions,
+        channel_mentions,
+        role_mentions,
+        num_attachments
+    ):
+        self.message_id: int = message_id
+        self.message_content: str or None = message_content
+        self.edit_epoch: int = edit_epoch
+        self.user_mentions = user_mentions
+        self.channel_mentions = channel_mentions
+        self.role_mentions = role_mentions
+        self.num_attachments: int = num_attachments
+
+
 class Profile:
     def __init__(self) -> None:
         # Discord IDs
@@ -72,3 +92,24 @@ class Profile:
         self.most_active_hour = None
         self.most_active_day = None
 
+        # stage: seconds it took to build, see build_profile
+        self.timings: dict[str, float] = {}
+
+
+
+class LetterLeaderboard:
+    def __init__(self, counts: dict[str, int], user_rank: int = None, ranked_users: int = None) -> None:
+        # letter: count, most common first
+        self.counts: dict[str, int] = dict(sorted(counts.items(), key=lambda item: (-item[1], item[0])))
+        self.total: int = sum(self.counts.values())
+
+        # letter: share of all the letters, in percent
+        self.percentages: dict[str, float] = {
+            letter: count / self.total * 100 for letter, count in self.counts.items()
+        }
+        # letter: rank, 1 being the most common letter
+        self.ranks: dict[str, int] = {letter: rank for rank, letter in enumerate(self.counts, start=1)}
+
+        # rank of the user among the ranked_users of the guild by number of letters, when the leaderboard is of a user
+        self.user_rank: int = user_rank
+        self.ranked_users: int = ranked_users
@@ -0,0 +1,148 @@
+"""Cache of the closed buckets of the activity series, see activity.py."""
+
+from collections import OrderedDict
+
+from .buckets import TimeBuckets
+from .filters import MessageFilter
+
+
+class SeriesCache:
+    """Per bucket results of the activity queries, keyed by (guild, filter, bucket size, UTC offset).
+
+    Only closed buckets - ones that ended before they were queried - are kept, the current one still changes. A bucket
+    is invalidated when a message of it is added, edited or removed afterwards, see DB._invalidate_series, so writes made
+    through other DB instances (e.g. another process) are not seen. At most `maxsize` series are kept, least recently
+    used first out.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+
+        # format - key: {SQL bucket: rows of the bucket}
+        self._series = OrderedDict()
+        # format - guild_id: [number of epochs no longer logged, epochs invalidated since]
+        # results are stored without the buckets invalidated while they were being computed
+        self._invalidations = {}
+        self._clears = 0  # number of times everything was dropped
+
+        # cache metrics, see cache_stats
+        self._hits = 0  # closed buckets served from the cache
+        self._misses = 0  # closed buckets queried
+        self._open = 0  # open buckets queried
+
+    @staticmethod
+    def key(message_filter: MessageFilter, buckets: TimeBuckets, by_user: bool = False) -> tuple:
+        """The series of a filter (but its time window) bucketed like `buckets`."""
+        return (
+            message_filter.guild_id, message_filter.channel_ids, message_filter.user_ids, message_filter.aliased,
+            message_filter.exclude_bots, message_filter.non_empty, buckets.seconds, buckets.offset, by_user,
+        )
+
+    def generation(self, guild_id: int) -> tuple[int, int]:
+        """Read before computing results to put."""
+        dropped, epochs = self._invalidations.get(guild_id, (0, ()))
+        return self._clears, dropped + len(epochs)
+
+    def get(self, key: tuple, buckets: range) -> tuple[dict[int, list], list[int]]:
+        """Returns the cached rows of the buckets, and the buckets that are not cached."""
+        series = self._series.get(key)
+        if series is None:
+            return {}, list(buckets)
+
+        self._series.move_to_end(key)
+
+        cached = {}
+        missing = []
+        for bucket in buckets:
+            rows = series.get(bucket)
+            if rows is None:
+                missing.append(bucket)
+            else:
+                cached[bucket] = rows
+
+        return cached, missing
+
+    def put(self, key: tuple, generation: tuple[int, int], rows_by_bucket: dict[int, list]):
+        """Stores the rows of closed buckets, leaving out the ones invalidated since `generation` was read."""
+        clears, position = generation
+        dropped, epochs = self._invalidations.get(key[0], (0, []))
+
+        if clears != self._clears or position < dropped:
+            return
+
+        seconds, offset = key[6], key[7]
+        late = {(epoch + offset) // seconds for epoch in epochs[position - dropped:]}
+
+        series = self._series.setdefault(key, {})
+        series.update((bucket, rows) for bucket, rows in rows_by_bucket.items() if bucket not in late)
+        self._series.move_to_end(key)
+
+        while len(self._series) > self.maxsize:
+            self._series.popitem(last=False)
+
+    def count(self, hits: int = 0, misses: int = 0, open_: int = 0):
+        self._hits += hits
+        self._misses += misses
+        self._open += open_
+
+    def invalidate(self, guild_id: int, epochs):
+        """Drops the buckets of a guild the epochs fall into."""
+        epochs = set(epochs)
+        if not epochs:
+            return
+
+        self._log(guild_id, epochs)
+
+        for key, series in self._series.items():
+            if key[0] != guild_id:
+                continue
+
+            seconds, offset = key[6], key[7]
+            for epoch in epochs:
+                series.pop((epoch + offset) // seconds, None)
+
+    def _log(self, guild_id: int, epochs):
+        invalidations = self._invalidations.setdefault(guild_id, [0, []])
+        invalidations[1].extend(epochs)
+
+        # results still being computed from before are not stored at all once their invalidations are forgotten
+        if len(invalidations[1]) > 10000:
+            invalidations[0] += len(invalidations[1])
+            invalidations[1] = []
+
+    def clear(self, guild_id: int = None):
+        """Drops everything cached of a guild, or of all guilds."""
+        if guild_id is None:
+            self._series.clear()
+            self._clears += 1
+            return
+
+        invalidations = self._invalidations.setdefault(guild_id, [0, []])
+        invalidations[0] += len(invalidations[1]) + 1
+        invalidations[1] = []
+
+        for key in [key for key in self._series if key[0] == guild_id]:
+            del self._series[key]
+
+    def cache_stats(self, reset: bool = False) -> dict:
+        """Returns how many buckets were served from the cache, and how many had to be queried.
+
+        Pass reset=True to start measuring afresh after reading them.
+        """
+        closed = self._hits + self._misses
+
+        stats = {
+            "series": len(self._series),
+            "buckets": sum(len(series) for series in self._series.values()),
+            "hits": self._hits,
+            "misses": self._misses,
+            "open": self._open,
+            "hit_rate": self._hits / closed if closed else 0.0,
+        }
+
+        if reset:
+            self._hits = 0
+            self._misses = 0
+            self._open = 0
+
+        return stats
@@ -0,0 +1,131 @@
+"""Bounded memory approximate counting, for top-k queries over more distinct items than fit in memory."""
+
+import heapq
+import math
+from collections import Counter
+
+
+class SpaceSaving:
+    """Space-Saving summary of the counts of a stream of items, keeping at most `capacity` items.
+
+    Every kept count overestimates the true count by at most its error. Built with update(), no error is more than
+    total / capacity, so any item occurring more often than that is guaranteed to be kept. Summaries are mergeable,
+    e.g. of different guilds or time ranges.
+    """
+
+    def __init__(self, capacity: int):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+
+        self.capacity = capacity
+        self.total = 0  # number of occurrences summarized
+        self._counts: dict = {}  # item: (over)estimated count
+        self._errors: dict = {}  # item: how much of its count may be overestimated
+        self._heap: list = []  # (count, item), with stale entries left in until they reach the top
+
+    @classmethod
+    def for_error(cls, error: float) -> "SpaceSaving":
+        """Returns a summary whose counts are off by at most `error` times the total, e.g. 0.001 for 0.1%."""
+        if not 0 < error < 1:
+            raise ValueError("error must be between 0 and 1")
+
+        return cls(math.ceil(1 / error))
+
+    @classmethod
+    def from_counts(cls, counts: Counter, capacity: int) -> "SpaceSaving":
+        """Returns a summary of exact counts."""
+        summary = cls(capacity)
+        summary.update(counts)
+
+        return summary
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __repr__(self):
+        return f"SpaceSaving(capacity={self.capacity}, total={self.total}, items={len(self)})"
+
+    def __getstate__(self):
+        # the heap can be rebuilt from the counts, leave it out of what is sent between processes
+        return {**self.__dict__, "_heap": []}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._heap = [(count, item) for item, count in self._counts.items()]
+        heapq.heapify(self._heap)
+
+    @property
+    def error_bound(self) -> int:
+        """The most a kept count can be overestimated by, and the most an item that was not kept can have occurred."""
+        return max(max(self._errors.values(), default=0), self._min_count())
+
+    def _min_count(self) -> int:
+        # an item that is not kept may have occurred up to this many times
+        return min(self._counts.values()) if len(self._counts) >= self.capacity else 0
+
+    def _pop_min(self):
+        """Removes the item with the lowest count, returning it and its count."""
+        while True:
+            count, item = heapq.heappop(self._heap)
+            if self._counts.get(item) == count:
+                del self._counts[item]
+                del self._errors[item]
+                return item, count
+
+    def _add(self, item, count: int, error: int = 0):
+        if item in self._counts:
+            self._counts[item] += count
+            self._errors[item] += error
+        elif len(self._counts) < self.capacity:
+            self._counts[item] = count
+            self._errors[item] = error
+        else:
+            # the new item takes the place of the least counted one, which it may have been all along
+            _, min_count = self._pop_min()
+            self._counts[item] = min_count + count
+            self._errors[item] = min_count + error
+
+        heapq.heappush(self._heap, (self._counts[item], item))
+
+        # drop the stale entries every so often, so the heap stays in proportion to the capacity
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(count_, item_) for item_, count_ in self._counts.items()]
+            heapq.heapify(self._heap)
+
+    def update(self, counts: Counter):
+        """Adds exact counts, e.g. of one batch of messages. The most common items are added first, so they are the
+        ones that are kept when the batch does not fit."""
+        for item, count in sorted(counts.items(), key=lambda item: item[1], reverse=True):
+            self._add(item, count)
+
+        self.total += sum(counts.values())
+
+    def merge(self, other: "SpaceSaving"):
+        """Adds another summary into this one. An item missing from either summary may have occurred up to that
+        summary's lowest count, which is added to its count and error."""
+        own_min = self._min_count()
+        other_min = other._min_count()
+
+        merged = {
+            item: (
+                self._counts.get(item, own_min) + other._counts.get(item, other_min),
+                self._errors.get(item, own_min) + other._errors.get(item, other_min),
+            )
+            for item in self._counts.keys() | other._counts.keys()
+        }
+        kept = heapq.nlargest(self.capacity, merged.items(), key=lambda item: item[1][0])
+
+        self._counts = {item: count for item, (count, _) in kept}
+        self._errors = {item: error for item, (_, error) in kept}
+        self._heap = [(count, item) for item, count in self._counts.items()]
+        heapq.heapify(self._heap)
+        self.total += other.total
+
+    def top(self, amount: int = 10) -> list[tuple]:
+        """Returns the most common items as (item, estimated count, max error) tuples, most common first. The true
+        count of an item is between the estimated count minus the max error and the estimated count."""
+        return [
+            (item, count, self._errors[item])
+            for item, count in heapq.nlargest(amount, self._counts.items(), key=lambda item: item[1])
+        ]
+
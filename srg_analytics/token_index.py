@@ -0,0 +1,137 @@
+"""Per-user and per-channel token counts (e.g. words), maintained at ingestion time."""
+
+from collections import Counter
+
+from .rollup import MessageSnapshot
+from .tokenizer import default_tokenizer
+
+TOKEN_INDEX_KEY = ("guild_id", "author_id", "channel_id", "token")
+TOKEN_LENGTH = 191  # longest token that fits the key, longer ones are cut
+
+
+class TokenIndex:
+    """A table of how often every token of the messages occurs, per guild, author and channel.
+
+    `extract` returns the tokens of a message's content, one entry per occurrence. It has to be picklable, so that
+    backfills can run it in the worker processes.
+    """
+
+    def __init__(self, table: str, extract):
+        self.table = table
+        self.extract = extract
+
+    def __repr__(self):
+        return f"TokenIndex({self.table})"
+
+    def create_table(self, dialect) -> list[str]:
+        return dialect.create_table(
+            self.table,
+            f"""
+                guild_id BIGINT NOT NULL,
+                author_id BIGINT NOT NULL,
+                channel_id BIGINT NOT NULL,
+                token {dialect.token_type} NOT NULL,
+                aliased_author_id BIGINT NOT NULL,
+                is_bot BOOLEAN NOT NULL,
+                occurrences BIGINT NOT NULL DEFAULT 0
+            """,
+            TOKEN_INDEX_KEY,
+            {
+                "idx_aliased_author": ("guild_id", "aliased_author_id"),
+                "idx_channel": ("guild_id", "channel_id"),
+            },
+        )
+
+    def upsert(self, dialect) -> str:
+        """The statement that adds the rows of a TokenDelta onto the table."""
+        return f"""
+            INSERT INTO {self.table} (guild_id, author_id, channel_id, token, aliased_author_id, is_bot, occurrences)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            {dialect.on_conflict(TOKEN_INDEX_KEY, add=("occurrences",))};
+        """
+
+    def prune(self) -> str:
+        """The statement that deletes a row of the table once nothing is counted in it anymore."""
+        return f"""
+            DELETE FROM {self.table}
+            WHERE guild_id = %s AND author_id = %s AND channel_id = %s AND token = %s AND occurrences <= 0;
+        """
+
+    def count(self, text: str) -> Counter:
+        """Returns how often every token occurs in a message's content, cut to TOKEN_LENGTH."""
+        return Counter(token[:TOKEN_LENGTH] for token in self.extract(text))
+
+    def delta(self, rows) -> "TokenDelta":
+        """Returns the delta that adds the messages of rows of SNAPSHOT_COLUMNS, e.g. for a backfill."""
+        delta = TokenDelta(self)
+        for row in rows:
+            delta.add(MessageSnapshot(*row))
+
+        return delta
+
+
+class TokenDelta:
+    """Accumulates the changes to a TokenIndex caused by added and removed messages."""
+
+    def __init__(self, index: TokenIndex):
+        self.index = index
+
+        # format - (author_id, channel_id, token): occurrences
+        self._deltas = Counter()
+        # format - (author_id, channel_id): (aliased_author_id, is_bot)
+        self._authors = {}
+
+    def __len__(self):
+        return len(self._deltas)
+
+    def add(self, message: MessageSnapshot, sign: int = 1, counts: "TokenCounts" = None):
+        """Adds a message to the delta, or removes it if sign is -1. The tokens are taken from counts if given."""
+        tokens = counts.get(self.index, message.text) if counts is not None else self.index.count(message.text)
+        if not tokens:
+            return
+
+        aliased_author_id = message.aliased_author_id if message.aliased_author_id is not None else message.author_id
+        self._authors.setdefault((message.author_id, message.channel_id), (aliased_author_id, bool(message.is_bot)))
+
+        for token, occurrences in tokens.items():
+            self._deltas[(message.author_id, message.channel_id, token)] += sign * occurrences
+
+    def update(self, other: "TokenDelta"):
+        """Adds the changes of another delta of the same index."""
+        self._deltas.update(other._deltas)
+        for key, author in other._authors.items():
+            self._authors.setdefault(key, author)
+
+    def rows(self, guild_id: int) -> list[tuple]:
+        """Returns the parameters for TokenIndex.upsert, skipping tokens whose changes cancel out."""
+        return [
+            (guild_id, author_id, channel_id, token, *self._authors[(author_id, channel_id)], occurrences)
+            for (author_id, channel_id, token), occurrences in self._deltas.items()
+            if occurrences
+        ]
+
+    def pruned(self, guild_id: int) -> list[tuple]:
+        """Returns the parameters for TokenIndex.prune, for the tokens that were removed from."""
+        return [(guild_id, *key) for key, occurrences in self._deltas.items() if occurrences < 0]
+
+
+class TokenCounts:
+    """The token counts of the messages of one write, computed once per index and content and shared by everything
+    that is derived from them - the token indexes, the postings and the metrics."""
+
+    def __init__(self):
+        # format - (table, content): Counter of the tokens
+        self._counts = {}
+
+    def get(self, index: TokenIndex, text: str) -> Counter:
+        """Returns TokenIndex.count of the content. The Counter is shared, so it must not be modified."""
+        key = (index.table, text)
+
+        counts = self._counts.get(key)
+        if counts is None:
+            counts = self._counts[key] = index.count(text)
+
+        return counts
+
+
+WORD_INDEX = TokenIndex("word_index", default_tokenizer.tokenize)
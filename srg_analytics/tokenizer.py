@@ -0,0 +1,176 @@
+"""Regex based word tokenizer, shared by all the word based analysis functions."""
+
+import re
+from collections import Counter, OrderedDict
+
+# the english stopword list of nltk, embedded so it does not need to be downloaded
+STOPWORDS = frozenset((
+    "i", "me", "my", "myself", "we", "our", "ours", "ourselves", "you", "you're", "you've", "you'll", "you'd", "your",
+    "yours", "yourself", "yourselves", "he", "him", "his", "himself", "she", "she's", "her", "hers", "herself", "it",
+    "it's", "its", "itself", "they", "them", "their", "theirs", "themselves", "what", "which", "who", "whom", "this",
+    "that", "that'll", "these", "those", "am", "is", "are", "was", "were", "be", "been", "being", "have", "has", "had",
+    "having", "do", "does", "did", "doing", "a", "an", "the", "and", "but", "if", "or", "because", "as", "until",
+    "while", "of", "at", "by", "for", "with", "about", "against", "between", "into", "through", "during", "before",
+    "after", "above", "below", "to", "from", "up", "down", "in", "out", "on", "off", "over", "under", "again",
+    "further", "then", "once", "here", "there", "when", "where", "why", "how", "all", "any", "both", "each", "few",
+    "more", "most", "other", "some", "such", "no", "nor", "not", "only", "own", "same", "so", "than", "too", "very",
+    "s", "t", "can", "will", "just", "don", "don't", "should", "should've", "now", "d", "ll", "m", "o", "re", "ve",
+    "y", "ain", "aren", "aren't", "couldn", "couldn't", "didn", "didn't", "doesn", "doesn't", "hadn", "hadn't", "hasn",
+    "hasn't", "haven", "haven't", "isn", "isn't", "ma", "mightn", "mightn't", "mustn", "mustn't", "needn", "needn't",
+    "shan", "shan't", "shouldn", "shouldn't", "wasn", "wasn't", "weren", "weren't", "won", "won't", "wouldn",
+    "wouldn't",
+))
+
+# everything that is skipped as a whole comes first in the alternation, so it is consumed before a word can match
+# inside it; only words are captured
+_TOKEN_PATTERN = re.compile(
+    r"```.*?(?:```|$)"            # code blocks, also unterminated ones
+    r"|`[^`\n]*`"                 # inline code
+    r"|<a?:\w+:\d+>"              # custom emojis - <:name:id>, <a:name:id>
+    r"|<(?:@[!&]?|#)\d+>"         # user, role and channel mentions
+    r"|(?:https?://|www\.)\S+"    # urls
+    r"|([^\W\d_]+)",              # words - runs of letters, in any script
+    re.DOTALL,
+)
+
+
+class Tokenizer:
+    """Splits messages into lowercase words, leaving out stopwords, words shorter than `min_length`, and code blocks,
+    urls, mentions and custom emojis.
+
+    count() tokenizes every distinct message of a batch once, and keeps the words of the last `cache_size`
+    distinct messages (by hash) to reuse across batches, as the same messages ("lol", "gm", spam, bot commands) come up
+    again and again.
+
+    Instances can be passed to worker processes. The cache is not, except for default_tokenizer, which is looked up in
+    the worker itself, so its cache lasts as long as the worker.
+    """
+
+    def __init__(self, stopwords: frozenset[str] = STOPWORDS, min_length: int = 2, cache_size: int = 10000):
+        self.stopwords = frozenset(stopwords)
+        self.min_length = min_length
+        self.cache_size = cache_size
+
+        # format - hash of the message: its words, least recently used first
+        self._cache = OrderedDict()
+
+        # cache metrics, see cache_stats
+        self._messages = 0
+        self._duplicates = 0  # repeats of a message within a batch
+        self._hits = 0  # distinct messages of a batch found in the cache
+        self._misses = 0  # distinct messages that were tokenized
+
+    def __reduce_ex__(self, protocol):
+        if self is default_tokenizer:
+            return "default_tokenizer"
+        return super().__reduce_ex__(protocol)
+
+    def __getstate__(self):
+        return {"stopwords": self.stopwords, "min_length": self.min_length, "cache_size": self.cache_size}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def tokenize(self, message: str | bytes | None) -> list[str]:
+        """Returns the words of a message."""
+        if not message:
+            return []
+        if isinstance(message, bytes):
+            message = message.decode("utf-8", errors="replace")
+
+        stopwords = self.stopwords
+        min_length = self.min_length
+
+        return [
+            word for word in _TOKEN_PATTERN.findall(message.lower())
+            if len(word) >= min_length and word not in stopwords
+        ]
+
+    def words(self, messages) -> list[str]:
+        """Returns the words of all the messages, in order."""
+        words = []
+        for message in messages:
+            words.extend(self.tokenize(message))
+
+        return words
+
+    def count(self, messages) -> Counter:
+        """Returns how often every word occurs in the messages."""
+        return self.count_batch(messages)[0]
+
+    def count_batch(self, messages) -> tuple[Counter, tuple[int, int, int, int]]:
+        """Returns how often every word occurs in the messages, along with what the cache saved counting them, to pass
+        to merge_stats of the tokenizer in the main process when this runs in a worker."""
+        counts = Counter()
+        words_once = []  # words of the messages that occur once, counted together at the end
+        cache = self._cache
+        stats = [0, 0, 0, 0]  # messages, duplicates, hits, misses
+
+        for message, multiplicity in Counter(messages).items():
+            stats[0] += multiplicity
+            stats[1] += multiplicity - 1
+
+            if not message:
+                continue
+
+            key = hash(message)
+            words = cache.get(key)
+
+            if words is None:
+                stats[3] += 1
+                words = tuple(self.tokenize(message))
+
+                if self.cache_size:
+                    cache[key] = words
+                    if len(cache) > self.cache_size:
+                        cache.popitem(last=False)
+            else:
+                stats[2] += 1
+                cache.move_to_end(key)
+
+            if multiplicity == 1:
+                words_once.extend(words)
+            else:
+                for word in words:
+                    counts[word] += multiplicity
+
+        counts.update(words_once)
+        self.merge_stats(stats)
+
+        return counts, tuple(stats)
+
+    def merge_stats(self, stats: tuple[int, int, int, int]):
+        """Adds the stats returned by count_batch, e.g. from a worker process."""
+        self._messages += stats[0]
+        self._duplicates += stats[1]
+        self._hits += stats[2]
+        self._misses += stats[3]
+
+    def cache_stats(self, reset: bool = False) -> dict:
+        """Returns how many of the counted messages were tokenized, and how many were saved by deduplicating the
+        batches and by the cache.
+
+        Pass reset=True to start measuring afresh after reading them.
+        """
+        saved = self._duplicates + self._hits
+
+        stats = {
+            "messages": self._messages,
+            "duplicates": self._duplicates,
+            "hits": self._hits,
+            "misses": self._misses,
+            "cache_hit_rate": self._hits / (self._hits + self._misses) if self._hits + self._misses else 0.0,
+            "saved_rate": saved / self._messages if self._messages else 0.0,
+            "cache_size": len(self._cache),
+        }
+
+        if reset:
+            self._messages = 0
+            self._duplicates = 0
+            self._hits = 0
+            self._misses = 0
+
+        return stats
+
+
+default_tokenizer = Tokenizer()
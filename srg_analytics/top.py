@@ -4,14 +4,15 @@ import time
 
 import matplotlib.pyplot as plt
 import mplcyberpunk
-from collections import Counter
 
 from .DB import DB
-from .helpers import get_top_users_by_words, get_top_channels_by_words
+from .filters import MessageFilter
+from .rollup import ROLLUP_TABLE
+from .helpers import _sum_metric, get_top_users_by_words, get_top_channels_by_words
 
 
 async def get_top_users(db: DB, guild_id: int, type_: str, amount: int = 10, timeperiod: str = None,
-                        count_others: bool = True):
+                        count_others: bool = True, message_filter: MessageFilter = None):
     # type_ can be either "messages" or "words" or "characters"
     # time_duration can be either "day" or "week" or "month" or "year" or None
 
@@ -19,7 +20,7 @@ async def get_top_users(db: DB, guild_id: int, type_: str, amount: int = 10, tim
         raise ValueError("time_duration must be either 'day' or 'week' or 'month' or 'year' or None")
     else:
         timezone = await db.get_timezone(guild_id=guild_id)
-        if not timezone:
+        if timezone is None:
             timezone = datetime.timezone(datetime.timedelta(hours=3))
         else:
             timezone = datetime.timezone(datetime.timedelta(hours=int(timezone)))
@@ -40,24 +41,13 @@ async def get_top_users(db: DB, guild_id: int, type_: str, amount: int = 10, tim
     else:
         epoch_start = None
 
-    if type_ == "messages":
-        query = f"""
-                SELECT aliased_author_id, COUNT(aliased_author_id) AS count
-                FROM `{guild_id}`
-                WHERE is_bot = 0
-            """
-        if epoch_start is not None:
-            query += f"AND epoch >= {epoch_start.timestamp()}"
-
-        query += """
-                GROUP BY aliased_author_id
-                ORDER BY count DESC
-                """
+    message_filter = (message_filter or MessageFilter(guild_id)).replace(exclude_bots=True)
+    if epoch_start is not None:
+        message_filter = message_filter.replace(since=epoch_start.timestamp())
 
-        if not count_others:
-            query += f"LIMIT {amount}"
-
-        top = await db.execute(query, fetch="all")
+    if type_ == "messages":
+        top = await _top_from_rollup(db, message_filter, "aliased_author_id", "message_count",
+                                     None if count_others else amount)
 
         if count_others:
             return [*top[:amount], ('others', sum([i[1] for i in top[amount:]]))]
@@ -65,32 +55,44 @@ async def get_top_users(db: DB, guild_id: int, type_: str, amount: int = 10, tim
             return top[:amount]
 
     elif type_ == "words":
-        if epoch_start is not None:
-            res = await get_top_users_by_words(db=db, guild_id=guild_id, amount=amount,
-                                               start_epoch=epoch_start.timestamp(), count_others=count_others)
-        else:
-            res = await get_top_users_by_words(db=db, guild_id=guild_id, amount=amount, count_others=count_others)
-
-        return res
+        return await get_top_users_by_words(db=db, guild_id=guild_id, amount=amount, count_others=count_others,
+                                            message_filter=message_filter)
 
     elif type_ == "characters":
-        query = f"""
-                SELECT aliased_author_id, SUM(CHAR_LENGTH(message_content)) AS count
-                FROM `{guild_id}`
-                WHERE is_bot = 0
-            """
+        top = await _top_from_rollup(db, message_filter, "aliased_author_id", "char_count")
 
-        if timeperiod is not None:
-            query += f"AND epoch >= {epoch_start.timestamp()}"
+        return top[:amount]
 
-        query += """
-                GROUP BY aliased_author_id
-                ORDER BY count DESC
-                """
 
-        top = await db.execute(query, fetch="all")
+# format - rollup column: the per-message value it sums in the guild tables
+_GUILD_TABLE_COLUMNS = {"message_count": "1", "char_count": "char_count"}
 
-        return top[:amount]
+
+async def _top_from_rollup(db: DB, message_filter: MessageFilter, group_by: str, column: str, amount: int = None):
+    """Sums a column of the rollups per user or channel, in descending order.
+
+    The rollups do not track message content, so non_empty filters are counted from the guild table instead.
+    """
+    if message_filter.non_empty:
+        where, args = message_filter.compile()
+        table = db.table(message_filter.guild_id)
+        group_by = "COALESCE(aliased_author_id, author_id)" if group_by == "aliased_author_id" else group_by
+        column = _GUILD_TABLE_COLUMNS[column]
+    else:
+        where, args = message_filter.compile_rollup()
+        table = ROLLUP_TABLE
+
+    query = f"""
+            SELECT {group_by}, CAST(SUM({column}) AS {db.dialect.int_type}) AS count
+            FROM {table} {where}
+            GROUP BY {group_by}
+            ORDER BY count DESC
+            """
+
+    if amount is not None:
+        query += f"LIMIT {int(amount)}"
+
+    return await db.execute(query, args, fetch="all")
 
 
 async def get_top_users_visual(db: DB, guild_id: int, client, type_: str, timeperiod: str, amount: int = 10) -> str:
@@ -149,41 +151,22 @@ async def get_top_users_visual(db: DB, guild_id: int, client, type_: str, timepe
     return name
 
 
-async def get_top_channels(db: DB, guild_id: int, type_: str, amount: int = 10):
+async def get_top_channels(db: DB, guild_id: int, type_: str, amount: int = 10, message_filter: MessageFilter = None):
+    """Returns the channels with the most non-bot messages, words or characters, as (channel_id, count) tuples.
+
+    Messages are counted from the rollups, which count every message, so messages without content (e.g. only an
+    attachment) count too, as they do in get_top_users.
+    """
+    message_filter = (message_filter or MessageFilter(guild_id)).replace(exclude_bots=True)
+
     if type_ == "messages":
-        return await db.execute(
-            f"""
-                SELECT channel_id, COUNT(aliased_author_id) AS count
-                FROM `{guild_id}` WHERE is_bot = 0
-                AND message_content IS NOT NULL
-                GROUP BY channel_id
-                ORDER BY count DESC
-                LIMIT {amount};
-            """, fetch="all"
-        )
+        return await _top_from_rollup(db, message_filter, "channel_id", "message_count", amount)
 
     elif type_ == "words":
-        return await get_top_channels_by_words(db=db, guild_id=guild_id, amount=amount)
+        return await get_top_channels_by_words(db=db, guild_id=guild_id, amount=amount, message_filter=message_filter)
 
     elif type_ == "characters":
-        # get all messages
-        res = await db.execute(
-            f"""
-                        SELECT channel_id, message_content
-                        FROM `{guild_id}` WHERE is_bot = 0 AND message_content IS NOT NULL
-                    """, fetch="all"
-        )
-
-        # Count characters for each user
-        char_counts = Counter()
-
-        for channel_id, message in res:
-            char_counts[channel_id] += len(message)
-
-        # Get the top users and their character counts
-        top_channels = char_counts.most_common()
-
-        return top_channels[:amount]
+        return await _sum_metric(db, message_filter, "channel_id", "char_count", amount)
 
 
 async def get_top_channels_visual(db: DB, guild_id: int, client, type_: str, amount: int = 10) -> str:
@@ -231,13 +214,13 @@ async def get_user_top_date(db: DB, guild_id: int, user_id: int, amount: int = 1
     res = await db.execute(
         f"""
             SELECT
-                UNIX_TIMESTAMP(CONCAT(DATE_FORMAT(FROM_UNIXTIME(epoch), '%Y-%m-%d'), ' 00:00:00')) AS start_of_day_epoch,
-                COUNT(CASE WHEN aliased_author_id = {user_id} THEN 1 ELSE NULL END) AS count,
-                COUNT(*) AS total_count
+                {db.dialect.start_of_day("hour_bucket")} AS start_of_day_epoch,
+                CAST(SUM(CASE WHEN aliased_author_id = {user_id} THEN message_count ELSE 0 END) AS {db.dialect.int_type}) AS count,
+                CAST(SUM(message_count) AS {db.dialect.int_type}) AS total_count
             FROM
-                `{guild_id}`
+                {ROLLUP_TABLE}
             WHERE
-                epoch <= UNIX_TIMESTAMP()
+                guild_id = {guild_id} AND hour_bucket <= {db.dialect.now}
             GROUP BY
                 start_of_day_epoch
             ORDER BY
@@ -252,12 +235,12 @@ async def get_server_top_date(db: DB, guild_id: int, amount: int = 10):
     res = await db.execute(
         f"""
     SELECT
-        UNIX_TIMESTAMP(CONCAT(DATE_FORMAT(FROM_UNIXTIME(epoch), '%Y-%m-%d'), ' 00:00:00')) AS start_of_day_epoch,
-        COUNT(*) AS count
+        {db.dialect.start_of_day("hour_bucket")} AS start_of_day_epoch,
+        CAST(SUM(message_count) AS {db.dialect.int_type}) AS count
     FROM
-        `{guild_id}`
+        {ROLLUP_TABLE}
     WHERE
-        epoch <= UNIX_TIMESTAMP()
+        guild_id = {guild_id} AND hour_bucket <= {db.dialect.now}
     GROUP BY
         start_of_day_epoch
     ORDER BY
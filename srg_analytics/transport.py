@@ -0,0 +1,127 @@
+"""Shared memory transport of message batches to the worker processes.
+
+A batch is packed into one block - the end offsets of the messages, optionally a key per message (e.g. its author),
+then the UTF-8 bytes of all the messages back to back - so only the name of the block is pickled, and the workers
+read the messages straight out of it.
+"""
+
+import contextlib
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+class PackedMessages:
+    """A batch of messages in one buffer.
+
+    Iterating yields the messages as strings, so it can be passed to anything taking a list of messages. `data` is the
+    UTF-8 bytes of all of them, the message i being data[ends[i - 1]:ends[i]], and `keys` the key of every message, or
+    None.
+    """
+
+    def __init__(self, data, ends: np.ndarray, keys: np.ndarray = None):
+        self.data = data
+        self.ends = ends
+        self.keys = keys
+
+    @classmethod
+    def pack(cls, messages, keys=None) -> "PackedMessages":
+        """Packs messages (str, UTF-8 bytes or None) into an in-process buffer."""
+        encoded = [message.encode("utf-8") if isinstance(message, str) else message or b"" for message in messages]
+        ends = np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)))
+        keys = None if keys is None else np.fromiter(keys, dtype=np.int64, count=len(encoded))
+
+        return cls(b"".join(encoded), ends, keys)
+
+    @classmethod
+    def pack_rows(cls, rows) -> "PackedMessages":
+        """Packs a batch of messages, or of (integer key, message) rows."""
+        if rows and isinstance(rows[0], (tuple, list)):
+            return cls.pack([message for _, message in rows], [key for key, _ in rows])
+        return cls.pack(rows)
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __iter__(self):
+        data = self.data
+        start = 0
+        for end in self.ends.tolist():
+            yield str(data[start:end], "utf-8", "replace")
+            start = end
+
+    @property
+    def starts(self) -> np.ndarray:
+        return np.concatenate(([0], self.ends[:-1])).astype(np.int64)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.ends, prepend=0)
+
+    def bytes(self) -> np.ndarray:
+        """The data as an array of bytes, without copying it."""
+        return np.frombuffer(self.data, dtype=np.uint8)
+
+    def message(self, i: int) -> str:
+        start = int(self.ends[i - 1]) if i else 0
+        return str(self.data[start:int(self.ends[i])], "utf-8", "replace")
+
+    def non_ascii(self) -> np.ndarray:
+        """The indexes of the messages with non-ASCII characters."""
+        high = self.bytes() >= 128
+        if not high.any():
+            return np.empty(0, dtype=np.int64)
+
+        running = np.concatenate(([0], np.cumsum(high)))
+        return np.flatnonzero(running[self.ends] - running[self.starts])
+
+
+class SharedBatch:
+    """A packed batch copied into a shared memory block. Pass `handle` to read_shared in a worker, and close() the
+    batch once the worker is done with it."""
+
+    def __init__(self, packed: PackedMessages):
+        count = len(packed)
+        keyed = packed.keys is not None
+        header = 8 * count * (2 if keyed else 1)
+        size = len(packed.data)
+
+        self._shm = shared_memory.SharedMemory(create=True, size=max(header + size, 1))
+        self.handle = (self._shm.name, count, keyed, size)
+
+        buffer = self._shm.buf
+        np.ndarray(count, dtype=np.int64, buffer=buffer)[:] = packed.ends
+        if keyed:
+            np.ndarray(count, dtype=np.int64, buffer=buffer, offset=8 * count)[:] = packed.keys
+        buffer[header:header + size] = packed.data
+
+    @classmethod
+    def pack(cls, rows) -> "SharedBatch":
+        """Packs a batch of messages, or of (integer key, message) rows, see PackedMessages.pack_rows."""
+        return cls(PackedMessages.pack_rows(rows))
+
+    def close(self):
+        self._shm.close()
+        self._shm.unlink()
+
+
+def _call_packed(func, buffer, count: int, keyed: bool, size: int):
+    header = 8 * count * (2 if keyed else 1)
+    ends = np.ndarray(count, dtype=np.int64, buffer=buffer)
+    keys = np.ndarray(count, dtype=np.int64, buffer=buffer, offset=8 * count) if keyed else None
+
+    return func(PackedMessages(buffer[header:header + size], ends, keys))
+
+
+def read_shared(func, handle):
+    """Runs func(PackedMessages) on the batch of a SharedBatch handle, in a worker process. The result must not hold
+    on to the packed messages, it is only valid until this returns."""
+    name, count, keyed, size = handle
+    shm = shared_memory.SharedMemory(name)
+
+    try:
+        return _call_packed(func, shm.buf, count, keyed, size)
+    finally:
+        # if func raised, its traceback may still hold views of the block; it is unmapped once they are freed
+        with contextlib.suppress(BufferError):
+            shm.close()
@@ -6,11 +6,14 @@ import matplotlib.pyplot as plt
 import mplcyberpunk
 
 from .DB import DB
+from .filters import MessageFilter
 from .helpers import get_top_words
 
 
-async def wordcloud(db: DB, guild_id: int, user_id: int = None, channel_id: int = None):
-    top_words = await get_top_words(db=db, guild_id=guild_id, user_id=user_id, channel_id=channel_id, amount=100)
+async def wordcloud(db: DB, guild_id: int, user_id: int = None, channel_id: int = None,
+                    message_filter: MessageFilter = None):
+    top_words = await get_top_words(db=db, guild_id=guild_id, user_id=user_id, channel_id=channel_id, amount=100,
+                                    message_filter=message_filter)
     # top_words = [(word, count), (word, count), ...]
 
     dpi = 300